@@ -0,0 +1,91 @@
+"""
+注文用紙OCRテキストからのフォーム抽出のベンチマーク。
+benchmarks/ocr_samples/*.txt の各サンプルについて、
+  - LLMのみ      : openai_extract_form_data (全項目を OpenAI に問い合わせる。ローカル抽出導入前の動作)
+  - ローカル+LLM : extract_form_data (ローカル抽出で埋まらなかった項目だけ問い合わせる)
+の処理時間・OpenAI 呼び出し回数・プロンプトトークン数と、ローカル抽出単体の処理時間を比べる。
+
+既定では OpenAI をスタブに差し替えて (応答は "{}"、トークン数は count_tokens で計算) ローカルで完結する。
+--live を付けると OPENAI_API_KEY で実際の API を呼び、実測のレイテンシとトークン数を表示する。
+
+    python benchmarks/bench_extract.py [--live] [--iterations N]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("CHANNEL_SECRET", "bench")
+
+import graffitees_LINE_BOT as bot  # noqa: E402
+
+
+def stub_chat_completion(messages, **kwargs):
+    prompt_tokens = sum(bot.count_tokens(m["content"]) for m in messages)
+    return {
+        "choices": [{"message": {"content": "{}"}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 2},
+    }
+
+
+def measure(func, text):
+    """func(text) を1回実行し、(所要ms, OpenAI呼び出し回数, プロンプトトークン数, 埋まった項目数) を返す"""
+    before = dict(bot.openai_stats)
+    start = time.perf_counter()
+    result = func(text)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return (
+        elapsed_ms,
+        bot.openai_stats["requests"] - before["requests"],
+        bot.openai_stats["prompt_tokens"] - before["prompt_tokens"],
+        len(result),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", action="store_true", help="実際の OpenAI API を呼ぶ")
+    parser.add_argument("--iterations", type=int, default=1000, help="ローカル抽出の計測回数")
+    args = parser.parse_args()
+
+    if not args.live:
+        bot.openai.ChatCompletion.create = stub_chat_completion
+    bot.logger.setLevel("WARNING")
+
+    paths = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_samples", "*.txt")))
+    header = (
+        f"{'sample':<26}{'local us':>10}{'local':>7}"
+        f"{'llm ms':>9}{'calls':>6}{'tokens':>8}"
+        f"{'hybrid ms':>11}{'calls':>6}{'tokens':>8}{'keys':>6}"
+    )
+    print(header)
+    print("-" * len(header))
+    totals = [0, 0]
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            local = bot.local_extract_form_data(text)
+        local_us = (time.perf_counter() - start) / args.iterations * 1e6
+
+        llm_ms, llm_calls, llm_tokens, _ = measure(bot.openai_extract_form_data, text)
+        hybrid_ms, hybrid_calls, hybrid_tokens, _ = measure(bot.extract_form_data, text)
+        totals[0] += llm_tokens
+        totals[1] += hybrid_tokens
+        print(
+            f"{os.path.basename(path):<26}{local_us:>10.1f}{len(local):>4}/{len(bot.FORM_FIELD_KEYS)}"
+            f"{llm_ms:>9.1f}{llm_calls:>6}{llm_tokens:>8}"
+            f"{hybrid_ms:>11.1f}{hybrid_calls:>6}{hybrid_tokens:>8}{len(bot.FORM_FIELD_KEYS) - len(local):>6}"
+        )
+    print("-" * len(header))
+    print(f"prompt tokens: llm only {totals[0]}, local + llm {totals[1]}")
+
+
+if __name__ == "__main__":
+    main()
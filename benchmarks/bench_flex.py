@@ -0,0 +1,81 @@
+"""
+静的な Flex Message の返信1回あたりのCPU時間のマイクロベンチマーク。
+HTTP送信はスタブに差し替え、送信直前までの処理 (メッセージ構築 + JSON化) だけを測る。
+
+  rebuild     : 毎回ビルダーでオブジェクトを組み立て、line_bot_api.reply_message で送る (事前構築なし)
+  cached dict : 事前構築した PrecompiledMessage を line_bot_api.reply_message で送る (SDK が毎回 json.dumps)
+  fast        : 事前構築した PrecompiledMessage を reply_message_fast で送る (JSON文字列を連結するだけ)
+
+3つの送信内容が JSON として同一であることも確認する。
+
+    python benchmarks/bench_flex.py [--number N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("CHANNEL_SECRET", "bench")
+
+import graffitees_LINE_BOT as bot  # noqa: E402
+
+
+class StubResponse:
+    status_code = 200
+    headers = {}
+    json = {}
+
+
+class StubHttpClient:
+    """送信せずに最後のリクエストボディだけ覚えておく"""
+
+    def __init__(self):
+        self.last_body = None
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.last_body = data
+        return StubResponse()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=2000, help="1パターンあたりの繰り返し回数")
+    args = parser.parse_args()
+
+    stub = StubHttpClient()
+    bot.line_bot_api.http_client = stub
+
+    builders = {
+        "mode selection": (bot.create_mode_selection_flex.__wrapped__, bot.create_mode_selection_flex),
+        "quick estimate intro": (bot.create_quick_estimate_intro_flex.__wrapped__, bot.create_quick_estimate_intro_flex),
+        "early discount": (bot.create_early_discount_flex.__wrapped__, bot.create_early_discount_flex),
+        "product carousel": (
+            lambda: bot.build_product_selection_carousel(bot.get_catalog().product_names),
+            bot.create_product_selection_carousel
+        ),
+        "print position": (bot.create_print_position_flex.__wrapped__, bot.create_print_position_flex),
+        "color options": (bot.create_color_options_flex.__wrapped__, bot.create_color_options_flex),
+    }
+
+    print(f"{'message':<22}{'rebuild us':>12}{'cached dict us':>16}{'fast us':>10}")
+    for name, (build, cached) in builders.items():
+        paths = {
+            "rebuild": lambda: bot.line_bot_api.reply_message("token", build()),
+            "cached dict": lambda: bot.line_bot_api.reply_message("token", cached()),
+            "fast": lambda: bot.reply_message_fast("token", cached()),
+        }
+        timings, bodies = {}, {}
+        for label, send in paths.items():
+            send()
+            bodies[label] = json.loads(stub.last_body)
+            timings[label] = timeit.timeit(send, number=args.number) / args.number * 1e6
+        assert bodies["rebuild"] == bodies["cached dict"] == bodies["fast"], name
+        print(f"{name:<22}{timings['rebuild']:>12.1f}{timings['cached dict']:>16.1f}{timings['fast']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+注文用紙の写真を Vision に送る前の正規化 (normalize_image_for_ocr) のベンチマーク。
+benchmarks/ocr_samples/*.txt から描画した用紙写真の各サンプルについて、
+  - 元画像   : 受け取った JPEG をそのまま送る (OCR_NORMALIZE=0 の動作)
+  - 正規化後 : 縮小・グレースケール化・EXIF の向き補正・傾き補正・再エンコードした JPEG を送る
+の送信バイト数と正規化の処理時間を比べ、元画像の品質チェック (check_image_quality) の判定も表示する。
+(本番でも品質チェックは元画像に対して行う。傾き補正後の画像は四隅が白で埋まるため判定には使わない)
+
+写真は実行時に各テキストを 3024x4032 の用紙写真として Pillow で描画し、一時ディレクトリに JPEG で書き出す
+(傾き・ノイズ・暗さを加え、03 は EXIF の向き 6 で横向きに保存。乱数は固定なので毎回同じ画像になる)。
+正解テキストは描画元の .txt。日本語の描画には CJK フォントが要る (--font で指定。省略時はよくある場所を探し、
+見つからなければ Pillow の既定フォントで描くので、その場合 --live の精度は参考にならない)。
+
+--live を付けると GOOGLE_APPLICATION_CREDENTIALS で実際の Vision API を呼び、両方の OCR レイテンシと精度
+(正解テキストとの文字一致率、正解テキストと同じ値を local_extract_form_data で読めた項目数) も表示する。
+
+    python benchmarks/bench_ocr_image.py [--live] [--iterations N] [--font PATH]
+"""
+import argparse
+import difflib
+import glob
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("CHANNEL_SECRET", "bench")
+
+import graffitees_LINE_BOT as bot  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PHOTO_SIZE = (3024, 4032)
+PAGE_SIZE = (2520, 3560)
+# サンプル名 -> (傾き(度), EXIF の向き, 明るさの倍率)。一覧にないサンプルは傾き・暗さなし
+PHOTO_VARIANTS = {
+    "01_clean": (0.0, 1, 1.0),
+    "02_noisy_photo": (3.2, 1, 0.9),
+    "03_split_lines": (-1.5, 6, 1.0),
+    "04_sparse_handwriting": (2.0, 1, 0.85),
+}
+CJK_FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/msgothic.ttc",
+]
+
+
+def load_font(path, size):
+    for candidate in [path] if path else CJK_FONT_CANDIDATES:
+        if os.path.exists(candidate):
+            return ImageFont.truetype(candidate, size)
+    if path:
+        sys.exit(f"font not found: {path}")
+    print("warning: no CJK font found; Japanese text renders as boxes (use --font)", file=sys.stderr)
+    return ImageFont.load_default(size)
+
+
+def render_photo(text, name, font_path, out_dir, rng):
+    """テキストを用紙に描き、机の上で撮ったような写真の JPEG にしてパスを返す"""
+    skew, orientation, brightness = PHOTO_VARIANTS.get(name, (0.0, 1, 1.0))
+    lines = [line for line in text.splitlines() if line.strip()]
+    size = min(110, int(PAGE_SIZE[1] * 0.9 / max(len(lines), 1) * 0.6))
+    font = load_font(font_path, size)
+
+    page = Image.new("L", PAGE_SIZE, 245)
+    draw = ImageDraw.Draw(page)
+    for i, line in enumerate(lines):
+        draw.text((160, 180 + i * int(size * 1.6)), line, fill=25, font=font)
+    photo = Image.new("L", PHOTO_SIZE, 90)
+    photo.paste(page, ((PHOTO_SIZE[0] - PAGE_SIZE[0]) // 2, (PHOTO_SIZE[1] - PAGE_SIZE[1]) // 2))
+    photo = photo.rotate(skew, resample=Image.BICUBIC, fillcolor=90).filter(ImageFilter.GaussianBlur(1.2))
+
+    # 黄ばんだ紙の色味とセンサーノイズ
+    pixels = np.asarray(photo, dtype=np.float32)[..., None] * brightness * np.array([1.0, 0.97, 0.92])
+    pixels += rng.normal(0, 6, pixels.shape)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+    exif = Image.Exif()
+    if orientation != 1:
+        image = image.transpose(Image.ROTATE_90)  # センサーの向きのまま保存し、表示時の回転は EXIF に任せる
+        exif[bot.EXIF_ORIENTATION_TAG] = orientation
+    path = os.path.join(out_dir, f"{name}.jpg")
+    image.save(path, quality=88, exif=exif)
+    return path
+
+
+def quality_verdict(image_content):
+    try:
+        bot.check_image_quality(image_content)
+    except bot.PoorImageQualityError as e:
+        return e.reason
+    return "ok"
+
+
+def ocr_accuracy(ocr_text, truth):
+    """(文字一致率, 正解と同じ値を読めた項目数, 正解テキストから読める項目数)"""
+    chars = difflib.SequenceMatcher(None, "".join(ocr_text.split()), "".join(truth.split())).ratio()
+    expected = bot.local_extract_form_data(truth)
+    actual = bot.local_extract_form_data(ocr_text)
+    return chars, sum(actual.get(k) == v for k, v in expected.items()), len(expected)
+
+
+def timed_ocr(image_content):
+    """キャッシュを通さずに1回 OCR し、(所要ms, テキスト) を返す"""
+    start = time.perf_counter()
+    text = bot.google_vision_ocr(image_content)
+    return (time.perf_counter() - start) * 1000, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", action="store_true", help="実際の Vision API を呼ぶ")
+    parser.add_argument("--iterations", type=int, default=5, help="正規化の計測回数 (中央値を表示)")
+    parser.add_argument("--font", help="日本語を描画するフォント (.ttf / .ttc)")
+    args = parser.parse_args()
+
+    bot.logger.setLevel("WARNING")
+    bot.VISION_BATCH = False
+
+    with tempfile.TemporaryDirectory(prefix="bench_ocr_image_") as out_dir:
+        rng = np.random.default_rng(0)
+        samples = []
+        for text_path in sorted(glob.glob(os.path.join(BENCH_DIR, "ocr_samples", "*.txt"))):
+            name = os.path.splitext(os.path.basename(text_path))[0]
+            with open(text_path, encoding="utf-8") as f:
+                truth = f.read()
+            samples.append((name, truth, render_photo(truth, name, args.font, out_dir, rng)))
+        run(samples, args)
+
+
+def run(samples, args):
+    header = f"{'sample':<26}{'raw KB':>8}{'norm KB':>9}{'norm ms':>9}{'gate':>9}"
+    if args.live:
+        # 以降の列は "元画像/正規化後"
+        header += f"{'ocr ms':>14}{'chars':>12}{'fields':>12}"
+    print(header)
+    print("-" * len(header))
+    totals = {"raw": 0, "norm": 0, "raw_ms": 0.0, "norm_ms": 0.0}
+    for name, truth, path in samples:
+        with open(path, "rb") as f:
+            raw = f.read()
+
+        elapsed = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            normalized = bot.normalize_image_for_ocr(raw)
+            elapsed.append((time.perf_counter() - start) * 1000)
+        totals["raw"] += len(raw)
+        totals["norm"] += len(normalized)
+        line = (
+            f"{name:<26}{len(raw) / 1024:>8.0f}{len(normalized) / 1024:>9.0f}{statistics.median(elapsed):>9.0f}"
+            f"{quality_verdict(raw):>9}"
+        )
+
+        if args.live:
+            raw_ms, raw_text = timed_ocr(raw)
+            norm_ms, norm_text = timed_ocr(normalized)
+            totals["raw_ms"] += raw_ms
+            totals["norm_ms"] += norm_ms
+            raw_chars, raw_fields, n_fields = ocr_accuracy(raw_text, truth)
+            norm_chars, norm_fields, _ = ocr_accuracy(norm_text, truth)
+            line += (
+                f"{f'{raw_ms:.0f}/{norm_ms:.0f}':>14}{f'{raw_chars:.2f}/{norm_chars:.2f}':>12}"
+                f"{f'{raw_fields}/{norm_fields} of {n_fields}':>12}"
+            )
+        print(line)
+    print("-" * len(header))
+    print(f"bytes uploaded: raw {totals['raw'] / 1024:.0f} KB, normalized {totals['norm'] / 1024:.0f} KB")
+    if args.live:
+        print(f"OCR latency: raw {totals['raw_ms']:.0f} ms, normalized {totals['norm_ms']:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import time
 import psycopg2
 import requests
 from dotenv import load_dotenv
-from flask import Flask, request, abort, render_template_string
+from flask import Flask, request, abort
 import logging
 import traceback
 import json
@@ -63,29 +63,741 @@ line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
 
 # ---------------------------------------
-# (B) ユーザーの状態管理 (簡易) - DB等推奨
+# (B) ユーザーの状態管理
+#     STATE_BACKEND で memory / sqlite / postgres を切り替える。
+#     gunicorn の複数ワーカー間で状態を共有する場合は sqlite(同一ホスト) か postgres を使う。
+#     compare_and_set は、現在の状態が expected と一致する(期限内の)ときだけ置き換えて True を返す。
+#     STATE_WRITE_BEHIND_SEC > 0 なら sqlite / postgres への書き込みを溜めて一定間隔でまとめて書く。
 # ---------------------------------------
-user_states = {}
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_TTL_SECONDS = int(os.getenv('STATE_TTL_SECONDS', '86400'))       # 最終更新からこの秒数で破棄
+STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', '10000'))       # memory のみ: LRUで追い出す上限
+STATE_SQLITE_PATH = os.getenv('STATE_SQLITE_PATH', 'user_states.db')
+STATE_SWEEP_INTERVAL = int(os.getenv('STATE_SWEEP_INTERVAL', '300'))   # 期限切れ掃除の間隔(秒)
+STATE_WRITE_BEHIND_SEC = float(os.getenv('STATE_WRITE_BEHIND_SEC', '0'))  # 0 なら毎回すぐ書く (sqlite / postgres のみ)
+
+def _dump_state(state: dict) -> str:
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":"))
+
+class MemoryStateStore:
+    """プロセス内の辞書。TTL と件数上限(LRU)で古いセッションを追い出す"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # user_id -> (expires_at, state)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return json.loads(item[1])
+
+    def set(self, user_id, state):
+        with self._lock:
+            self._data[user_id] = (time.time() + self.ttl, _dump_state(state))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def compare_and_set(self, user_id, expected, state) -> bool:
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None or item[0] < time.time() or item[1] != _dump_state(expected):
+                return False
+            self._data[user_id] = (time.time() + self.ttl, _dump_state(state))
+            self._data.move_to_end(user_id)
+            return True
+
+    def delete(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (expires_at, _) in self._data.items() if expires_at < now]
+            for k in expired:
+                del self._data[k]
+        return len(expired)
+
+class SQLiteStateStore:
+    """同一ホスト上のワーカー間で共有する SQLite ファイル (スレッドごとに接続)"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_states ("
+                " user_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        row = self._conn().execute(
+            "SELECT data FROM user_states WHERE user_id = ? AND expires_at >= ?",
+            (user_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, user_id, state):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO user_states (user_id, data, expires_at) VALUES (?, ?, ?)",
+                (user_id, _dump_state(state), time.time() + self.ttl)
+            )
+
+    def compare_and_set(self, user_id, expected, state) -> bool:
+        now = time.time()
+        with self._conn() as conn:
+            return conn.execute(
+                "UPDATE user_states SET data = ?, expires_at = ?"
+                " WHERE user_id = ? AND data = ? AND expires_at >= ?",
+                (_dump_state(state), now + self.ttl, user_id, _dump_state(expected), now)
+            ).rowcount == 1
+
+    def delete(self, user_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+
+    def write_many(self, items):
+        """items: user_id -> シリアライズ済みの状態 (None なら削除)。1トランザクションで書く"""
+        expires_at = time.time() + self.ttl
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_states (user_id, data, expires_at) VALUES (?, ?, ?)",
+                [(user_id, data, expires_at) for user_id, data in items.items() if data is not None]
+            )
+            conn.executemany(
+                "DELETE FROM user_states WHERE user_id = ?",
+                [(user_id,) for user_id, data in items.items() if data is None]
+            )
+
+    def sweep(self):
+        with self._conn() as conn:
+            return conn.execute("DELETE FROM user_states WHERE expires_at < ?", (time.time(),)).rowcount
+
+class PostgresStateStore:
+    """PostgreSQL の user_states テーブル (複数ホストで共有可)"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_states (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    expires_at TIMESTAMPTZ NOT NULL
+                )
+                """)
+
+    def get(self, user_id):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT data FROM user_states WHERE user_id = %s AND expires_at >= NOW()",
+                    (user_id,)
+                )
+                row = cur.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, user_id, state):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO user_states (user_id, data, expires_at)
+                    VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                    ON CONFLICT (user_id) DO UPDATE
+                       SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                    """,
+                    (user_id, _dump_state(state), self.ttl)
+                )
+
+    def compare_and_set(self, user_id, expected, state) -> bool:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE user_states
+                       SET data = %s, expires_at = NOW() + %s * INTERVAL '1 second'
+                     WHERE user_id = %s AND data = %s AND expires_at >= NOW()
+                    """,
+                    (_dump_state(state), self.ttl, user_id, _dump_state(expected))
+                )
+                return cur.rowcount == 1
+
+    def delete(self, user_id):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM user_states WHERE user_id = %s", (user_id,))
+
+    def write_many(self, items):
+        """items: user_id -> シリアライズ済みの状態 (None なら削除)。1トランザクションで書く"""
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.executemany(
+                    """
+                    INSERT INTO user_states (user_id, data, expires_at)
+                    VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                    ON CONFLICT (user_id) DO UPDATE
+                       SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                    """,
+                    [(user_id, data, self.ttl) for user_id, data in items.items() if data is not None]
+                )
+                deleted = [user_id for user_id, data in items.items() if data is None]
+                if deleted:
+                    cur.execute("DELETE FROM user_states WHERE user_id = ANY(%s)", (deleted,))
+
+    def sweep(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM user_states WHERE expires_at < NOW()")
+                return cur.rowcount
+
+class WriteBehindStateStore:
+    """
+    sqlite / postgres ストアの前に置く書き込みバッファ。
+    set / delete は溜めておき、interval 秒ごとに write_many で1トランザクションにまとめて書く。
+    未反映の書き込みはこのプロセスからしか見えないため、同じユーザーのイベントが
+    別のワーカーに届く構成では interval をその間隔より十分短くすること。
+    """
+
+    def __init__(self, store, interval):
+        self.store = store
+        self.interval = interval
+        self._pending = {}   # user_id -> シリアライズ済みの状態 (None なら削除)
+        self._flushing = {}  # 書き込み中の分 (書き終わるまでは get からこちらを返す)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self._writer, name="state-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _buffered(self, user_id):
+        """バッファ上の状態 (なければ KeyError)"""
+        if user_id in self._pending:
+            return self._pending[user_id]
+        return self._flushing[user_id]
+
+    def get(self, user_id):
+        with self._lock:
+            try:
+                data = self._buffered(user_id)
+            except KeyError:
+                pass
+            else:
+                return json.loads(data) if data is not None else None
+        return self.store.get(user_id)
+
+    def set(self, user_id, state):
+        with self._lock:
+            self._pending[user_id] = _dump_state(state)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._pending[user_id] = None
+
+    def compare_and_set(self, user_id, expected, state) -> bool:
+        with self._lock:
+            try:
+                data = self._buffered(user_id)
+            except KeyError:
+                return self.store.compare_and_set(user_id, expected, state)
+            if data != _dump_state(expected):
+                return False
+            self._pending[user_id] = _dump_state(state)
+            return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+            if not self._flushing:
+                return 0
+            try:
+                self.store.write_many(self._flushing)
+            except Exception:
+                # 書けなかった分は、その後の書き込みを優先して次回に回す
+                with self._lock:
+                    for user_id, data in self._flushing.items():
+                        self._pending.setdefault(user_id, data)
+                raise
+            finally:
+                with self._lock:
+                    written, self._flushing = len(self._flushing), {}
+            return written
+
+    def _writer(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flushing buffered user states failed: {e}")
+
+    def sweep(self):
+        self.flush()
+        return self.store.sweep()
+
+_state_store = None
+_state_store_pid = None
+_state_store_lock = threading.Lock()
+
+# 状態と同じ掃除スレッドで期限切れを消すもの (名前, sweep関数)。sweep関数は削除件数を返す
+_sweep_targets = []
+
+def register_sweep_target(name, sweep):
+    _sweep_targets.append((name, sweep))
+
+def _state_sweeper(store):
+    while True:
+        time.sleep(STATE_SWEEP_INTERVAL)
+        for name, sweep in [("user states", store.sweep)] + _sweep_targets:
+            try:
+                removed = sweep()
+                if removed:
+                    logger.info(f"Swept {removed} expired {name}")
+            except Exception as e:
+                logger.error(f"Sweep of {name} failed: {e}")
+
+def get_state_store():
+    """プロセスごとに状態ストアを生成し、期限切れ掃除スレッドを起動する"""
+    global _state_store, _state_store_pid
+    pid = os.getpid()
+    if _state_store is None or _state_store_pid != pid:
+        with _state_store_lock:
+            if _state_store is None or _state_store_pid != pid:
+                if STATE_BACKEND == "postgres":
+                    store = PostgresStateStore(STATE_TTL_SECONDS)
+                elif STATE_BACKEND == "sqlite":
+                    store = SQLiteStateStore(STATE_SQLITE_PATH, STATE_TTL_SECONDS)
+                else:
+                    store = MemoryStateStore(STATE_TTL_SECONDS, STATE_MAX_ENTRIES)
+                if STATE_WRITE_BEHIND_SEC > 0 and hasattr(store, "write_many"):
+                    store = WriteBehindStateStore(store, STATE_WRITE_BEHIND_SEC)
+                threading.Thread(target=_state_sweeper, args=(store,), name="state-sweeper", daemon=True).start()
+                _state_store = store
+                _state_store_pid = pid
+    return _state_store
 
 ###################################
 # (C) DB接続 (PostgreSQL想定)
+#     プロセス単位のコネクションプールを共有する
 ###################################
+import contextlib
+from psycopg2 import pool as pg_pool
+
+DB_POOL_MINCONN = int(os.getenv('DB_POOL_MINCONN', '1'))
+DB_POOL_MAXCONN = int(os.getenv('DB_POOL_MAXCONN', '10'))
+DB_POOL_MAX_USES = int(os.getenv('DB_POOL_MAX_USES', '500'))          # N回貸し出したら接続を作り直す
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))           # 空き待ちの上限(秒)
+DB_POOL_PING_INTERVAL = float(os.getenv('DB_POOL_PING_INTERVAL', '30'))  # この秒数以上アイドルなら SELECT 1 で確認
+
+class DBConnectionPool:
+    """
+    psycopg2 の ThreadedConnectionPool をラップしたもの。
+    - 空きが無い場合は DB_POOL_TIMEOUT 秒まで待つ (ThreadedConnectionPool は即エラーになるため)
+    - 貸し出し時にヘルスチェックし、壊れた接続は作り直す
+    - max_uses 回使った接続は返却時に閉じる
+    - 待ち時間などの統計を stats に保持する
+    """
+
+    def __init__(self, minconn, maxconn, max_uses, timeout, ping_interval):
+        self._pool = pg_pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
+            dbname=DATABASE_NAME,
+            user=DATABASE_USER,
+            password=DATABASE_PASSWORD,
+            host=DATABASE_HOST,
+            port=DATABASE_PORT
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.maxconn = maxconn
+        self._uses = {}       # id(conn) -> 貸し出し回数
+        self._last_used = {}  # id(conn) -> 最後に返却された時刻
+        self.max_uses = max_uses
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "wait_total_sec": 0.0,
+            "wait_max_sec": 0.0,
+            "timeouts": 0,
+            "recycled": 0,
+            "broken": 0
+        }
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.ping_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._uses.pop(id(conn), None)
+            self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise pg_pool.PoolError(f"DB connection pool exhausted (waited {self.timeout}s)")
+        waited = time.monotonic() - start
+
+        try:
+            # DB再起動の直後はアイドル接続が全て切れているので、健全な接続か新しい接続が得られるまで捨てていく
+            for _ in range(self.maxconn + 1):
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                logger.warning("Discarding broken DB connection from pool")
+                with self._lock:
+                    self.stats["broken"] += 1
+                self._discard(conn)
+            else:
+                raise pg_pool.PoolError("No healthy DB connection available")
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._uses[id(conn)] = self._uses.get(id(conn), 0) + 1
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_total_sec"] += waited
+            self.stats["wait_max_sec"] = max(self.stats["wait_max_sec"], waited)
+        return conn
+
+    def putconn(self, conn):
+        try:
+            with self._lock:
+                self.stats["in_use"] -= 1
+                uses = self._uses.get(id(conn), 0)
+            if conn.closed or uses >= self.max_uses:
+                with self._lock:
+                    self.stats["recycled"] += 1
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def snapshot(self) -> dict:
+        """メトリクス出力用に統計をコピーして返す"""
+        with self._lock:
+            data = dict(self.stats)
+        data["wait_avg_sec"] = data["wait_total_sec"] / data["checkouts"] if data["checkouts"] else 0.0
+        return data
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> DBConnectionPool:
+    """
+    プロセスごとのコネクションプールを返す。
+    gunicorn の fork 後に親プロセスの接続を使い回さないよう、PIDが変わったら作り直す。
+    """
+    global _db_pool, _db_pool_pid
+    pid = os.getpid()
+    if _db_pool is None or _db_pool_pid != pid:
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != pid:
+                _db_pool = DBConnectionPool(
+                    DB_POOL_MINCONN,
+                    DB_POOL_MAXCONN,
+                    DB_POOL_MAX_USES,
+                    DB_POOL_TIMEOUT,
+                    DB_POOL_PING_INTERVAL
+                )
+                _db_pool_pid = pid
+    return _db_pool
+
+@contextlib.contextmanager
 def get_db_connection():
-    """PostgreSQLに接続してconnectionを返す"""
-    return psycopg2.connect(
-        dbname=DATABASE_NAME,
-        user=DATABASE_USER,
-        password=DATABASE_PASSWORD,
-        host=DATABASE_HOST,
-        port=DATABASE_PORT
-    )
+    """
+    プールからPostgreSQLの接続を借りる。
+    with を抜けると commit (例外時は rollback) してプールへ返却する。
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.putconn(conn)
+
+###################################
+# (C') LINE Push/Multicast 送信の共通部品
+#     レート制限 + 並行送信 + 429/5xx のリトライ
+###################################
+import random
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from linebot.exceptions import LineBotApiError
+
+LINE_MAX_MESSAGES_PER_REQUEST = 5
+LINE_MULTICAST_MAX_RECIPIENTS = 500
+
+LINE_PUSH_RATE = float(os.getenv('LINE_PUSH_RATE', '2000'))            # push API の上限 (req/秒)
+LINE_MULTICAST_RATE = float(os.getenv('LINE_MULTICAST_RATE', '200'))   # multicast API の上限 (req/秒)
+LINE_OUTBOX_WORKERS = int(os.getenv('LINE_OUTBOX_WORKERS', '8'))
+LINE_OUTBOX_QUEUE_SIZE = int(os.getenv('LINE_OUTBOX_QUEUE_SIZE', '1000'))
+LINE_OUTBOX_ENQUEUE_TIMEOUT = float(os.getenv('LINE_OUTBOX_ENQUEUE_TIMEOUT', '5'))  # キューが満杯の時に空きを待つ上限(秒)
+LINE_MAX_RETRIES = int(os.getenv('LINE_MAX_RETRIES', '5'))
+LINE_RETRY_BASE_DELAY = float(os.getenv('LINE_RETRY_BASE_DELAY', '0.5'))
+LINE_RETRY_MAX_DELAY = float(os.getenv('LINE_RETRY_MAX_DELAY', '30'))
+
+def _chunks(seq, size):
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+class TokenBucket:
+    """rate 個/秒で補充され、最大 capacity 個まで貯まるトークンバケット"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class LineOutboxFullError(Exception):
+    """送信キューが満杯のまま空かず、送信を諦めたメッセージ"""
+
+class LineOutbox:
+    """
+    LINE への push / multicast をワーカースレッドで並行送信する。
+    - API ごとのトークンバケットで LINE のレート上限を超えないようにする
+    - 5通ごとのチャンクにそれぞれ X-Line-Retry-Key を付け、429 / 5xx は失敗したチャンクだけを
+      指数バックオフ(ジッタ付き)で同じキーのまま再送する
+    - 未処理件数が queue_size に達すると send() は enqueue_timeout 秒まで空きを待ち、
+      空かなければ送信せずに LineOutboxFullError を保持した Future を返す (呼び出し元のスレッドを止めない)
+    """
+
+    def __init__(self, workers, queue_size, max_retries, enqueue_timeout):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="line-outbox")
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._buckets = {
+            "push": TokenBucket(LINE_PUSH_RATE),
+            "multicast": TokenBucket(LINE_MULTICAST_RATE)
+        }
+        self.max_retries = max_retries
+        self.enqueue_timeout = enqueue_timeout
+        self._lock = threading.Lock()
+        self._recent = deque()  # 直近60秒の送信完了時刻 (スループット算出用)
+        self.stats = {
+            "queue_depth": 0,
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+            "retries": 0,
+            "queue_latency_total_sec": 0.0,
+            "queue_latency_max_sec": 0.0
+        }
+
+    def send(self, to, messages, retry_key=None):
+        """
+        to: user_id (str) または user_id のリスト (500件まで)
+        messages: SendMessage またはそのリスト (5通を超える分は順番に分割送信)
+        retry_key: 失敗した送信を後でやり直す時に同じ値を渡すと、各チャンクに前回と同じリトライキーが付き、
+                   送信済みのチャンクは LINE 側で受理済み (409) として扱われ二重に届かない (キーの有効期間は24時間)
+        戻り値: concurrent.futures.Future (失敗時は例外を保持)
+        """
+        recipients = [to] if isinstance(to, str) else list(to)
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        if retry_key is None:
+            retry_key = str(uuid.uuid4())
+        if not self._slots.acquire(timeout=self.enqueue_timeout):
+            with self._lock:
+                self.stats["dropped"] += 1
+            logger.error(
+                f"LINE outbox full; dropped {len(messages)} message(s) to {len(recipients)} recipient(s) "
+                f"after waiting {self.enqueue_timeout}s (retry_key={retry_key})"
+            )
+            future = Future()
+            future.set_exception(LineOutboxFullError(f"LINE outbox full (waited {self.enqueue_timeout}s)"))
+            return future
+        with self._lock:
+            self.stats["queue_depth"] += 1
+        try:
+            future = self._executor.submit(self._run, recipients, list(messages), retry_key, time.monotonic())
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, recipients, messages, retry_key, enqueued_at):
+        waited = time.monotonic() - enqueued_at
+        with self._lock:
+            self.stats["queue_depth"] -= 1
+            self.stats["queue_latency_total_sec"] += waited
+            self.stats["queue_latency_max_sec"] = max(self.stats["queue_latency_max_sec"], waited)
+        try:
+            for i, msg_chunk in enumerate(_chunks(messages, LINE_MAX_MESSAGES_PER_REQUEST)):
+                chunk_retry_key = str(uuid.uuid5(uuid.NAMESPACE_OID, f"{retry_key}:{i}"))
+                self._call_with_retry(recipients, msg_chunk, chunk_retry_key)
+        except Exception:
+            with self._lock:
+                self.stats["failed"] += 1
+            raise
+        with self._lock:
+            self.stats["sent"] += 1
+            now = time.monotonic()
+            self._recent.append(now)
+            while self._recent and self._recent[0] < now - 60:
+                self._recent.popleft()
+        return True
+
+    def _call_with_retry(self, recipients, messages, retry_key):
+        kind = "push" if len(recipients) == 1 else "multicast"
+        for attempt in range(self.max_retries + 1):
+            self._buckets[kind].acquire()
+            try:
+                push_messages(recipients, messages, retry_key)
+                return
+            except LineBotApiError as e:
+                if e.status_code == 409 and e.accepted_request_id:
+                    # このチャンクのリトライキーのリクエストは受理済み (X-Line-Accepted-Request-Id が返る)
+                    return
+                if (e.status_code != 429 and e.status_code < 500) or attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(LINE_RETRY_MAX_DELAY, LINE_RETRY_BASE_DELAY * (2 ** attempt)))
+                logger.warning(f"LINE {kind} got {e.status_code}; retry {attempt + 1} in {delay:.2f}s")
+                with self._lock:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+            now = time.monotonic()
+            data["throughput_per_sec_1m"] = sum(1 for t in self._recent if t >= now - 60) / 60.0
+        done = data["sent"] + data["failed"]
+        data["queue_latency_avg_sec"] = data["queue_latency_total_sec"] / done if done else 0.0
+        return data
+
+_line_outbox = None
+_line_outbox_pid = None
+_line_outbox_lock = threading.Lock()
+
+def get_line_outbox() -> LineOutbox:
+    """プロセスごと(fork後)に送信ワーカーを生成する"""
+    global _line_outbox, _line_outbox_pid
+    pid = os.getpid()
+    if _line_outbox is None or _line_outbox_pid != pid:
+        with _line_outbox_lock:
+            if _line_outbox is None or _line_outbox_pid != pid:
+                _line_outbox = LineOutbox(
+                    LINE_OUTBOX_WORKERS,
+                    LINE_OUTBOX_QUEUE_SIZE,
+                    LINE_MAX_RETRIES,
+                    LINE_OUTBOX_ENQUEUE_TIMEOUT
+                )
+                _line_outbox_pid = pid
+    return _line_outbox
+
+def push_message_async(user_id, messages):
+    """応答を待たずに push する。失敗はログに残す"""
+    def _log_failure(future):
+        if future.exception() is not None:
+            logger.error(f"Push message failed for user_id={user_id}: {future.exception()}")
+    get_line_outbox().send(user_id, messages).add_done_callback(_log_failure)
 
 ###################################
 # (D) S3にファイルをアップロード
 ###################################
 import boto3
+from boto3.s3.transfer import TransferConfig
 from werkzeug.utils import secure_filename
-import uuid
+
+S3_UPLOAD_WORKERS = int(os.getenv('S3_UPLOAD_WORKERS', '4'))
+S3_MULTIPART_THRESHOLD_MB = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8'))
+
+# 大きいデザイン画像はマルチパートで分割・並行アップロードする
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True
+)
+
+_s3_client = None
+_s3_executor = None
+_s3_pid = None
+_s3_lock = threading.Lock()
+
+def _init_s3():
+    """S3クライアントとアップロード用スレッドプールをプロセスごと(fork後)に1つだけ作る"""
+    global _s3_client, _s3_executor, _s3_pid
+    pid = os.getpid()
+    if _s3_client is None or _s3_pid != pid:
+        with _s3_lock:
+            if _s3_client is None or _s3_pid != pid:
+                _s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+                )
+                _s3_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3-upload")
+                _s3_pid = pid
+
+def get_s3_client():
+    _init_s3()
+    return _s3_client
 
 def upload_file_to_s3(file_storage, s3_bucket, prefix="uploads/"):
     """
@@ -97,23 +809,32 @@ def upload_file_to_s3(file_storage, s3_bucket, prefix="uploads/"):
     if not file_storage or file_storage.filename == "":
         return None
 
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-    )
+    s3 = get_s3_client()
 
     filename = secure_filename(file_storage.filename)
     unique_id = str(uuid.uuid4())
     s3_key = prefix + unique_id + "_" + filename
 
-    s3.upload_fileobj(file_storage, s3_bucket, s3_key)
+    s3.upload_fileobj(file_storage, s3_bucket, s3_key, Config=S3_TRANSFER_CONFIG)
 
     url = f"https://{s3_bucket}.s3.amazonaws.com/{s3_key}"
     return url
 
+def upload_files_to_s3(file_storages, s3_bucket, prefix="uploads/"):
+    """
+    複数ファイルを並行してアップロードする。
+    戻り値: 引数と同じ順番の URL リスト (空のファイルは None)
+    """
+    _init_s3()
+    futures = [
+        _s3_executor.submit(upload_file_to_s3, file_storage, s3_bucket, prefix)
+        for file_storage in file_storages
+    ]
+    return [future.result() for future in futures]
+
 ###################################
 # (E) 価格表と計算ロジック (既存)
+#     PRICE_TABLE は組み込みの既定カタログ (CATALOG_SOURCE=builtin)
 ###################################
 PRICE_TABLE = [
     # product,  minQty, maxQty, discountType, unitPrice, addColor, addPosition, addFullColor
@@ -327,6 +1048,59 @@ PRICE_TABLE = [
     ("ジップアップライトパーカー", 100, 500, "通常", 2910, 300, 300, 550),
 ]
 
+import bisect
+
+class PriceIndex:
+    """
+    価格表 (PRICE_TABLE と同じ形式の行) を (商品名, 割引種別) ごとにまとめ、枚数の下限でソートした索引。
+    calc_total_price からは lookup() で該当行を bisect で引く。
+    生成時に枚数レンジの重複・抜けを検証し、不正なら ValueError を送出する。
+    """
+
+    def __init__(self, table):
+        self._mins = {}
+        self._rows = {}
+        grouped = {}
+        for row in table:
+            grouped.setdefault((row[0], row[3]), []).append(row)
+        for key, rows in grouped.items():
+            rows.sort(key=lambda r: r[1])
+            self._mins[key] = [r[1] for r in rows]
+            self._rows[key] = rows
+        self.validate()
+
+    def validate(self):
+        problems = []
+        for (product, d_type), rows in self._rows.items():
+            for r in rows:
+                if r[1] > r[2]:
+                    problems.append(f"{product}/{d_type}: {r[1]}-{r[2]} の下限が上限より大きい")
+            for prev, cur in zip(rows, rows[1:]):
+                if cur[1] <= prev[2]:
+                    problems.append(f"{product}/{d_type}: {prev[1]}-{prev[2]} と {cur[1]}-{cur[2]} が重複")
+                elif cur[1] != prev[2] + 1:
+                    problems.append(f"{product}/{d_type}: {prev[2] + 1}-{cur[1] - 1} の価格が未定義")
+        if problems:
+            raise ValueError("価格表の枚数レンジが不正です: " + "; ".join(problems))
+
+    def groups(self):
+        """(商品名, 割引種別) ごとの、枚数下限でソート済みの行リストを返す"""
+        return sorted(self._rows.items())
+
+    def lookup(self, product_name: str, discount_type: str, quantity: int):
+        """該当する価格表の行(タプル)を返す。無ければ None"""
+        key = (product_name, discount_type)
+        mins = self._mins.get(key)
+        if not mins:
+            return None
+        i = bisect.bisect_right(mins, quantity) - 1
+        if i < 0:
+            return None
+        row = self._rows[key][i]
+        if quantity > row[2]:
+            return None
+        return row
+
 def calc_total_price(
     product_name: str,
     quantity: int,
@@ -339,13 +1113,7 @@ def calc_total_price(
     else:
         discount_type = "通常"
 
-    row = None
-    for item in PRICE_TABLE:
-        (p_name, min_q, max_q, d_type, unit_price, color_price, pos_price, full_price) = item
-        if p_name == product_name and d_type == discount_type and min_q <= quantity <= max_q:
-            row = item
-            break
-
+    row = get_catalog().price_index.lookup(product_name, discount_type, quantity)
     if not row:
         return 0
 
@@ -363,9 +1131,459 @@ def calc_total_price(
     total = base + option_cost
     return total
 
+###################################
+# (E') 一括見積 (NumPy でベクトル化)
+#     過去見積の再計算や、枚数ごとの価格カーブ表示用
+###################################
+import numpy as np
+
+# color_option -> PriceArrays.option_prices の列番号 (該当なしはオプション料金 0)
+COLOR_OPTION_COLUMNS = {
+    "same_color_add": 0,
+    "different_color_add": 1,
+    "full_color_add": 2
+}
+
+class PriceArrays:
+    """
+    PriceIndex を配列で持ち直したもの。
+    (商品名, 割引種別) に整数コードを振り、「コード * QTY_STRIDE + 枚数下限」を
+    昇順に並べた keys に対して np.searchsorted で全件を一度に引く。
+    """
+
+    QTY_STRIDE = 1 << 31
+
+    def __init__(self, price_index: PriceIndex):
+        self.group_codes = {}
+        keys, max_qty, unit_prices, option_prices = [], [], [], []
+        for code, (group, rows) in enumerate(price_index.groups()):
+            self.group_codes[group] = code
+            for (_, min_q, max_q, _, unit_price, color_price, pos_price, full_price) in rows:
+                keys.append(code * self.QTY_STRIDE + min_q)
+                max_qty.append(max_q)
+                unit_prices.append(unit_price)
+                option_prices.append((color_price, pos_price, full_price, 0))
+        self.keys = np.array(keys, dtype=np.int64)
+        self.group_of_row = self.keys // self.QTY_STRIDE
+        self.max_qty = np.array(max_qty, dtype=np.int64)
+        self.unit_prices = np.array(unit_prices, dtype=np.int64)
+        self.option_prices = np.array(option_prices, dtype=np.int64)
+
+    def _encode(self, values, mapping, default):
+        """文字列配列を mapping で整数コードに変換 (ユニーク値だけ辞書を引く)"""
+        uniques, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+        codes = np.array([mapping.get(u, default) for u in uniques], dtype=np.int64)
+        return codes[inverse]
+
+    def quote(self, products, quantities, early_discounts, color_options):
+        """
+        calc_total_price と同じ規則で合計金額と1枚あたり単価を一括計算する。
+        引数はブロードキャスト可能な配列 (スカラー可)。戻り値: (totals, unit_prices)
+        """
+        products, quantities, early_discounts, color_options = np.broadcast_arrays(
+            np.asarray(products, dtype=object),
+            np.asarray(quantities, dtype=np.int64),
+            np.asarray(early_discounts, dtype=object),
+            np.asarray(color_options, dtype=object)
+        )
+        discount_types = np.where(early_discounts.astype(str) == "14日前以上", "早割", "通常")
+        group_keys = np.char.add(np.char.add(products.astype(str), "\t"), discount_types)
+        group_codes = self._encode(
+            group_keys,
+            {f"{p}\t{d}": code for (p, d), code in self.group_codes.items()},
+            -1
+        )
+        option_cols = self._encode(color_options, COLOR_OPTION_COLUMNS, 3)
+
+        qty = np.clip(quantities, 0, self.QTY_STRIDE - 1)
+        idx = np.searchsorted(self.keys, group_codes * self.QTY_STRIDE + qty, side="right") - 1
+        safe_idx = np.clip(idx, 0, len(self.keys) - 1)
+        found = (
+            (group_codes >= 0)
+            & (idx >= 0)
+            & (self.group_of_row[safe_idx] == group_codes)
+            & (quantities <= self.max_qty[safe_idx])
+        )
+
+        per_item = self.unit_prices[safe_idx] + self.option_prices[safe_idx, option_cols]
+        totals = np.where(found, per_item * quantities, 0)
+        unit_prices = np.where(quantities > 0, totals // np.maximum(quantities, 1), 0)
+        return totals, unit_prices
+
+def calc_total_price_batch(products, quantities, early_discounts, color_options):
+    """calc_total_price の一括版。(totals, unit_prices) を NumPy 配列で返す"""
+    return get_catalog().price_arrays.quote(products, quantities, early_discounts, color_options)
+
+BATCH_QUOTE_MAX_ITEMS = int(os.getenv('BATCH_QUOTE_MAX_ITEMS', '10000'))
+
+# /batch_quote の入力項目: (キー, 既定値, 値の検証)
+BATCH_QUOTE_FIELDS = (
+    ("product", "", lambda v: isinstance(v, str)),
+    ("quantity", 0, lambda v: isinstance(v, int) and not isinstance(v, bool) and 0 <= v < PriceArrays.QTY_STRIDE),
+    ("early_discount", "", lambda v: isinstance(v, str)),
+    ("color_option", "", lambda v: isinstance(v, str)),
+)
+
+def parse_batch_quote_payload(payload):
+    """
+    /batch_quote のJSONを検証し、calc_total_price_batch の引数リストを返す。不正なら ValueError。
+    各項目はスカラーか1次元の配列で、配列は全て同じ長さ (BATCH_QUOTE_MAX_ITEMS 件まで)。枚数は整数のみ。
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("JSONオブジェクトではありません")
+    args = []
+    length = None
+    for key, default, is_valid in BATCH_QUOTE_FIELDS:
+        value = payload.get(key, default)
+        values = value if isinstance(value, list) else [value]
+        if isinstance(value, list):
+            if length is not None and len(value) != length:
+                raise ValueError(f"{key}: 配列の長さが他の項目と異なります")
+            length = len(value)
+            if length > BATCH_QUOTE_MAX_ITEMS:
+                raise ValueError(f"{key}: {BATCH_QUOTE_MAX_ITEMS} 件を超えています")
+        for v in values:
+            if not is_valid(v):
+                raise ValueError(f"{key}: 不正な値です ({v!r})")
+        args.append(value)
+    return args
+
+@app.route("/batch_quote", methods=["POST"])
+def batch_quote():
+    """
+    JSON: {"product": [...], "quantity": [...], "early_discount": [...], "color_option": [...]}
+    各項目は配列またはスカラー(全件共通)。例えば product をスカラー、quantity を配列にすると価格カーブになる。
+    配列は全て同じ長さ (BATCH_QUOTE_MAX_ITEMS 件まで)、枚数は0以上の整数であること。
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        logger.warning("batch_quote invalid input: body is not JSON")
+        abort(400)
+    try:
+        totals, unit_prices = calc_total_price_batch(*parse_batch_quote_payload(payload))
+    except (TypeError, ValueError, OverflowError) as e:
+        logger.warning(f"batch_quote invalid input: {e}")
+        abort(400)
+    data = {"total_price": totals.tolist(), "unit_price": unit_prices.tolist()}
+    return app.response_class(json.dumps(data, ensure_ascii=False), mimetype="application/json")
+
+###################################
+# (F') 静的な Flex Message の事前構築
+#     ボタン構成が固定のメッセージは初回に1度だけ組み立て、JSONまで作っておく
+#     (benchmarks/bench_flex.py で1返信あたりのCPU時間を比較できる)
+###################################
+import functools
+from linebot.models import SendMessage
+from linebot.models.error import Error as LineError
+
+class PrecompiledMessage(SendMessage):
+    """as_json_dict() の結果と、そのJSON文字列を事前に計算して保持するメッセージ"""
+
+    def __init__(self, message):
+        super().__init__()
+        self._json_dict = message.as_json_dict()
+        self.json = json.dumps(self._json_dict, ensure_ascii=False, separators=(",", ":"))
+
+    def as_json_dict(self):
+        return self._json_dict
+
+def precompiled_message(builder):
+    """ビルダー関数の結果を初回呼び出し時に PrecompiledMessage 化してキャッシュする"""
+    return functools.wraps(builder)(functools.lru_cache(maxsize=None)(lambda: PrecompiledMessage(builder())))
+
+def _messages_json(messages) -> str:
+    """メッセージのリストをJSON配列の文字列にする (PrecompiledMessage は事前に作ったJSONを連結するだけ)"""
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    parts = [
+        m.json if isinstance(m, PrecompiledMessage)
+        else json.dumps(m.as_json_dict(), ensure_ascii=False, separators=(",", ":"))
+        for m in messages
+    ]
+    return "[" + ",".join(parts) + "]"
+
+def post_line_api(path, body, extra_headers=None, timeout=None):
+    """
+    SDK の公開している http_client / endpoint / headers で Messaging API に POST する。
+    リクエストごとのヘッダ (X-Line-Retry-Key など) は extra_headers で渡す。
+    line_bot_api.headers は全スレッドで共有されるので書き換えない。
+    エラーは SDK と同じ LineBotApiError にする。timeout 省略時は http_client の既定値。
+    """
+    headers = {"Content-Type": "application/json"}
+    headers.update(line_bot_api.headers)
+    headers.update(extra_headers or {})
+    response = line_bot_api.http_client.post(
+        line_bot_api.endpoint + path,
+        headers=headers,
+        data=body.encode("utf-8"),
+        timeout=timeout
+    )
+    if not 200 <= response.status_code < 300:
+        raise LineBotApiError(
+            status_code=response.status_code,
+            headers=dict(response.headers.items()),
+            request_id=response.headers.get("X-Line-Request-Id"),
+            accepted_request_id=response.headers.get("X-Line-Accepted-Request-Id"),
+            error=LineError.new_from_json_dict(response.json)
+        )
+
+def reply_message_fast(reply_token, messages, timeout=None):
+    """line_bot_api.reply_message と同じ送信を、PrecompiledMessage はJSON文字列を連結するだけで行う"""
+    body = '{"replyToken":' + json.dumps(reply_token) + ',"messages":' + _messages_json(messages) + ',"notificationDisabled":false}'
+    post_line_api("/v2/bot/message/reply", body, timeout=timeout)
+
+def push_messages(recipients, messages, retry_key):
+    """
+    1人なら push、複数人なら multicast で送る。
+    SDK の push_message / multicast に retry_key を渡すと共有の line_bot_api.headers に書き込まれ、
+    並行して送る他のリクエストにも付いてしまうため、リトライキーはこのリクエストのヘッダにだけ付ける。
+    """
+    if len(recipients) == 1:
+        path, to = "/v2/bot/message/push", json.dumps(recipients[0])
+    else:
+        path, to = "/v2/bot/message/multicast", json.dumps(list(recipients))
+    body = '{"to":' + to + ',"messages":' + _messages_json(messages) + ',"notificationDisabled":false}'
+    post_line_api(path, body, extra_headers={"X-Line-Retry-Key": retry_key})
+
+###################################
+# (F'') 商品カタログ
+#     商品一覧と価格表を1か所 (組み込み / JSONファイル / DBテーブル) から読み込み、
+#     価格索引・一括見積用配列・商品選択カルーセルをまとめて作る。
+#     読み込み元は CATALOG_RELOAD_INTERVAL_SEC ごとに確認し、変わっていればワーカーを再起動せずに差し替える。
+###################################
+CATALOG_SOURCE = os.getenv('CATALOG_SOURCE', 'builtin')           # builtin / file / db
+CATALOG_PATH = os.getenv('CATALOG_PATH', 'catalog.json')
+CATALOG_RELOAD_INTERVAL_SEC = float(os.getenv('CATALOG_RELOAD_INTERVAL_SEC', '30'))
+
+# LINE の制限: カルーセルは最大12バブル、ボタンのラベルは最大20文字
+LINE_CAROUSEL_MAX_BUBBLES = 12
+LINE_ACTION_LABEL_MAX_CHARS = 20
+PRODUCT_BUTTONS_PER_BUBBLE = 7
+
+DISCOUNT_TYPES = ("早割", "通常")
+
+def build_product_selection_carousel(product_names):
+    """商品名のリストから商品選択カルーセルを作る (各バブルのボタン数が均等になるように分割)"""
+    pages = -(-len(product_names) // PRODUCT_BUTTONS_PER_BUBBLE)
+    if pages > LINE_CAROUSEL_MAX_BUBBLES:
+        raise ValueError(
+            f"商品数 {len(product_names)} 件はカルーセルに収まりません "
+            f"(最大 {LINE_CAROUSEL_MAX_BUBBLES * PRODUCT_BUTTONS_PER_BUBBLE} 件)"
+        )
+    per_page = -(-len(product_names) // pages)
+    bubbles = []
+    for page, names in enumerate(_chunks(product_names, per_page), start=1):
+        bubbles.append(BubbleContainer(
+            body=BoxComponent(layout='vertical', contents=[
+                TextComponent(text=f'商品を選択してください({page}/{pages})', weight='bold', size='md')
+            ]),
+            footer=BoxComponent(layout='vertical', contents=[
+                ButtonComponent(
+                    style='primary',
+                    action=PostbackAction(label=name[:LINE_ACTION_LABEL_MAX_CHARS], data=name)
+                )
+                for name in names
+            ])
+        ))
+    return FlexSendMessage(alt_text='商品を選択してください', contents=CarouselContainer(contents=bubbles))
+
+class Catalog:
+    """
+    読み込んだ1世代分のカタログ。生成後は変更しない (差し替えは get_catalog() 側で丸ごと行う)。
+    rows は PRICE_TABLE と同じ形式、product_names はカルーセル・フォームでの表示順。
+    """
+
+    def __init__(self, rows, product_names=None, version=None):
+        self.rows = [tuple(r) for r in rows]
+        if not self.rows:
+            raise ValueError("カタログが空です")
+        self.version = version
+        self.loaded_at = time.time()
+        self.price_index = PriceIndex(self.rows)
+        self.price_arrays = PriceArrays(self.price_index)
+
+        priced = list(dict.fromkeys(r[0] for r in self.rows))
+        self.product_names = list(dict.fromkeys(product_names or priced))
+        groups = {group for group, _ in self.price_index.groups()}
+        problems = [
+            f"{name}/{d_type}"
+            for name in self.product_names
+            for d_type in DISCOUNT_TYPES
+            if (name, d_type) not in groups
+        ]
+        if problems:
+            raise ValueError("価格が未登録の商品があります: " + ", ".join(problems))
+        self.products = frozenset(self.product_names)
+        self.product_carousel = PrecompiledMessage(build_product_selection_carousel(self.product_names))
+
+    def snapshot(self):
+        return {
+            "source": CATALOG_SOURCE,
+            "version": str(self.version),
+            "products": len(self.product_names),
+            "price_rows": len(self.rows),
+            "loaded_at": self.loaded_at
+        }
+
+class BuiltinCatalogSource:
+    """ソースコード内の PRICE_TABLE"""
+
+    def version(self):
+        return "builtin"
+
+    def load(self):
+        return Catalog(PRICE_TABLE, version=self.version())
+
+class FileCatalogSource:
+    """
+    JSONファイル: {"products": [商品名, ...], "prices": [[商品名, 下限, 上限, 割引種別, 単価, 色追加, 位置追加, フルカラー], ...]}
+    products は表示順 (省略時は prices に出てくる順)。
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def version(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        version = self.version()
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        return Catalog(data["prices"], data.get("products"), version)
+
+class PostgresCatalogSource:
+    """
+    PostgreSQL の product_catalog テーブル。表示順は sort_order の昇順。
+    変更の検知は行数と updated_at の最大値で行うので、更新時は updated_at も更新すること。
+    """
+
+    def __init__(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                CREATE TABLE IF NOT EXISTS product_catalog (
+                    product_name TEXT NOT NULL,
+                    min_qty INTEGER NOT NULL,
+                    max_qty INTEGER NOT NULL,
+                    discount_type TEXT NOT NULL,
+                    unit_price INTEGER NOT NULL,
+                    add_color INTEGER NOT NULL,
+                    add_position INTEGER NOT NULL,
+                    add_full_color INTEGER NOT NULL,
+                    sort_order INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (product_name, discount_type, min_qty)
+                )
+                """)
+
+    def version(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*), MAX(updated_at) FROM product_catalog")
+                count, updated_at = cur.fetchone()
+        return (count, updated_at.isoformat() if updated_at else None)
+
+    def load(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*), MAX(updated_at) FROM product_catalog")
+                count, updated_at = cur.fetchone()
+                cur.execute("""
+                SELECT product_name, min_qty, max_qty, discount_type,
+                       unit_price, add_color, add_position, add_full_color
+                  FROM product_catalog
+                 ORDER BY sort_order, product_name, discount_type, min_qty
+                """)
+                rows = cur.fetchall()
+        return Catalog(rows, version=(count, updated_at.isoformat() if updated_at else None))
+
+_catalog = None
+_catalog_source = None
+_catalog_checked_at = 0.0
+_catalog_lock = threading.Lock()
+_catalog_listeners = []
+_catalog_failures = 0  # 読み込み元の確認・読み込みが続けて失敗した回数 (ログは最初の失敗と復旧時だけ出す)
+
+def on_catalog_reload(listener):
+    """
+    カタログ差し替え時に listener(catalog) を呼ぶ (デコレータとしても使える)。
+    登録時に既にカタログを読み込み済みなら、その場で1回呼ぶ。
+    """
+    _catalog_listeners.append(listener)
+    if _catalog is not None:
+        listener(_catalog)
+    return listener
+
+def _create_catalog_source():
+    if CATALOG_SOURCE == 'file':
+        return FileCatalogSource(CATALOG_PATH)
+    if CATALOG_SOURCE == 'db':
+        return PostgresCatalogSource()
+    return BuiltinCatalogSource()
+
+def reload_catalog(force=False):
+    """
+    読み込み元のバージョンが変わっていればカタログを作り直して差し替える。
+    読み込みや検証に失敗した場合は現在のカタログを使い続ける (初回は組み込みの PRICE_TABLE)。
+    失敗が続く間は、最初の失敗だけをエラーとして記録し、復旧した時にその旨を記録する。
+    """
+    global _catalog, _catalog_source, _catalog_failures
+    try:
+        if _catalog_source is None:
+            _catalog_source = _create_catalog_source()
+        unchanged = not force and _catalog is not None and _catalog_source.version() == _catalog.version
+        if not unchanged:
+            catalog = _catalog_source.load()
+    except Exception as e:
+        _catalog_failures += 1
+        if _catalog_failures == 1:
+            logger.error(f"Catalog load failed (source={CATALOG_SOURCE}): {e}")
+        else:
+            logger.debug(f"Catalog load still failing (source={CATALOG_SOURCE}, {_catalog_failures} attempts): {e}")
+        if _catalog is not None:
+            return _catalog
+        catalog = BuiltinCatalogSource().load()
+    else:
+        if _catalog_failures:
+            logger.info(f"Catalog source recovered after {_catalog_failures} failed attempt(s) (source={CATALOG_SOURCE})")
+            _catalog_failures = 0
+        if unchanged:
+            return _catalog
+
+    _catalog = catalog
+    logger.info(f"Catalog loaded: version={catalog.version}, products={len(catalog.product_names)}")
+    for listener in _catalog_listeners:
+        try:
+            listener(catalog)
+        except Exception as e:
+            logger.error(f"Catalog reload listener failed: {e}")
+    return catalog
+
+def get_catalog() -> Catalog:
+    """
+    現在のカタログを返す。前回の確認から CATALOG_RELOAD_INTERVAL_SEC 経過していれば読み込み元を確認する。
+    確認は1スレッドだけが行い、その間の他スレッドは現在のカタログをそのまま使う。
+    """
+    global _catalog_checked_at
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - _catalog_checked_at < CATALOG_RELOAD_INTERVAL_SEC:
+        return catalog
+    if not _catalog_lock.acquire(blocking=catalog is None):
+        return catalog
+    try:
+        if _catalog is None or time.monotonic() - _catalog_checked_at >= CATALOG_RELOAD_INTERVAL_SEC:
+            reload_catalog()
+            _catalog_checked_at = time.monotonic()
+        return _catalog
+    finally:
+        _catalog_lock.release()
+
 ###################################
 # (F) Flex Message: モード選択
 ###################################
+@precompiled_message
 def create_mode_selection_flex():
     bubble = BubbleContainer(
         body=BoxComponent(
@@ -388,6 +1606,7 @@ def create_mode_selection_flex():
 ###################################
 # (G) 簡易見積フロー (既存機能)
 ###################################
+@precompiled_message
 def create_quick_estimate_intro_flex():
     bubble = BubbleContainer(
         body=BoxComponent(
@@ -418,6 +1637,7 @@ def create_quick_estimate_intro_flex():
     )
     return FlexSendMessage(alt_text='簡易見積モードへようこそ', contents=bubble)
 
+@precompiled_message
 def create_early_discount_flex():
     bubble = BubbleContainer(
         body=BoxComponent(layout='vertical', contents=[
@@ -434,36 +1654,10 @@ def create_early_discount_flex():
     return FlexSendMessage(alt_text='早割確認', contents=bubble)
 
 def create_product_selection_carousel():
-    bubble1 = BubbleContainer(
-        body=BoxComponent(layout='vertical', contents=[
-            TextComponent(text='商品を選択してください(1/2)', weight='bold', size='md')
-        ]),
-        footer=BoxComponent(layout='vertical', contents=[
-            ButtonComponent(style='primary', action=PostbackAction(label='ドライTシャツ', data='ドライTシャツ')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ヘビーウェイトTシャツ', data='ヘビーウェイトTシャツ')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ドライポロシャツ', data='ドライポロシャツ')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ドライメッシュビブス', data='ドライメッシュビブス')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ドライベースボールシャツ', data='ドライベースボールシャツ')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ドライロングスリープTシャツ', data='ドライロングスリープTシャツ')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ドライハーフパンツ', data='ドライハーフパンツ'))
-        ])
-    )
-    bubble2 = BubbleContainer(
-        body=BoxComponent(layout='vertical', contents=[
-            TextComponent(text='商品を選択してください(2/2)', weight='bold', size='md')
-        ]),
-        footer=BoxComponent(layout='vertical', contents=[
-            ButtonComponent(style='primary', action=PostbackAction(label='ヘビーウェイトロングスリープTシャツ', data='ヘビーウェイトロングスリープTシャツ')),
-            ButtonComponent(style='primary', action=PostbackAction(label='クルーネックライトトレーナー', data='クルーネックライトトレーナー')),
-            ButtonComponent(style='primary', action=PostbackAction(label='フーデッドライトパーカー', data='フーデッドライトパーカー')),
-            ButtonComponent(style='primary', action=PostbackAction(label='スタンダードトレーナー', data='スタンダードトレーナー')),
-            ButtonComponent(style='primary', action=PostbackAction(label='スタンダードWフードパーカー', data='スタンダードWフードパーカー')),
-            ButtonComponent(style='primary', action=PostbackAction(label='ジップアップライトパーカー', data='ジップアップライトパーカー'))
-        ])
-    )
-    carousel = CarouselContainer(contents=[bubble1, bubble2])
-    return FlexSendMessage(alt_text='商品を選択してください', contents=carousel)
+    """商品選択カルーセル (現在のカタログから事前構築済みのもの)"""
+    return get_catalog().product_carousel
 
+@precompiled_message
 def create_print_position_flex():
     bubble = BubbleContainer(
         body=BoxComponent(layout='vertical', contents=[
@@ -477,6 +1671,7 @@ def create_print_position_flex():
     )
     return FlexSendMessage(alt_text='プリント位置選択', contents=bubble)
 
+@precompiled_message
 def create_color_options_flex():
     bubble = BubbleContainer(
         body=BoxComponent(layout='vertical', contents=[
@@ -498,9 +1693,173 @@ def create_color_options_flex():
 def health_check():
     return "OK", 200
 
+class LatencyHistogram:
+    """処理時間(秒)の累積ヒストグラム"""
+
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.total += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+        n = sum(counts)
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(list(self.BUCKETS) + ["+Inf"], counts):
+            cumulative += count
+            buckets[f"le_{bound}"] = cumulative
+        return {"count": n, "sum_sec": total, "avg_sec": total / n if n else 0.0, "buckets": buckets}
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """プロセス内の各種統計(JSON)"""
+    data = {"pid": os.getpid()}
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        data["db_pool"] = _db_pool.snapshot()
+    if _webhook_queue is not None and _webhook_queue_pid == os.getpid():
+        data["webhook_queue"] = _webhook_queue.snapshot()
+    if _line_outbox is not None and _line_outbox_pid == os.getpid():
+        data["line_outbox"] = _line_outbox.snapshot()
+    if _paper_pipeline is not None and _paper_pipeline_pid == os.getpid():
+        data["paper_order_pipeline"] = _paper_pipeline.snapshot()
+    with openai_stats_lock:
+        data["openai"] = dict(openai_stats)
+    data["openai"]["latency"] = openai_histogram.snapshot()
+    with ocr_image_stats_lock:
+        data["ocr_image"] = dict(ocr_image_stats)
+    data["ocr_image"]["latency"] = ocr_image_histogram.snapshot()
+    with image_quality_stats_lock:
+        data["image_quality"] = dict(image_quality_stats)
+    data["ocr_cache"] = ocr_cache.snapshot()
+    data["extract_cache"] = extract_cache.snapshot()
+    data["catalog"] = get_catalog().snapshot()
+    return app.response_class(json.dumps(data, ensure_ascii=False), mimetype="application/json")
+
 ###################################
 # (I) Flaskルート: LINE Callback
 ###################################
+import contextvars
+import queue
+import zlib
+
+# WEBHOOK_ASYNC=1 の場合、/callback は署名検証とキュー投入だけ行って即 200 を返す
+WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', '0') == '1'
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# 受信した /callback のホスト名。ハンドラはリクエストの外 (ワーカースレッド) でも current_event_host() で参照する
+_event_host = contextvars.ContextVar("line_event_host")
+
+def current_event_host() -> str:
+    return _event_host.get()
+
+# イベント種別 (と MessageEvent のメッセージ種別) -> ハンドラ。WebhookHandler と同じキーで持つ
+_line_event_handlers = {}
+
+def line_event_handler(event, message=None):
+    """
+    handler.add と同じくハンドラを登録するデコレータ。
+    非同期モードでイベントを1件ずつ渡せるよう、同じハンドラを _line_event_handlers にも記録する。
+    """
+    def decorator(func):
+        key = event.__name__ if message is None else f"{event.__name__}_{message.__name__}"
+        _line_event_handlers[key] = func
+        return handler.add(event, message=message)(func)
+    return decorator
+
+def dispatch_line_event(event, host):
+    """WebhookHandler.handle() と同じ規則で、1件のイベントを line_event_handler で登録したハンドラに渡す"""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = _line_event_handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = _line_event_handlers.get(event.__class__.__name__)
+    if func is None:
+        logger.info(f"No handler for {event.__class__.__name__}")
+        return
+    token = _event_host.set(host)
+    try:
+        func(event)
+    finally:
+        _event_host.reset(token)
+
+class WebhookEventQueue:
+    """
+    Webhookイベントをワーカースレッドで処理するキュー。
+    user_id のハッシュでワーカーを固定し、同一ユーザーのイベント順序を保つ。
+    各ワーカーのキューは有界で、溢れたイベントは破棄してカウントする。
+    """
+
+    def __init__(self, workers, queue_size):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._lock = threading.Lock()
+        self.stats = {"enqueued": 0, "processed": 0, "dropped": 0, "errors": 0}
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._worker, args=(q,), name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+
+    def _shard(self, event) -> queue.Queue:
+        user_id = getattr(event.source, "user_id", None) or ""
+        return self._queues[zlib.crc32(user_id.encode("utf-8")) % len(self._queues)]
+
+    def submit(self, event, host) -> bool:
+        try:
+            self._shard(event).put_nowait((event, host))
+        except queue.Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+            logger.error(f"Webhook queue full; dropped {event.__class__.__name__}")
+            return False
+        with self._lock:
+            self.stats["enqueued"] += 1
+        return True
+
+    def _worker(self, q):
+        while True:
+            event, host = q.get()
+            try:
+                dispatch_line_event(event, host)
+                with self._lock:
+                    self.stats["processed"] += 1
+            except Exception as e:
+                with self._lock:
+                    self.stats["errors"] += 1
+                logger.error(f"Webhook worker error: {e}")
+                traceback.print_exc()
+            finally:
+                q.task_done()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+        data["queue_depth"] = sum(q.qsize() for q in self._queues)
+        return data
+
+_webhook_queue = None
+_webhook_queue_pid = None
+_webhook_queue_lock = threading.Lock()
+
+def get_webhook_queue() -> WebhookEventQueue:
+    """プロセスごと(fork後)にワーカースレッドを起動する"""
+    global _webhook_queue, _webhook_queue_pid
+    pid = os.getpid()
+    if _webhook_queue is None or _webhook_queue_pid != pid:
+        with _webhook_queue_lock:
+            if _webhook_queue is None or _webhook_queue_pid != pid:
+                _webhook_queue = WebhookEventQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+                _webhook_queue_pid = pid
+    return _webhook_queue
+
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
@@ -508,6 +1867,19 @@ def callback():
         abort(400)
 
     body = request.get_data(as_text=True)
+
+    if WEBHOOK_ASYNC:
+        try:
+            events = handler.parser.parse(body, signature)
+        except InvalidSignatureError as e:
+            logger.error(f"InvalidSignatureError: {e}")
+            abort(400)
+        event_queue = get_webhook_queue()
+        for event in events:
+            event_queue.submit(event, request.host)
+        return "OK", 200
+
+    token = _event_host.set(request.host)
     try:
         handler.handle(body, signature)
     except InvalidSignatureError as e:
@@ -517,13 +1889,15 @@ def callback():
         logger.error(f"Unexpected error: {e}")
         traceback.print_exc()
         abort(500)
+    finally:
+        _event_host.reset(token)
 
     return "OK", 200
 
 ###################################
 # (J) LINEハンドラ: TextMessage
 ###################################
-@handler.add(MessageEvent, message=TextMessage)
+@line_event_handler(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     user_id = event.source.user_id
     user_input = event.message.text.strip()
@@ -531,24 +1905,34 @@ def handle_text_message(event):
 
     if user_input == "モード選択":
         flex = create_mode_selection_flex()
-        line_bot_api.reply_message(event.reply_token, flex)
+        reply_message_fast(event.reply_token, flex)
         return
 
+    state_store = get_state_store()
+    user_state = state_store.get(user_id)
+
     # ▼▼ 追加: 「注文用紙から注文」で写真待ちの状態でテキストを受け取った場合のガード ▼▼
-    if user_id in user_states and user_states[user_id].get("state") == "await_order_form_photo":
+    if user_state is not None and user_state.get("state") == "await_order_form_photo":
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="注文用紙の写真を送ってください。テキストはまだ受け付けていません。")
         )
         return
+    if user_state is not None and user_state.get("state") == "analysing_order_form_photo":
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="注文用紙の写真を読み取り中です。完了までしばらくお待ちください。")
+        )
+        return
     # ▲▲ 追加 ▲▲
 
-    if user_id in user_states:
-        st = user_states[user_id].get("state")
+    if user_state is not None:
+        st = user_state.get("state")
         # 以下、既存のステートマシン処理
         if st == "await_school_name":
-            user_states[user_id]["school_name"] = user_input
-            user_states[user_id]["state"] = "await_prefecture"
+            user_state["school_name"] = user_input
+            user_state["state"] = "await_prefecture"
+            state_store.set(user_id, user_state)
             line_bot_api.reply_message(
                 event.reply_token,
                 TextSendMessage(text="学校名を保存しました。\n次にお届け先(都道府県)を入力してください。")
@@ -556,24 +1940,27 @@ def handle_text_message(event):
             return
 
         if st == "await_prefecture":
-            user_states[user_id]["prefecture"] = user_input
-            user_states[user_id]["state"] = "await_early_discount"
+            user_state["prefecture"] = user_input
+            user_state["state"] = "await_early_discount"
+            state_store.set(user_id, user_state)
             discount_flex = create_early_discount_flex()
-            line_bot_api.reply_message(event.reply_token, discount_flex)
+            reply_message_fast(event.reply_token, discount_flex)
             return
 
         if st == "await_budget":
-            user_states[user_id]["budget"] = user_input
-            user_states[user_id]["state"] = "await_product"
+            user_state["budget"] = user_input
+            user_state["state"] = "await_product"
+            state_store.set(user_id, user_state)
             product_flex = create_product_selection_carousel()
-            line_bot_api.reply_message(event.reply_token, product_flex)
+            reply_message_fast(event.reply_token, product_flex)
             return
 
         if st == "await_quantity":
-            user_states[user_id]["quantity"] = user_input
-            user_states[user_id]["state"] = "await_print_position"
+            user_state["quantity"] = user_input
+            user_state["state"] = "await_print_position"
+            state_store.set(user_id, user_state)
             pos_flex = create_print_position_flex()
-            line_bot_api.reply_message(event.reply_token, pos_flex)
+            reply_message_fast(event.reply_token, pos_flex)
             return
 
         # 想定外
@@ -593,72 +1980,48 @@ def handle_text_message(event):
 # (J') LINEハンドラ: ImageMessage
 #     (注文用紙からの注文で写真をアップロードさせる機能)
 ###################################
-@handler.add(MessageEvent, message=ImageMessage)
+@line_event_handler(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
     user_id = event.source.user_id
 
     # 状態が "await_order_form_photo" 以外の場合はスルー
-    if user_id not in user_states or user_states[user_id].get("state") != "await_order_form_photo":
+    state_store = get_state_store()
+    user_state = state_store.get(user_id)
+    if user_state is None or user_state.get("state") != "await_order_form_photo":
         return
 
-    # 画像取得
-    message_id = event.message.id
-    message_content = line_bot_api.get_message_content(message_id)
-    
-    # 一時的にローカル保存する
-    temp_filename = f"temp_{user_id}_{message_id}.jpg"
-    with open(temp_filename, "wb") as fd:
-        for chunk in message_content.iter_content():
-            fd.write(chunk)
-
-    # ローカルに保存した画像を使って Google Vision API OCR 処理
-    ocr_text = google_vision_ocr(temp_filename)
-    logger.info(f"[DEBUG] OCR result: {ocr_text}")
-
-    # OpenAI API を呼び出して、webフォーム各項目に対応しそうな値を推定
-    form_estimated_data = openai_extract_form_data(ocr_text)
-    logger.info(f"[DEBUG] form_estimated_data from OpenAI: {form_estimated_data}")
-
-    # 推定結果をユーザーごとの状態に保持しておき、フォーム表示の際に使う
-    user_states[user_id]["paper_form_data"] = form_estimated_data
-    # ステート終了
-    del user_states[user_id]["state"]
-
-    # ユーザーにフォームURLを案内し、修正・送信を促す
-    paper_form_url = f"https://{request.host}/paper_order_form?user_id={user_id}"
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(
-            text=(
-                "注文用紙の写真から情報を読み取りました。\n"
-                "こちらのフォームに自動入力しましたので、内容をご確認・修正の上送信してください。\n"
-                f"{paper_form_url}"
-            )
-        )
-    )
+    # 解析中は同じユーザーの追加の写真を受け付けない
+    # (どの写真を解析中かも記録し、解析結果はこの状態のままのときだけ書き込む)
+    state_store.set(user_id, PaperOrderPipeline.analysing_state(event.message.id))
 
-    # ローカルファイル削除(任意)
+    # 解析(ダウンロード → OCR → OpenAI)はバックグラウンドで行い、まずは受付だけ返信する
+    # (返信に失敗しても解析は進むよう、先に投入しておく。結果は push で届く)
+    get_paper_order_pipeline().submit(user_id, event.message.id, current_event_host())
     try:
-        os.remove(temp_filename)
-    except Exception:
-        pass
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="注文用紙の写真を受け付けました。\n読み取りが終わり次第、フォームのURLをお送りします。")
+        )
+    except LineBotApiError as e:
+        logger.warning(f"Order form photo acknowledgement failed for user_id={user_id}: {e}")
 
 ###################################
 # (K) LINEハンドラ: PostbackEvent
 ###################################
-@handler.add(PostbackEvent)
+@line_event_handler(PostbackEvent)
 def handle_postback(event):
     user_id = event.source.user_id
     data = event.postback.data
     logger.info(f"[DEBUG] Postback data: {data}")
+    state_store = get_state_store()
 
     if data == "quick_estimate":
         intro = create_quick_estimate_intro_flex()
-        line_bot_api.reply_message(event.reply_token, intro)
+        reply_message_fast(event.reply_token, intro)
         return
 
     if data == "start_quick_estimate_input":
-        user_states[user_id] = {
+        state_store.set(user_id, {
             "state": "await_school_name",
             "school_name": None,
             "prefecture": None,
@@ -668,7 +2031,7 @@ def handle_postback(event):
             "quantity": None,
             "print_position": None,
             "color_options": None
-        }
+        })
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="まずは学校または団体名を入力してください。")
@@ -676,42 +2039,48 @@ def handle_postback(event):
         return
 
     if data == "web_order":
-        form_url = f"https://{request.host}/webform?user_id={user_id}"
+        form_url = f"https://{current_event_host()}/webform?user_id={user_id}"
         msg = (f"WEBフォームから注文ですね！\nこちらから入力してください。\n{form_url}")
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
         return
 
     if data == "paper_order":
-        user_states[user_id] = {
+        state_store.set(user_id, {
             "state": "await_order_form_photo"
-        }
+        })
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="注文用紙の写真を送ってください。\n(スマホで撮影したものでもOKです)")
         )
         return
 
-    if user_id not in user_states:
+    user_state = state_store.get(user_id)
+    if user_state is None:
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="簡易見積モードではありません。"))
         return
 
-    st = user_states[user_id]["state"]
+    st = user_state.get("state")
 
     if st == "await_early_discount":
         if data == "14days_plus":
-            user_states[user_id]["early_discount"] = "14日前以上"
+            user_state["early_discount"] = "14日前以上"
         elif data == "14days_minus":
-            user_states[user_id]["early_discount"] = "14日前以内"
+            user_state["early_discount"] = "14日前以内"
         else:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="早割選択が不明です。"))
             return
-        user_states[user_id]["state"] = "await_budget"
+        user_state["state"] = "await_budget"
+        state_store.set(user_id, user_state)
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="早割を保存しました。\n1枚あたりの予算を入力してください。"))
         return
 
     if st == "await_product":
-        user_states[user_id]["product"] = data
-        user_states[user_id]["state"] = "await_quantity"
+        if data not in get_catalog().products:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="商品の選択が不明です。"))
+            return
+        user_state["product"] = data
+        user_state["state"] = "await_quantity"
+        state_store.set(user_id, user_state)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text=f"{data} を選択しました。\n枚数を入力してください。")
@@ -720,17 +2089,18 @@ def handle_postback(event):
 
     if st == "await_print_position":
         if data == "front":
-            user_states[user_id]["print_position"] = "前"
+            user_state["print_position"] = "前"
         elif data == "back":
-            user_states[user_id]["print_position"] = "背中"
+            user_state["print_position"] = "背中"
         elif data == "front_back":
-            user_states[user_id]["print_position"] = "前と背中"
+            user_state["print_position"] = "前と背中"
         else:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="プリント位置の指定が不明です。"))
             return
-        user_states[user_id]["state"] = "await_color_options"
+        user_state["state"] = "await_color_options"
+        state_store.set(user_id, user_state)
         color_flex = create_color_options_flex()
-        line_bot_api.reply_message(event.reply_token, color_flex)
+        reply_message_fast(event.reply_token, color_flex)
         return
 
     if st == "await_color_options":
@@ -738,10 +2108,10 @@ def handle_postback(event):
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="色数の選択が不明です。"))
             return
 
-        user_states[user_id]["color_options"] = data
+        user_state["color_options"] = data
 
         # ▼▼ ここで簡易見積結果をまとめ、DBにINSERT + 見積番号発行 ▼▼
-        s = user_states[user_id]
+        s = user_state
         summary = (
             f"学校/団体名: {s['school_name']}\n"
             f"都道府県: {s['prefecture']}\n"
@@ -787,7 +2157,7 @@ def handle_postback(event):
         )
 
         # これ以上ステートを追わないので削除
-        del user_states[user_id]
+        state_store.delete(user_id)
 
         # ▼▼ ユーザーに送るメッセージ(一括)＋モード選択画面 ▼▼
         reply_text = (
@@ -800,7 +2170,7 @@ def handle_postback(event):
             "もしくは注文用紙から注文を選択してください。"
         )
         # ここで「結果メッセージ + モード選択」をまとめて返信
-        line_bot_api.reply_message(
+        reply_message_fast(
             event.reply_token,
             [
                 TextSendMessage(text=reply_text),
@@ -871,6 +2241,37 @@ def insert_estimate(
 ###################################
 # (L) WEBフォーム (修正)
 ###################################
+import hashlib
+
+# フォームは毎回再検証させ (no-cache)、変わっていなければ 304 を返す
+FORM_CACHE_CONTROL = os.getenv('FORM_CACHE_CONTROL', 'private, no-cache')
+
+class FormPage:
+    """
+    インラインのHTMLテンプレートを起動時に1度だけコンパイルしておき、GETごとには描画だけ行う。
+    ETag はテンプレート本体と描画に使う値 (user_id・商品一覧・事前入力データ) から計算するので、
+    内容が変わっていない再訪問は描画せずに 304 を返す。
+    """
+
+    def __init__(self, source):
+        self.template = app.jinja_env.from_string(source)
+        self.digest = hashlib.sha256(source.encode("utf-8")).digest()
+
+    def etag(self, context):
+        h = hashlib.sha256(self.digest)
+        h.update(json.dumps(context, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+        return h.hexdigest()
+
+    def respond(self, **context):
+        etag = self.etag(context)
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(self.template.render(**context), mimetype="text/html")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = FORM_CACHE_CONTROL
+        return response
+
 FORM_HTML = """
 <!DOCTYPE html>
 <html>
@@ -1000,19 +2401,9 @@ FORM_HTML = """
 
     <label>商品名:</label>
     <select name="product_name">
-      <option value="ドライTシャツ">ドライTシャツ</option>
-      <option value="ヘビーウェイトTシャツ">ヘビーウェイトTシャツ</option>
-      <option value="ドライポロシャツ">ドライポロシャツ</option>
-      <option value="ドライメッシュビブス">ドライメッシュビブス</option>
-      <option value="ドライベースボールシャツ">ドライベースボールシャツ</option>
-      <option value="ドライロングスリープTシャツ">ドライロングスリープTシャツ</option>
-      <option value="ドライハーフパンツ">ドライハーフパンツ</option>
-      <option value="ヘビーウェイトロングスリープTシャツ">ヘビーウェイトロングスリープTシャツ</option>
-      <option value="クルーネックライトトレーナー">クルーネックライトトレーナー</option>
-      <option value="フーデッドライトパーカー">フーデッドライトパーカー</option>
-      <option value="スタンダードトレーナー">スタンダードトレーナー</option>
-      <option value="スタンダードWフードパーカー">スタンダードWフードパーカー</option>
-      <option value="ジップアップライトパーカー">ジップアップライトパーカー</option>
+      {% for p in products %}
+      <option value="{{ p }}">{{ p }}</option>
+      {% endfor %}
     </select>
 
     <label>商品カラー:</label>
@@ -1123,10 +2514,12 @@ FORM_HTML = """
 </html>
 """
 
+WEBFORM_PAGE = FormPage(FORM_HTML)
+
 @app.route("/webform", methods=["GET"])
 def show_webform():
     user_id = request.args.get("user_id", "")
-    return render_template_string(FORM_HTML, user_id=user_id)
+    return WEBFORM_PAGE.respond(user_id=user_id, products=get_catalog().product_names)
 
 ###################################
 # (M) 空文字を None にする関数
@@ -1145,218 +2538,194 @@ def none_if_empty_date(val: str):
 
 def none_if_empty_int(val: str):
     """数値カラム用: 空なら None, それ以外はintに変換"""
-    if not val:
+    if val is None or val == "":
         return None
     return int(val)
 
 ###################################
-# (N) /webform_submit: フォーム送信
+# (M') 注文項目の定義と orders への保存
+#     webform_submit / paper_order_form_submit (と一括取込) はこの定義だけを使う
 ###################################
-@app.route("/webform_submit", methods=["POST"])
-def webform_submit():
-    form = request.form
-    files = request.files
-    user_id = form.get("user_id", "")
-
-    # ---------- テキスト項目を取得 (空文字はNone化) ----------
-    application_date = none_if_empty_date(form.get("application_date"))
-    delivery_date = none_if_empty_date(form.get("delivery_date"))
-    use_date = none_if_empty_date(form.get("use_date"))
-
-    discount_option = none_if_empty_str(form.get("discount_option"))
-    school_name = none_if_empty_str(form.get("school_name"))
-    line_account = none_if_empty_str(form.get("line_account"))
-    group_name = none_if_empty_str(form.get("group_name"))
-    school_address = none_if_empty_str(form.get("school_address"))
-    school_tel = none_if_empty_str(form.get("school_tel"))
-    teacher_name = none_if_empty_str(form.get("teacher_name"))
-    teacher_tel = none_if_empty_str(form.get("teacher_tel"))
-    teacher_email = none_if_empty_str(form.get("teacher_email"))
-    representative = none_if_empty_str(form.get("representative"))
-    rep_tel = none_if_empty_str(form.get("rep_tel"))
-    rep_email = none_if_empty_str(form.get("rep_email"))
-
-    design_confirm = none_if_empty_str(form.get("design_confirm"))
-    payment_method = none_if_empty_str(form.get("payment_method"))
-    product_name = none_if_empty_str(form.get("product_name"))
-    product_color = none_if_empty_str(form.get("product_color"))
-
-    size_ss = none_if_empty_int(form.get("size_ss"))
-    size_s = none_if_empty_int(form.get("size_s"))
-    size_m = none_if_empty_int(form.get("size_m"))
-    size_l = none_if_empty_int(form.get("size_l"))
-    size_ll = none_if_empty_int(form.get("size_ll"))
-    size_lll = none_if_empty_int(form.get("size_lll"))
-
-    # ▼▼ 新規追加項目(前) ▼▼
-    print_size_front = none_if_empty_str(form.get("print_size_front"))
-    print_size_front_custom = none_if_empty_str(form.get("print_size_front_custom"))
-    print_color_front = none_if_empty_str(form.get("print_color_front"))
-    font_no_front = none_if_empty_str(form.get("font_no_front"))
-    design_sample_front = none_if_empty_str(form.get("design_sample_front"))
-
-    # ▼▼ 新規追加項目(後) ▼▼
-    print_size_back = none_if_empty_str(form.get("print_size_back"))
-    print_size_back_custom = none_if_empty_str(form.get("print_size_back_custom"))
-    print_color_back = none_if_empty_str(form.get("print_color_back"))
-    font_no_back = none_if_empty_str(form.get("font_no_back"))
-    design_sample_back = none_if_empty_str(form.get("design_sample_back"))
-
-    # ▼▼ 新規追加項目(その他) ▼▼
-    print_size_other = none_if_empty_str(form.get("print_size_other"))
-    print_size_other_custom = none_if_empty_str(form.get("print_size_other_custom"))
-    print_color_other = none_if_empty_str(form.get("print_color_other"))
-    font_no_other = none_if_empty_str(form.get("font_no_other"))
-    design_sample_other = none_if_empty_str(form.get("design_sample_other"))
-
-    # ---------- 画像ファイル(位置データ) ----------
-    pos_data_front = files.get("position_data_front")
-    pos_data_back = files.get("position_data_back")
-    pos_data_other = files.get("position_data_other")
-
-    front_url = upload_file_to_s3(pos_data_front, S3_BUCKET_NAME, prefix="uploads/")
-    back_url = upload_file_to_s3(pos_data_back, S3_BUCKET_NAME, prefix="uploads/")
-    other_url = upload_file_to_s3(pos_data_other, S3_BUCKET_NAME, prefix="uploads/")
-
-    # ---------- 追加のデザインイメージデータ ----------
-    additional_design_position = none_if_empty_str(form.get("additional_design_position"))
-    additional_design_image = files.get("additional_design_image")
-    additional_design_image_url = upload_file_to_s3(additional_design_image, S3_BUCKET_NAME, prefix="uploads/")
+import datetime
+from psycopg2.extras import execute_values
 
-    # DBに保存 (orders)
+ORDER_BULK_PAGE_SIZE = int(os.getenv('ORDER_BULK_PAGE_SIZE', '200'))
+
+class OrderField:
+    """
+    orders テーブルの1カラム。
+    upload を指定したカラムはフォームの同名ファイルを S3 にアップロードし、そのURLを保存する。
+    """
+    __slots__ = ("column", "parse", "validate", "upload")
+
+    def __init__(self, column, parse=none_if_empty_str, validate=None, upload=None):
+        self.column = column
+        self.parse = parse
+        self.validate = validate
+        self.upload = upload
+
+def _validate_order_date(value):
+    datetime.date.fromisoformat(value)
+
+def _validate_order_quantity(value):
+    if value < 0:
+        raise ValueError("負の枚数")
+
+def _date_field(column):
+    return OrderField(column, none_if_empty_date, _validate_order_date)
+
+def _int_field(column):
+    return OrderField(column, none_if_empty_int, _validate_order_quantity)
+
+# INSERT 時のカラム順 (created_at は NOW())
+ORDER_FIELDS = [
+    OrderField("user_id", lambda val: val or ""),
+    _date_field("application_date"),
+    _date_field("delivery_date"),
+    _date_field("use_date"),
+    OrderField("discount_option"),
+    OrderField("school_name"),
+    OrderField("line_account"),
+    OrderField("group_name"),
+    OrderField("school_address"),
+    OrderField("school_tel"),
+    OrderField("teacher_name"),
+    OrderField("teacher_tel"),
+    OrderField("teacher_email"),
+    OrderField("representative"),
+    OrderField("rep_tel"),
+    OrderField("rep_email"),
+    OrderField("design_confirm"),
+    OrderField("payment_method"),
+    OrderField("product_name"),
+    OrderField("product_color"),
+    _int_field("size_ss"),
+    _int_field("size_s"),
+    _int_field("size_m"),
+    _int_field("size_l"),
+    _int_field("size_ll"),
+    _int_field("size_lll"),
+
+    OrderField("print_size_front"),
+    OrderField("print_size_front_custom"),
+    OrderField("print_color_front"),
+    OrderField("font_no_front"),
+    OrderField("design_sample_front"),
+    OrderField("position_data_front_url", upload="position_data_front"),
+
+    OrderField("print_size_back"),
+    OrderField("print_size_back_custom"),
+    OrderField("print_color_back"),
+    OrderField("font_no_back"),
+    OrderField("design_sample_back"),
+    OrderField("position_data_back_url", upload="position_data_back"),
+
+    OrderField("print_size_other"),
+    OrderField("print_size_other_custom"),
+    OrderField("print_color_other"),
+    OrderField("font_no_other"),
+    OrderField("design_sample_other"),
+    OrderField("position_data_other_url", upload="position_data_other"),
+
+    OrderField("additional_design_position"),
+    OrderField("additional_design_image_url", upload="additional_design_image"),
+]
+ORDER_COLUMNS = [f.column for f in ORDER_FIELDS]
+ORDER_UPLOAD_FIELDS = [f for f in ORDER_FIELDS if f.upload]
+
+# SQL は起動時に1度だけ組み立てる
+ORDER_INSERT_SQL = (
+    f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}, created_at) "
+    f"VALUES ({', '.join(['%s'] * len(ORDER_COLUMNS))}, NOW()) RETURNING id"
+)
+ORDER_BULK_INSERT_SQL = f"INSERT INTO orders ({', '.join(ORDER_COLUMNS)}, created_at) VALUES %s RETURNING id"
+ORDER_BULK_TEMPLATE = f"({', '.join(['%s'] * len(ORDER_COLUMNS))}, NOW())"
+
+def parse_order(data):
+    """
+    フォーム (request.form) や抽出結果の dict から、orders の1行分を dict で返す。
+    戻り値: (order, errors)。errors が空でなければ保存しないこと。
+    アップロード対象のカラムは None のまま (upload_order_files で埋める)。
+    """
+    order = {}
+    errors = []
+    for field in ORDER_FIELDS:
+        if field.upload:
+            order[field.column] = data.get(field.column)
+            continue
+        raw = data.get(field.column)
+        try:
+            value = field.parse(raw)
+            if value is not None and field.validate:
+                field.validate(value)
+        except (TypeError, ValueError):
+            errors.append(f"{field.column}: {raw!r}")
+            value = None
+        order[field.column] = value
+    return order, errors
+
+def upload_order_files(order, files, s3_bucket, prefix="uploads/"):
+    """アップロード対象のファイルを並行して S3 に上げ、order にURLを設定する"""
+    urls = upload_files_to_s3([files.get(f.upload) for f in ORDER_UPLOAD_FIELDS], s3_bucket, prefix=prefix)
+    for field, url in zip(ORDER_UPLOAD_FIELDS, urls):
+        order[field.column] = url
+    return order
+
+def _order_params(order):
+    return tuple(order.get(column) for column in ORDER_COLUMNS)
+
+def insert_order(order) -> int:
+    """orders に1件保存して id を返す (サイズ別集計も同じトランザクションで加算)"""
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            sql = """
-            INSERT INTO orders (
-                user_id,
-                application_date,
-                delivery_date,
-                use_date,
-                discount_option,
-                school_name,
-                line_account,
-                group_name,
-                school_address,
-                school_tel,
-                teacher_name,
-                teacher_tel,
-                teacher_email,
-                representative,
-                rep_tel,
-                rep_email,
-                design_confirm,
-                payment_method,
-                product_name,
-                product_color,
-                size_ss,
-                size_s,
-                size_m,
-                size_l,
-                size_ll,
-                size_lll,
-
-                print_size_front,
-                print_size_front_custom,
-                print_color_front,
-                font_no_front,
-                design_sample_front,
-                position_data_front_url,
-
-                print_size_back,
-                print_size_back_custom,
-                print_color_back,
-                font_no_back,
-                design_sample_back,
-                position_data_back_url,
-
-                print_size_other,
-                print_size_other_custom,
-                print_color_other,
-                font_no_other,
-                design_sample_other,
-                position_data_other_url,
-
-                additional_design_position,
-                additional_design_image_url,
-
-                created_at
-            ) VALUES (
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s,
+            cur.execute(ORDER_INSERT_SQL, _order_params(order))
+            new_id = cur.fetchone()[0]
+            add_order_sizes(cur, [order])
+    return new_id
 
-                %s, %s, %s, %s, %s, %s,
+def insert_orders(orders, page_size=None):
+    """
+    orders に複数件をまとめて保存し、id のリストを入力と同じ順で返す (1トランザクション)。
+    execute_values で page_size 件ずつ1つの INSERT 文にする。サイズ別集計もまとめて加算する。
+    orders はジェネレータでもよい (行の組み立てと集計で2回読むため、先にリストにする)。
+    """
+    orders = list(orders)
+    rows = [_order_params(order) for order in orders]
+    if not rows:
+        return []
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            result = execute_values(
+                cur,
+                ORDER_BULK_INSERT_SQL,
+                rows,
+                template=ORDER_BULK_TEMPLATE,
+                page_size=page_size or ORDER_BULK_PAGE_SIZE,
+                fetch=True
+            )
+            add_order_sizes(cur, orders)
+    return [row[0] for row in result]
 
-                %s, %s, %s, %s, %s, %s,
+def _reject_invalid_order(errors):
+    logger.warning(f"Invalid order form: {errors}")
+    return "入力内容に誤りがあります: " + ", ".join(errors), 400
 
-                %s, %s, %s, %s, %s, %s,
+###################################
+# (N) /webform_submit: フォーム送信
+###################################
+@app.route("/webform_submit", methods=["POST"])
+def webform_submit():
+    order, errors = parse_order(request.form)
+    if errors:
+        return _reject_invalid_order(errors)
+    user_id = order["user_id"]
 
-                %s,
-                %s,
+    # 画像ファイル(位置データ・追加のデザインイメージ)を並行してアップロード
+    upload_order_files(order, request.files, S3_BUCKET_NAME, prefix="uploads/")
 
-                NOW()
-            )
-            RETURNING id
-            """
-            params = (
-                user_id,
-                application_date,
-                delivery_date,
-                use_date,
-                discount_option,
-                school_name,
-                line_account,
-                group_name,
-                school_address,
-                school_tel,
-                teacher_name,
-                teacher_tel,
-                teacher_email,
-                representative,
-                rep_tel,
-                rep_email,
-                design_confirm,
-                payment_method,
-                product_name,
-                product_color,
-                size_ss,
-                size_s,
-                size_m,
-                size_l,
-                size_ll,
-                size_lll,
-
-                print_size_front,
-                print_size_front_custom,
-                print_color_front,
-                font_no_front,
-                design_sample_front,
-                front_url,
-
-                print_size_back,
-                print_size_back_custom,
-                print_color_back,
-                font_no_back,
-                design_sample_back,
-                back_url,
-
-                print_size_other,
-                print_size_other_custom,
-                print_color_other,
-                font_no_other,
-                design_sample_other,
-                other_url,
-
-                additional_design_position,
-                additional_design_image_url
-            )
-            cur.execute(sql, params)
-            new_id = cur.fetchone()[0]
-        conn.commit()
-        logger.info(f"Inserted order id={new_id}")
+    # DBに保存 (orders)
+    new_id = insert_order(order)
+    logger.info(f"Inserted order id={new_id}")
 
     # 見積→注文へのコンバージョンを示すため、estimatesテーブル側の order_placed = true に更新しておく例
     mark_estimate_as_ordered(user_id)
@@ -1364,114 +2733,1590 @@ def webform_submit():
     # フォーム送信完了 → Push通知
     push_text = (
         "WEBフォームの注文を受け付けました！\n"
-        f"学校名: {school_name}\n"
-        f"商品名: {product_name}\n"
+        f"学校名: {order['school_name']}\n"
+        f"商品名: {order['product_name']}\n"
         "後ほど担当者からご連絡いたします。"
     )
-    try:
-        line_bot_api.push_message(to=user_id, messages=TextSendMessage(text=push_text))
-    except Exception as e:
-        logger.error(f"Push message failed: {e}")
+    push_message_async(user_id, TextSendMessage(text=push_text))
 
     return "フォーム送信完了。LINEに通知を送りました。"
 
 ###################################
 # (O) 例: CSV出力関数 (任意, 既存)
+#     COPY ... TO STDOUT で PostgreSQL にCSVを作らせ、チャンクごとに書き出す (全件をメモリに載せない)
 ###################################
-import csv
+import hmac
 
-def export_orders_to_csv():
+EXPORT_API_TOKEN = os.getenv('EXPORT_API_TOKEN')                    # 未設定ならデータ出力・集計系のAPIは無効
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', str(64 * 1024)))
+EXPORT_QUEUE_CHUNKS = int(os.getenv('EXPORT_QUEUE_CHUNKS', '16'))    # 送信待ちのチャンク数の上限
+
+def build_orders_export_sql(cur, date_from=None, date_to=None, since_id=None) -> str:
+    """
+    orders を id 順にCSVで出力する COPY 文を返す。
+    date_from / date_to: created_at の日付範囲 (どちらも含む), since_id: この id より後だけ (差分取得用)
+    """
+    conditions, params = [], []
+    if date_from is not None:
+        conditions.append("created_at >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("created_at < %s")
+        params.append(date_to + datetime.timedelta(days=1))
+    if since_id is not None:
+        conditions.append("id > %s")
+        params.append(since_id)
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    # COPY はパラメータを受け付けないので、値は mogrify で埋め込む
+    query = cur.mogrify(f"SELECT * FROM orders{where} ORDER BY id", params).decode("utf-8")
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+def export_orders_to_csv(file_path="orders_export.csv", **filters):
     """DBの orders テーブルをCSV形式で出力する例(ローカルファイル書き込み想定)"""
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM orders ORDER BY id")
-            rows = cur.fetchall()
-            col_names = [desc[0] for desc in cur.description]
-
-    file_path = "orders_export.csv"
-    with open(file_path, mode="w", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(col_names)
-        for row in rows:
-            writer.writerow(row)
+            with open(file_path, mode="wb") as f:
+                cur.copy_expert(build_orders_export_sql(cur, **filters), f, size=EXPORT_CHUNK_BYTES)
     logger.info(f"CSV Export Done: {file_path}")
 
+class ExportCancelled(Exception):
+    pass
+
+class _CopyPipe:
+    """
+    copy_expert の書き込み先。出力を EXPORT_CHUNK_BYTES ずつのチャンクに区切ってキューに積む (最後のチャンクのみ短い)。
+    キューが一杯なら COPY 側が待つので、メモリ使用量はおよそ EXPORT_QUEUE_CHUNKS x EXPORT_CHUNK_BYTES で頭打ちになる。
+    読み手が止めた (cancelled) 場合は write で例外を出して COPY を中断させる。
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+        self.cancelled = threading.Event()
+        self.error = None
+        self._buffer = bytearray()
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise ExportCancelled()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= EXPORT_CHUNK_BYTES:
+            self._put(bytes(self._buffer[:EXPORT_CHUNK_BYTES]))
+            del self._buffer[:EXPORT_CHUNK_BYTES]
+
+    def close(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        self._put(None)
+
+def stream_orders_csv(filters, compress=False):
+    """
+    orders のCSVを bytes のチャンクで返すジェネレータ (compress=True なら gzip)。
+    COPY は別スレッドで実行し、プールの接続は出力し終えるか中断されるまで使う。
+    """
+    pipe = _CopyPipe()
+
+    def run():
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.copy_expert(build_orders_export_sql(cur, **filters), pipe, size=EXPORT_CHUNK_BYTES)
+            pipe.close()
+        except ExportCancelled:
+            logger.info("Orders export cancelled by client")
+        except Exception as e:
+            logger.error(f"Orders export failed: {e}")
+            pipe.error = e
+            try:
+                pipe._put(None)
+            except ExportCancelled:
+                pass
+
+    threading.Thread(target=run, name="orders-export", daemon=True).start()
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    try:
+        while True:
+            chunk = pipe.queue.get()
+            if chunk is None:
+                break
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        # 途中で失敗した場合は、正常終了に見えないようレスポンスを打ち切る
+        if pipe.error is not None:
+            raise pipe.error
+        if compressor:
+            yield compressor.flush()
+    finally:
+        pipe.cancelled.set()
+
+def require_export_token():
+    """Authorization: Bearer <EXPORT_API_TOKEN> を確認する (トークン未設定なら機能ごと無効で 404)"""
+    if not EXPORT_API_TOKEN:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {EXPORT_API_TOKEN}".encode("utf-8")):
+        abort(401)
+
+def _parse_export_date(value):
+    return datetime.date.fromisoformat(value) if value else None
+
+@app.route("/export/orders.csv", methods=["GET"])
+def export_orders():
+    """
+    orders をCSVでストリーミング出力する。Authorization: Bearer <EXPORT_API_TOKEN> が必要。
+    クエリ: from / to (YYYY-MM-DD, 作成日), since_id (これより大きい id のみ), gzip=1 (gzip 圧縮)
+    """
+    require_export_token()
+    try:
+        filters = {
+            "date_from": _parse_export_date(request.args.get("from")),
+            "date_to": _parse_export_date(request.args.get("to")),
+            "since_id": int(request.args["since_id"]) if request.args.get("since_id") else None,
+        }
+    except ValueError:
+        abort(400)
+
+    compress = request.args.get("gzip") == "1"
+    filename = "orders_export.csv.gz" if compress else "orders_export.csv"
+    return app.response_class(
+        stream_orders_csv(filters, compress),
+        mimetype="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}", "Cache-Control": "no-store"}
+    )
+
+###################################
+# (O') 分析用スナップショット (Parquet / Arrow IPC)
+#     orders / estimates の新しい行だけを id の順に取り出し、月ごとのパーティションにファイルとして追記する。
+#     分析はこのファイルに対して行う (本番DBには問い合わせない)。例:
+#       pyarrow.dataset.dataset("analytics_snapshots/orders", format="parquet", partitioning="hive")
+#     取り込み済みの行が後から更新されても反映されない (estimates.order_placed など)。必要なら rebuild=1 で作り直す。
+###################################
+import shutil
+
+ANALYTICS_SNAPSHOT_DIR = os.getenv('ANALYTICS_SNAPSHOT_DIR', 'analytics_snapshots')
+ANALYTICS_SNAPSHOT_FORMAT = os.getenv('ANALYTICS_SNAPSHOT_FORMAT', 'parquet')   # parquet (zstd圧縮) / arrow (非圧縮, memory_map 可)
+ANALYTICS_SNAPSHOT_BATCH_ROWS = int(os.getenv('ANALYTICS_SNAPSHOT_BATCH_ROWS', '50000'))
+ANALYTICS_SNAPSHOT_LAG_SEC = int(os.getenv('ANALYTICS_SNAPSHOT_LAG_SEC', '600'))   # これより新しい行は次回に回す
+ANALYTICS_TABLES = ("orders", "estimates")
+
+_analytics_snapshot_lock = threading.Lock()
+
+def _arrow_type_for(type_code):
+    """PostgreSQL の型OID に対応する Arrow の型 (対応外は None = 文字列として保存)"""
+    import pyarrow as pa
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int32(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1700: pa.float64(),
+        25: pa.string(),
+        1043: pa.string(),
+        1082: pa.date32(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="Asia/Tokyo"),
+    }.get(type_code)
+
+def _rows_to_arrow(description, rows):
+    """カーソルの description と行 (タプル) から Arrow のテーブルを作る (バッチ間で型が揃うよう列の型は固定)"""
+    import pyarrow as pa
+    arrays, names = [], []
+    for i, column in enumerate(description):
+        values = [row[i] for row in rows]
+        arrow_type = _arrow_type_for(column.type_code)
+        if arrow_type is None:
+            arrow_type = pa.string()
+            values = [None if v is None else str(v) for v in values]
+        elif column.type_code == 1700:
+            values = [None if v is None else float(v) for v in values]
+        arrays.append(pa.array(values, type=arrow_type))
+        names.append(column.name)
+    return pa.Table.from_arrays(arrays, names=names)
+
+def _write_snapshot_file(table, path):
+    """一時ファイルに書いてから置き換える (途中で落ちても壊れたファイルを残さない)"""
+    tmp_path = path + ".tmp"
+    if ANALYTICS_SNAPSHOT_FORMAT == "arrow":
+        import pyarrow.feather as feather
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+def _read_watermark(table_dir):
+    try:
+        with open(os.path.join(table_dir, "_watermark.json"), encoding="utf-8") as f:
+            return json.load(f)["last_id"]
+    except FileNotFoundError:
+        return 0
+
+def _write_watermark(table_dir, last_id):
+    path = os.path.join(table_dir, "_watermark.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"last_id": last_id, "updated_at": time.time()}, f)
+    os.replace(path + ".tmp", path)
+
+def snapshot_table(table_name, rebuild=False) -> dict:
+    """
+    table_name の id > 前回の最終id の行を ANALYTICS_SNAPSHOT_BATCH_ROWS 件ずつ取り出し、
+    {ANALYTICS_SNAPSHOT_DIR}/{table_name}/month=YYYY-MM/part-{先頭id}.parquet に書き出す。
+    1バッチ書き終えるごとに最終idを _watermark.json に記録する。記録前に落ちても、次回は同じidから
+    取り出すので同名ファイルが上書きされ、行が重複しない。
+    id は INSERT 時に採番されコミット順とは一致しないため、created_at が ANALYTICS_SNAPSHOT_LAG_SEC 以内の
+    最初の行より手前までしか取り込まない (コミット待ちの小さいidを飛ばして最終idを進めないように)。
+    """
+    table_dir = os.path.join(ANALYTICS_SNAPSHOT_DIR, table_name)
+    if rebuild:
+        shutil.rmtree(table_dir, ignore_errors=True)
+    os.makedirs(table_dir, exist_ok=True)
+    extension = "arrow" if ANALYTICS_SNAPSHOT_FORMAT == "arrow" else "parquet"
+
+    last_id = _read_watermark(table_dir)
+    total_rows = 0
+    files = 0
+    while True:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT * FROM {table_name}
+                    WHERE id > %(last_id)s
+                      AND id < COALESCE(
+                          (SELECT min(id) FROM {table_name}
+                           WHERE id > %(last_id)s AND created_at >= NOW() - %(lag)s * interval '1 second'),
+                          9223372036854775807
+                      )
+                    ORDER BY id LIMIT %(limit)s
+                    """,
+                    {"last_id": last_id, "lag": ANALYTICS_SNAPSHOT_LAG_SEC, "limit": ANALYTICS_SNAPSHOT_BATCH_ROWS}
+                )
+                rows = cur.fetchall()
+                description = cur.description
+        if not rows:
+            break
+
+        columns = [c.name for c in description]
+        id_index, created_index = columns.index("id"), columns.index("created_at")
+        by_month = {}
+        for row in rows:
+            created_at = row[created_index]
+            month = created_at.strftime("%Y-%m") if created_at else "unknown"
+            by_month.setdefault(month, []).append(row)
+
+        for month, month_rows in by_month.items():
+            month_dir = os.path.join(table_dir, f"month={month}")
+            os.makedirs(month_dir, exist_ok=True)
+            path = os.path.join(month_dir, f"part-{month_rows[0][id_index]:012d}.{extension}")
+            _write_snapshot_file(_rows_to_arrow(description, month_rows), path)
+            files += 1
+
+        last_id = rows[-1][id_index]
+        _write_watermark(table_dir, last_id)
+        total_rows += len(rows)
+        if len(rows) < ANALYTICS_SNAPSHOT_BATCH_ROWS:
+            break
+
+    logger.info(f"Analytics snapshot {table_name}: {total_rows} rows, {files} files, last_id={last_id}")
+    return {"rows": total_rows, "files": files, "last_id": last_id}
+
+@app.route("/analytics/snapshot", methods=["POST"])
+def analytics_snapshot():
+    """
+    orders / estimates のスナップショットを差分更新する (定期実行用)。
+    Authorization: Bearer <EXPORT_API_TOKEN> が必要。rebuild=1 で全件を作り直す。
+    """
+    require_export_token()
+    if not _analytics_snapshot_lock.acquire(blocking=False):
+        return "スナップショット作成中です", 409
+    try:
+        rebuild = request.args.get("rebuild") == "1"
+        result = {name: snapshot_table(name, rebuild=rebuild) for name in ANALYTICS_TABLES}
+    finally:
+        _analytics_snapshot_lock.release()
+    return app.response_class(json.dumps(result, ensure_ascii=False), mimetype="application/json")
+
 ###################################
 # ▼▼ 追加: Google Vision OCR処理
 ###################################
-def google_vision_ocr(local_image_path: str) -> str:
+import io
+import tempfile
+
+IMAGE_MEMORY_LIMIT_BYTES = int(os.getenv('IMAGE_MEMORY_LIMIT_BYTES', str(8 * 1024 * 1024)))  # これを超えたら退避
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', str(20 * 1024 * 1024)))                   # これを超えたら拒否
+IMAGE_SPOOL_DIR = os.getenv('IMAGE_SPOOL_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+class ImageTooLargeError(Exception):
+    pass
+
+def download_line_image(message_id, timeout=None):
+    """
+    LINEの画像コンテンツを受信して、先頭にシーク済みのファイルオブジェクトを返す。
+    IMAGE_MEMORY_LIMIT_BYTES まではメモリ上に持ち、超えた分は IMAGE_SPOOL_DIR (tmpfs) に退避する。
+    ファイルは close 時に自動で消えるので、with 文で使うこと。
     """
-    Google Cloud Vision APIを用いて画像のOCRを行い、
+    message_content = line_bot_api.get_message_content(message_id, timeout=timeout)
+    buf = tempfile.SpooledTemporaryFile(max_size=IMAGE_MEMORY_LIMIT_BYTES, dir=IMAGE_SPOOL_DIR)
+    try:
+        size = 0
+        for chunk in message_content.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            if size > IMAGE_MAX_BYTES:
+                raise ImageTooLargeError(f"image {message_id} exceeds {IMAGE_MAX_BYTES} bytes")
+            buf.write(chunk)
+        buf.seek(0)
+    except Exception:
+        buf.close()
+        raise
+    return buf
+
+# 以下の画像を受け取る関数は、bytes か download_line_image のファイルオブジェクトのどちらでも受け付ける。
+# ファイルはメモリに読み込まずに先頭から読み直して使う (退避した大きな写真を丸ごと bytes にしない)。
+def open_image_source(image):
+    """Image.open に渡せる、先頭にシーク済みのファイルオブジェクト"""
+    if isinstance(image, (bytes, bytearray)):
+        return io.BytesIO(image)
+    image.seek(0)
+    return image
+
+def image_size_bytes(image) -> int:
+    if isinstance(image, (bytes, bytearray)):
+        return len(image)
+    return image.seek(0, io.SEEK_END)
+
+def image_sha256(image) -> str:
+    if isinstance(image, (bytes, bytearray)):
+        return hashlib.sha256(image).hexdigest()
+    h = hashlib.sha256()
+    source = open_image_source(image)
+    for chunk in iter(lambda: source.read(64 * 1024), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+def read_image_bytes(image) -> bytes:
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    return open_image_source(image).read()
+
+# VISION_API_ENDPOINT を指定すると接続先を差し替えられる (ローカルのフェイクサーバーでのテスト用)
+VISION_API_ENDPOINT = os.getenv('VISION_API_ENDPOINT')
+VISION_API_INSECURE = os.getenv('VISION_API_INSECURE', '0') == '1'     # TLS なしの gRPC で接続
+# VISION_BATCH=1 の場合、短時間に届いた写真をまとめて batch_annotate_images で1回に送る
+VISION_BATCH = os.getenv('VISION_BATCH', '0') == '1'
+VISION_BATCH_WINDOW_SEC = float(os.getenv('VISION_BATCH_WINDOW_SEC', '0.2'))
+VISION_BATCH_MAX_IMAGES = int(os.getenv('VISION_BATCH_MAX_IMAGES', '16'))          # API の上限は16枚
+VISION_BATCH_MAX_BYTES = int(os.getenv('VISION_BATCH_MAX_BYTES', str(8 * 1024 * 1024)))
+VISION_TIMEOUT_SEC = float(os.getenv('VISION_TIMEOUT_SEC', '60'))
+VISION_BATCH_RESULT_MARGIN_SEC = float(os.getenv('VISION_BATCH_RESULT_MARGIN_SEC', '5'))  # バッチの結果待ちに足す余裕(秒)
+
+_vision_client = None
+_vision_batcher = None
+_vision_pid = None
+_vision_lock = threading.Lock()
+
+def _create_vision_client():
+    from google.cloud import vision
+
+    if VISION_API_ENDPOINT and VISION_API_INSECURE:
+        import grpc
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+        transport = ImageAnnotatorGrpcTransport(channel=grpc.insecure_channel(VISION_API_ENDPOINT))
+        return vision.ImageAnnotatorClient(transport=transport)
+    if VISION_API_ENDPOINT:
+        return vision.ImageAnnotatorClient(client_options={"api_endpoint": VISION_API_ENDPOINT})
+    return vision.ImageAnnotatorClient()
+
+def _init_vision():
+    """Visionクライアント(gRPCチャネル)とバッチャーをプロセスごと(fork後)に1つだけ作る"""
+    global _vision_client, _vision_batcher, _vision_pid
+    pid = os.getpid()
+    if _vision_client is None or _vision_pid != pid:
+        with _vision_lock:
+            if _vision_client is None or _vision_pid != pid:
+                _vision_client = _create_vision_client()
+                _vision_batcher = VisionBatcher(
+                    VISION_BATCH_WINDOW_SEC, VISION_BATCH_MAX_IMAGES, VISION_BATCH_MAX_BYTES, VISION_TIMEOUT_SEC,
+                    VISION_BATCH_RESULT_MARGIN_SEC
+                )
+                _vision_pid = pid
+
+def get_vision_client():
+    _init_vision()
+    return _vision_client
+
+class VisionBatcher:
+    """
+    submit() された画像を window_sec の間ためて、batch_annotate_images で一度に OCR する。
+    max_images 枚 / max_bytes に達したら待たずに送る。結果は Future で各呼び出し元に返す。
+    1回の送信は timeout_sec で打ち切り、そのバッチの Future は全て例外で終える (後続のバッチを待たせない)。
+    呼び出し元は result_timeout (ためる時間 + 送信のタイムアウト + margin_sec) まで結果を待つ。
+    """
+
+    def __init__(self, window_sec, max_images, max_bytes, timeout_sec, margin_sec=0.0):
+        self.window_sec = window_sec
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.timeout_sec = timeout_sec
+        self.result_timeout = window_sec + timeout_sec + margin_sec
+        self._lock = threading.Lock()
+        self._pending = []  # (content, future)
+        self._pending_bytes = 0
+        self._timer = None
+
+    def submit(self, image_content: bytes) -> Future:
+        future = Future()
+        batch = None
+        with self._lock:
+            if self._pending and self._pending_bytes + len(image_content) > self.max_bytes:
+                batch = self._take_pending()
+            self._pending.append((image_content, future))
+            self._pending_bytes += len(image_content)
+            if len(self._pending) >= self.max_images:
+                batch = (batch or []) + self._take_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window_sec, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._send(batch)
+        return future
+
+    def _take_pending(self):
+        batch = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            batch = self._take_pending()
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        from google.cloud import vision
+
+        for i in range(0, len(batch), self.max_images):
+            part = batch[i:i + self.max_images]
+            requests_ = [
+                vision.AnnotateImageRequest(
+                    image=vision.Image(content=content),
+                    features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
+                )
+                for content, _ in part
+            ]
+            try:
+                response = get_vision_client().batch_annotate_images(requests=requests_, timeout=self.timeout_sec)
+            except Exception as e:
+                logger.error(f"Vision batch of {len(part)} image(s) failed: {e}")
+                for _, future in part:
+                    future.set_exception(e)
+                continue
+            logger.info(f"Vision batch of {len(part)} image(s) done")
+            for (_, future), res in zip(part, response.responses):
+                if res.error.message:
+                    future.set_exception(Exception(f"Vision API Error: {res.error.message}"))
+                else:
+                    future.set_result(res.full_text_annotation.text)
+            for _, future in part[len(response.responses):]:
+                future.set_exception(Exception("Vision API Error: no response for image"))
+
+def google_vision_ocr(image_content: bytes) -> str:
+    """
+    Google Cloud Vision APIを用いて画像(バイト列)のOCRを行い、
     抽出されたテキスト全体を文字列で返すサンプル。
+    VISION_BATCH=1 の場合は他の写真とまとめて送信し、結果を待つ。
     """
     from google.cloud import vision
 
-    client = vision.ImageAnnotatorClient()
-    with open(local_image_path, "rb") as image_file:
-        content = image_file.read()
-    image = vision.Image(content=content)
+    _init_vision()
+    if VISION_BATCH:
+        # 送信前にためる時間の分も待つ (VISION_TIMEOUT_SEC だけでは成功するバッチを先に諦めてしまう)
+        return _vision_batcher.submit(image_content).result(timeout=_vision_batcher.result_timeout)
 
-    response = client.document_text_detection(image=image)
+    image = vision.Image(content=image_content)
+    response = _vision_client.document_text_detection(image=image, timeout=VISION_TIMEOUT_SEC)
     if response.error.message:
         raise Exception(f"Vision API Error: {response.error.message}")
 
     full_text = response.full_text_annotation.text
     return full_text
 
+###################################
+# ▼▼ 追加: OCR前の画像の正規化
+#     スマホで撮った写真(数MB)を、EXIFの向きに合わせて回転 → グレースケール化 → 縮小 → 傾き補正
+#     → JPEG再エンコードしてから Vision に送る。読めない画像はそのまま送る。
+###################################
+from PIL import Image
+
+OCR_NORMALIZE = os.getenv('OCR_NORMALIZE', '1') == '1'
+OCR_MAX_LONG_EDGE = int(os.getenv('OCR_MAX_LONG_EDGE', '2048'))        # 長辺の上限(px)
+OCR_JPEG_QUALITY = int(os.getenv('OCR_JPEG_QUALITY', '85'))
+OCR_DESKEW_MAX_ANGLE = float(os.getenv('OCR_DESKEW_MAX_ANGLE', '5'))   # 0 で傾き補正なし
+OCR_DESKEW_MIN_ANGLE = 0.2       # これ未満の傾きは補正しない
+OCR_DESKEW_SAMPLE_EDGE = 1000    # 傾き推定に使う縮小画像の長辺(px)
+
+# EXIF Orientation の値 -> 正しい向きに戻すための transpose (ImageOps.exif_transpose と同じ対応)
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+ocr_image_histogram = LatencyHistogram()
+ocr_image_stats_lock = threading.Lock()
+ocr_image_stats = {"images": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+
+def _otsu_threshold(pixels) -> int:
+    """グレースケール画素 (uint8 配列) の大津の二値化しきい値"""
+    p = np.bincount(pixels.ravel(), minlength=256) / pixels.size
+    w0 = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu[-1] * w0 - mu) ** 2 / (w0 * (1 - w0))
+    return int(np.nanargmax(between))
+
+def estimate_skew_angle(gray) -> float:
+    """
+    文字の行が水平になる回転角度(度, 反時計回り)を推定する。
+    二値化した縮小画像を回転させ、行ごとの黒画素数のプロファイルが最も鋭くなる角度を
+    1度刻み → 0.1度刻みの順に探す。
+    """
+    small = gray.copy()
+    small.thumbnail((OCR_DESKEW_SAMPLE_EDGE, OCR_DESKEW_SAMPLE_EDGE))
+    pixels = np.asarray(small, dtype=np.uint8)
+    ink = Image.fromarray(((pixels < _otsu_threshold(pixels)) * 255).astype(np.uint8))
+
+    def score(angle):
+        rows = np.asarray(ink.rotate(angle, fillcolor=0), dtype=np.int64).sum(axis=1)
+        return int(np.square(np.diff(rows)).sum())
+
+    best = max(np.arange(-OCR_DESKEW_MAX_ANGLE, OCR_DESKEW_MAX_ANGLE + 0.5, 1.0), key=score)
+    best = max(np.arange(best - 0.5, best + 0.55, 0.1), key=score)
+    return float(round(best, 1))
+
+def normalize_image_for_ocr(image) -> bytes:
+    """OCR向けに正規化したJPEGのバイト列を返す。開けない画像は元のバイト列をそのまま返す"""
+    start = time.perf_counter()
+    try:
+        with Image.open(open_image_source(image)) as img:
+            # JPEG は 1/2, 1/4, ... に縮小したグレースケールのままデコードさせる
+            # (長辺が OCR_MAX_LONG_EDGE の3/4以上残る範囲で。4032px の写真なら 2016px でデコードされる)
+            scale = OCR_MAX_LONG_EDGE * 0.75 / max(img.size)
+            if scale < 1:
+                img.draft("L", (int(img.width * scale), int(img.height * scale)))
+            orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+            gray = img.convert("L")
+        # EXIF の向きは縮小後に合わせる (フル解像度のまま回転させない)
+        gray.thumbnail((OCR_MAX_LONG_EDGE, OCR_MAX_LONG_EDGE), Image.LANCZOS)
+        if orientation in EXIF_ORIENTATION_TRANSPOSE:
+            gray = gray.transpose(EXIF_ORIENTATION_TRANSPOSE[orientation])
+
+        angle = estimate_skew_angle(gray) if OCR_DESKEW_MAX_ANGLE > 0 else 0.0
+        if abs(angle) >= OCR_DESKEW_MIN_ANGLE:
+            gray = gray.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=255)
+
+        out = io.BytesIO()
+        gray.save(out, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+        normalized = out.getvalue()
+    except Exception as e:
+        logger.warning(f"Image normalization skipped: {e}")
+        with ocr_image_stats_lock:
+            ocr_image_stats["failed"] += 1
+        return read_image_bytes(image)
+    finally:
+        ocr_image_histogram.observe(time.perf_counter() - start)
+
+    size_in = image_size_bytes(image)
+    with ocr_image_stats_lock:
+        ocr_image_stats["images"] += 1
+        ocr_image_stats["bytes_in"] += size_in
+        ocr_image_stats["bytes_out"] += len(normalized)
+    logger.info(
+        f"Normalized image for OCR: {size_in} -> {len(normalized)} bytes, "
+        f"size={gray.size}, skew={angle}deg, {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+    return normalized
+
+###################################
+# ▼▼ 追加: 注文用紙の写真の品質チェック
+#     暗い・ぼけた・用紙が切れている写真は Vision / OpenAI に送らず、すぐに撮り直しを依頼する
+###################################
+OCR_GATE = os.getenv('OCR_GATE', '1') == '1'
+OCR_GATE_SAMPLE_EDGE = 1024                                                     # 判定用に縮小する長辺(px)
+OCR_GATE_MIN_SHORT_EDGE = int(os.getenv('OCR_GATE_MIN_SHORT_EDGE', '600'))      # 元画像の短辺の下限(px)
+OCR_GATE_MIN_BRIGHTNESS = int(os.getenv('OCR_GATE_MIN_BRIGHTNESS', '80'))       # 明るい側 (95パーセンタイル) の下限
+OCR_GATE_MIN_CONTRAST = int(os.getenv('OCR_GATE_MIN_CONTRAST', '60'))           # 用紙と文字の平均の明るさの差の下限
+OCR_GATE_MIN_SHARPNESS = float(os.getenv('OCR_GATE_MIN_SHARPNESS', '60'))       # ラプラシアンの分散の下限
+OCR_GATE_MIN_PAGE_RATIO = float(os.getenv('OCR_GATE_MIN_PAGE_RATIO', '0.25'))   # 用紙が画面に占める割合の下限
+OCR_GATE_MAX_BORDER_INK = float(os.getenv('OCR_GATE_MAX_BORDER_INK', '0.03'))   # 用紙が画面端まである辺の、端の帯の文字(黒画素)率の上限
+OCR_GATE_BORDER_BAND = 0.03                                                     # 端の帯の幅 (辺の長さに対する割合)
+
+IMAGE_RETAKE_MESSAGES = {
+    "too_small": "写真の解像度が低すぎます。注文用紙全体が写るように、もう一度撮影して送ってください。",
+    "too_dark": "写真が暗すぎます。明るい場所で、もう一度撮影して送ってください。",
+    "low_contrast": "文字がはっきり写っていません。光の反射や影を避けて、もう一度撮影して送ってください。",
+    "blurry": "写真がぼやけています。ピントを合わせて、もう一度撮影して送ってください。",
+    "no_page": "注文用紙が小さく写っています。用紙が画面いっぱいになるように、もう一度撮影して送ってください。",
+    "cropped": "注文用紙の一部が写っていません。用紙全体が画面に収まるように、もう一度撮影して送ってください。",
+}
+
+image_quality_stats_lock = threading.Lock()
+image_quality_stats = dict({"checked": 0, "passed": 0, "unreadable": 0}, **{reason: 0 for reason in IMAGE_RETAKE_MESSAGES})
+
+class PoorImageQualityError(Exception):
+    """品質チェックで不合格になった写真。reason は IMAGE_RETAKE_MESSAGES のキー"""
+
+    def __init__(self, reason, metrics):
+        super().__init__(f"{reason}: {metrics}")
+        self.reason = reason
+        self.metrics = metrics
+
+    @property
+    def retake_message(self):
+        return IMAGE_RETAKE_MESSAGES[self.reason]
+
+def _page_bounds(mask, min_fill=0.5):
+    """明るい画素(用紙)が min_fill 以上を占める行/列の範囲 (無ければ None)"""
+    lines = np.flatnonzero(mask.mean(axis=1) >= min_fill)
+    return (lines[0], lines[-1]) if len(lines) else None
+
+def measure_image_quality(image) -> dict:
+    """
+    判定に使う指標を計算する (縮小したグレースケール画像で、数ミリ秒)。
+    short_edge: 元画像の短辺, brightness: 明るさの95パーセンタイル,
+    contrast: 大津のしきい値で分けた用紙(明)と文字(暗)の平均の差,
+    sharpness: ラプラシアンの分散, page_ratio: 用紙の外接矩形の面積比,
+    border_ink: 用紙が画面端まである辺の、端の帯に含まれる文字の割合 (最大値)
+    """
+    with Image.open(open_image_source(image)) as img:
+        short_edge = min(img.size)
+        # JPEG は長辺が OCR_GATE_SAMPLE_EDGE の3/4以上残る範囲で縮小デコードさせる
+        scale = OCR_GATE_SAMPLE_EDGE * 0.75 / max(img.size)
+        if scale < 1:
+            img.draft("L", (int(img.width * scale), int(img.height * scale)))
+        gray = img.convert("L")
+    gray.thumbnail((OCR_GATE_SAMPLE_EDGE, OCR_GATE_SAMPLE_EDGE))
+    pixels = np.asarray(gray, dtype=np.uint8)
+
+    hist = np.bincount(pixels.ravel(), minlength=256)
+    p95 = int(np.searchsorted(np.cumsum(hist), 0.95 * pixels.size))
+    threshold = _otsu_threshold(pixels)
+    levels = np.arange(256)
+    ink_mean = (hist[:threshold] * levels[:threshold]).sum() / max(hist[:threshold].sum(), 1)
+    paper_mean = (hist[threshold:] * levels[threshold:]).sum() / max(hist[threshold:].sum(), 1)
+
+    px = pixels.astype(np.float32)
+    laplacian = px[:-2, 1:-1] + px[2:, 1:-1] + px[1:-1, :-2] + px[1:-1, 2:] - 4 * px[1:-1, 1:-1]
+
+    # 用紙 = 大津のしきい値より明るい領域。行・列の半分以上が明るい範囲を用紙の外接矩形とみなす
+    paper = pixels >= threshold
+    height, width = paper.shape
+    rows, cols = _page_bounds(paper), _page_bounds(paper.T)
+    page_ratio = 0.0
+    border_ink = 0.0
+    if rows and cols:
+        page_ratio = (rows[1] - rows[0] + 1) * (cols[1] - cols[0] + 1) / paper.size
+        page = paper[rows[0]:rows[1] + 1, cols[0]:cols[1] + 1]
+        band_h = max(1, int(height * OCR_GATE_BORDER_BAND))
+        band_w = max(1, int(width * OCR_GATE_BORDER_BAND))
+        # 用紙の縁が見えている辺は切れていないので、画面端まで用紙が続いている辺だけ文字の有無を見る
+        bands = []
+        if rows[0] < band_h:
+            bands.append(page[:band_h])
+        if rows[1] >= height - band_h:
+            bands.append(page[-band_h:])
+        if cols[0] < band_w:
+            bands.append(page[:, :band_w])
+        if cols[1] >= width - band_w:
+            bands.append(page[:, -band_w:])
+        border_ink = max((1.0 - band.mean() for band in bands), default=0.0)
+
+    return {
+        "short_edge": short_edge,
+        "brightness": p95,
+        "contrast": round(float(paper_mean - ink_mean), 1),
+        "sharpness": round(float(laplacian.var()), 1),
+        "page_ratio": round(float(page_ratio), 3),
+        "border_ink": round(float(border_ink), 3),
+    }
+
+def check_image_quality(image) -> dict:
+    """
+    注文用紙の写真がOCRに使えるかを判定し、指標を返す。使えない場合は PoorImageQualityError。
+    開けない画像はここでは判定せず、そのまま Vision に任せる。
+    """
+    try:
+        metrics = measure_image_quality(image)
+    except Exception as e:
+        logger.warning(f"Image quality check skipped: {e}")
+        with image_quality_stats_lock:
+            image_quality_stats["unreadable"] += 1
+        return {}
+
+    if metrics["short_edge"] < OCR_GATE_MIN_SHORT_EDGE:
+        reason = "too_small"
+    elif metrics["brightness"] < OCR_GATE_MIN_BRIGHTNESS:
+        reason = "too_dark"
+    elif metrics["sharpness"] < OCR_GATE_MIN_SHARPNESS:
+        reason = "blurry"
+    elif metrics["contrast"] < OCR_GATE_MIN_CONTRAST:
+        reason = "low_contrast"
+    elif metrics["page_ratio"] < OCR_GATE_MIN_PAGE_RATIO:
+        reason = "no_page"
+    elif metrics["border_ink"] > OCR_GATE_MAX_BORDER_INK:
+        reason = "cropped"
+    else:
+        reason = None
+
+    with image_quality_stats_lock:
+        image_quality_stats["checked"] += 1
+        image_quality_stats[reason or "passed"] += 1
+    if reason:
+        raise PoorImageQualityError(reason, metrics)
+    return metrics
+
 ###################################
 # ▼▼ 追加: OpenAIでテキスト解析
 ###################################
 import openai
 
-def openai_extract_form_data(ocr_text: str) -> dict:
+OPENAI_TIMEOUT_SEC = float(os.getenv('OPENAI_TIMEOUT_SEC', '30'))
+# OPENAI_EXTRACT_MODE=function の場合、JSONスキーマ付きの function calling で抽出し、不正な値は1回だけ修正を依頼する
+OPENAI_EXTRACT_MODE = os.getenv('OPENAI_EXTRACT_MODE', 'json')
+# テスト用のスタブサーバーなどに接続先を差し替える場合に指定
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE')
+if OPENAI_API_BASE:
+    openai.api_base = OPENAI_API_BASE
+
+import re
+
+# OpenAI に抽出させる注文フォーム項目 (orders テーブルの列名と同じ)
+FORM_FIELD_KEYS = [
+    "application_date", "delivery_date", "use_date", "discount_option", "school_name",
+    "line_account", "group_name", "school_address", "school_tel", "teacher_name",
+    "teacher_tel", "teacher_email", "representative", "rep_tel", "rep_email",
+    "design_confirm", "payment_method", "product_name", "product_color",
+    "size_ss", "size_s", "size_m", "size_l", "size_ll", "size_lll",
+    "print_size_front", "print_size_front_custom", "print_color_front", "font_no_front", "design_sample_front",
+    "print_size_back", "print_size_back_custom", "print_color_back", "font_no_back", "design_sample_back",
+    "print_size_other", "print_size_other_custom", "print_color_other", "font_no_other", "design_sample_other"
+]
+
+###################################
+# ▼▼ 追加: 注文用紙の定型ラベルからのローカル抽出 (OpenAI の前段)
+###################################
+# 注文用紙上のラベル -> 項目 (行頭で最長一致したラベルを採用する)
+FORM_FIELD_LABELS = {
+    "申込日": "application_date",
+    "お申込日": "application_date",
+    "配達日": "delivery_date",
+    "お届け日": "delivery_date",
+    "使用日": "use_date",
+    "ご使用日": "use_date",
+    "学校名": "school_name",
+    "LINEアカウント名": "line_account",
+    "団体名": "group_name",
+    "学校住所": "school_address",
+    "学校TEL": "school_tel",
+    "学校電話番号": "school_tel",
+    "担任名": "teacher_name",
+    "担任携帯": "teacher_tel",
+    "担任メール": "teacher_email",
+    "代表者": "representative",
+    "代表者名": "representative",
+    "代表者TEL": "rep_tel",
+    "代表者携帯": "rep_tel",
+    "代表者メール": "rep_email",
+    "商品カラー": "product_color",
+    "プリントカラー(前)": "print_color_front",
+    "フォントNo.(前)": "font_no_front",
+    "プリントサンプル(前)": "design_sample_front",
+    "プリントカラー(後)": "print_color_back",
+    "フォントNo.(後)": "font_no_back",
+    "プリントサンプル(後)": "design_sample_back",
+    "プリントカラー(その他)": "print_color_other",
+    "フォントNo.(その他)": "font_no_other",
+    "プリントサンプル(その他)": "design_sample_other",
+}
+_FORM_LABEL_RE = re.compile("|".join(re.escape(l) for l in sorted(FORM_FIELD_LABELS, key=len, reverse=True)))
+
+# 選択式の項目: 用紙上に候補が1つだけ現れた場合に採用する
+FORM_FIELD_CHOICES = {
+    "discount_option": ["早割", "タダ割", "いっしょ割り"],
+    "design_confirm": ["LINE代表者", "LINEご担任(保護者)", "メール代表者", "メールご担任(保護者)"],
+    "payment_method": [
+        "代金引換(ヤマト運輸/現金のみ)",
+        "後払い(コンビニ/郵便振替)",
+        "後払い(銀行振込)",
+        "先払い(銀行振込)"
+    ],
+    "product_name": [],  # カタログの読み込み時に _update_product_choices で設定する (import 時には読み込まない)
+}
+
+SIZE_FIELDS = {"SS": "size_ss", "S": "size_s", "M": "size_m", "L": "size_l", "LL": "size_ll", "LLL": "size_lll"}
+
+_DATE_RE = re.compile(r"(\d{4})\s*[年/.\-]\s*(\d{1,2})\s*[月/.\-]\s*(\d{1,2})")
+_SIZE_RE = re.compile(r"(?<![A-Za-z])(LLL|LL|SS|S|M|L)(?![A-Za-z])\s*[)）]?\s*[:：=]?\s*(\d+)")
+_SIZE_LINE_RE = re.compile(r"^(?:[\s(（]*(?:LLL|LL|SS|S|M|L)[\s)）]*[:：=]?\s*\d+\s*枚?[\s,、/]*)+$")
+_EMAIL_RE = re.compile(r"[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+")
+_TEL_RE = re.compile(r"(?<!\d)0\d{1,4}-?\d{1,4}-?\d{3,4}(?!\d)")
+_LEFTOVER_ALNUM_RE = re.compile(r"[A-Za-z0-9]")
+_DATE_FIELDS = {"application_date", "delivery_date", "use_date"}
+_EMAIL_FIELDS = {"teacher_email", "rep_email"}
+_TEL_FIELDS = {"school_tel", "teacher_tel", "rep_tel"}
+
+_ZENKAKU_TABLE = str.maketrans({chr(0xFF01 + i): chr(0x21 + i) for i in range(94)})
+_ZENKAKU_TABLE[0x3000] = " "
+
+def _normalize_ocr_line(line: str) -> str:
+    """全角英数・記号を半角にそろえる (ラベル照合用)"""
+    return line.translate(_ZENKAKU_TABLE).strip()
+
+def _coerce_local_value(field, value):
+    """ローカル抽出した値を項目の型に合わせる。判定できなければ None"""
+    value = value.strip(" :：\t")
+    if not value:
+        return None
+    if field in _DATE_FIELDS:
+        m = _DATE_RE.search(value)
+        return f"{int(m.group(1)):04d}-{int(m.group(2)):02d}-{int(m.group(3)):02d}" if m else None
+    if field in _EMAIL_FIELDS:
+        m = _EMAIL_RE.search(value)
+        return m.group(0) if m else None
+    if field in _TEL_FIELDS:
+        # 番号の前後に英数字が残る場合 (O9O のような誤読・内線表記など) は OpenAI に任せる
+        m = _TEL_RE.search(value)
+        if m is None or _LEFTOVER_ALNUM_RE.search(value[:m.start()] + value[m.end():]):
+            return None
+        return m.group(0)
+    return value
+
+def local_extract_form_data(ocr_text: str) -> dict:
+    """
+    注文用紙の定型ラベル・選択肢・サイズ表記を正規表現で読み取る。
+    確実に読めた項目だけを返す (読めなかった項目はキー自体を含めない)。
+    """
+    get_catalog()  # 商品名の候補をカタログに合わせる
+    result = {}
+    lines = [_normalize_ocr_line(line) for line in ocr_text.splitlines()]
+    lines = [line for line in lines if line]
+
+    for i, line in enumerate(lines):
+        # 行頭がラベルの行のみ対象。1行に複数のラベルがあればラベルごとに区切る
+        matches = list(_FORM_LABEL_RE.finditer(line))
+        if matches and matches[0].start() == 0:
+            for j, m in enumerate(matches):
+                field = FORM_FIELD_LABELS[m.group(0)]
+                end = matches[j + 1].start() if j + 1 < len(matches) else len(line)
+                value = line[m.end():end]
+                # 値が次の行に分かれている場合 (次の行がラベルで始まらなければ採用)
+                if not value.strip(" :：") and j + 1 == len(matches) and i + 1 < len(lines) \
+                        and not _FORM_LABEL_RE.match(lines[i + 1]):
+                    value = lines[i + 1]
+                coerced = _coerce_local_value(field, value)
+                if coerced is not None and field not in result:
+                    result[field] = coerced
+
+        if "サイズ" in line or _SIZE_LINE_RE.match(line):
+            for size, qty in _SIZE_RE.findall(line):
+                result.setdefault(SIZE_FIELDS[size], int(qty))
+
+    normalized_text = "\n".join(lines)
+    for field, choices in FORM_FIELD_CHOICES.items():
+        if field in result:
+            continue
+        found = [c for c in choices if _normalize_ocr_line(c) in normalized_text]
+        # 長い候補に含まれる短い候補(部分一致)は除外
+        found = [c for c in found if not any(c != other and c in other for other in found)]
+        if len(found) == 1:
+            result[field] = found[0]
+    return result
+
+def extract_form_data(ocr_text: str) -> dict:
+    """
+    まずローカル抽出で埋められる項目を埋め、残りの項目だけ OpenAI に問い合わせて結果をマージする。
+    FORM_FIELD_KEYS が全てローカルで埋まった場合だけ OpenAI を呼ばない。
+    """
+    start = time.perf_counter()
+    local = local_extract_form_data(ocr_text)
+    logger.info(
+        f"Local form extraction filled {len(local)}/{len(FORM_FIELD_KEYS)} fields "
+        f"in {(time.perf_counter() - start) * 1000:.2f}ms"
+    )
+    missing = [k for k in FORM_FIELD_KEYS if k not in local]
+    if not missing:
+        return local
+
+    remote = openai_extract_form_data(ocr_text, keys=missing)
+    merged = {k: v for k, v in remote.items() if k not in local}
+    merged.update(local)
+    return merged
+
+###################################
+# ▼▼ 追加: OpenAI に送るOCRテキストの前処理 (トークン予算)
+###################################
+OPENAI_PROMPT_TOKEN_BUDGET = int(os.getenv('OPENAI_PROMPT_TOKEN_BUDGET', '1500'))  # 1リクエストあたりのOCRテキスト上限
+OPENAI_MAX_CHUNKS = int(os.getenv('OPENAI_MAX_CHUNKS', '3'))                        # 分割後に送るチャンク数の上限
+
+# フォームに関係しそうな行の判定 (ラベル・選択肢・数字・メールアドレス・よく出る語)
+def _build_relevant_line_re():
+    return re.compile(
+        "|".join(
+            [re.escape(l) for l in FORM_FIELD_LABELS]
+            + [re.escape(c) for choices in FORM_FIELD_CHOICES.values() for c in choices]
+            + ["サイズ", "プリント", "カラー", "フォント", "学校", "高校", "中学", "大学", "組", "部",
+               "先生", "様", "住所", "都", "道", "府", "県", "市", "区", "町", "村", "TEL", "電話", "メール",
+               "LINE", "割", "払", r"\d", "@"]
+        )
+    )
+
+_RELEVANT_LINE_RE = _build_relevant_line_re()
+
+@on_catalog_reload
+def _update_product_choices(catalog):
+    """商品名の候補と、それを含む行判定の正規表現をカタログに合わせて作り直す"""
+    global _RELEVANT_LINE_RE
+    FORM_FIELD_CHOICES["product_name"] = catalog.product_names
+    _RELEVANT_LINE_RE = _build_relevant_line_re()
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+TOKEN_ENCODER_RETRY_SEC = float(os.getenv('TOKEN_ENCODER_RETRY_SEC', '300'))  # tiktoken の読み込みに失敗した後、再試行するまでの秒数
+
+_token_encoder = None
+_token_encoder_failed_at = None
+_token_encoder_lock = threading.Lock()
+
+def _get_token_encoder():
+    """
+    tiktoken のエンコーダを返す。初回は語彙をダウンロードするため失敗することがあり、
+    その場合は None を返して TOKEN_ENCODER_RETRY_SEC 後に読み込みを再試行する (失敗を永続させない)。
+    """
+    global _token_encoder, _token_encoder_failed_at
+    if _token_encoder is not None:
+        return _token_encoder
+    with _token_encoder_lock:
+        if _token_encoder is None:
+            if _token_encoder_failed_at is not None and time.monotonic() - _token_encoder_failed_at < TOKEN_ENCODER_RETRY_SEC:
+                return None
+            try:
+                import tiktoken
+                _token_encoder = tiktoken.encoding_for_model("gpt-3.5-turbo").encode
+            except Exception as e:
+                logger.warning(
+                    f"tiktoken unavailable, estimating tokens by characters (retry in {TOKEN_ENCODER_RETRY_SEC:.0f}s): {e}"
+                )
+                _token_encoder_failed_at = time.monotonic()
+    return _token_encoder
+
+def count_tokens(text: str) -> int:
+    """
+    gpt-3.5-turbo のトークン数。tiktoken が使えない間(未インストール・辞書未取得)は
+    1文字=1トークンとして見積もる (日本語のOCRテキストでは多めに数える側になる)。
+    """
+    encoder = _get_token_encoder()
+    if encoder is None:
+        return len(text)
+    return len(encoder(text))
+
+def preprocess_ocr_text(ocr_text: str) -> list:
+    """
+    OCRテキストを OpenAI に送る前に整える。
+    - 空白の連続を1つにまとめ、全角英数を半角にする
+    - フォームに関係する語を含まない行を落とす (ラベル行の直後の行は値として残す)
+    - OPENAI_PROMPT_TOKEN_BUDGET トークンごとのチャンクに分け、先頭 OPENAI_MAX_CHUNKS 個を返す
+    """
+    kept = []
+    previous_was_label = False
+    for raw_line in ocr_text.splitlines():
+        line = _WHITESPACE_RE.sub(" ", _normalize_ocr_line(raw_line))
+        if not line:
+            continue
+        if _RELEVANT_LINE_RE.search(line) or previous_was_label:
+            kept.append(line)
+        previous_was_label = bool(_FORM_LABEL_RE.match(line))
+
+    chunks = []
+    current, current_tokens = [], 0
+    for line in kept:
+        tokens = count_tokens(line) + 1
+        if tokens > OPENAI_PROMPT_TOKEN_BUDGET:
+            # 1行で予算を超える場合は文字数で切り詰める
+            line = line[:OPENAI_PROMPT_TOKEN_BUDGET]
+            tokens = count_tokens(line) + 1
+        if current and current_tokens + tokens > OPENAI_PROMPT_TOKEN_BUDGET:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+
+    if len(chunks) > OPENAI_MAX_CHUNKS:
+        logger.warning(f"OCR text split into {len(chunks)} chunks; only the first {OPENAI_MAX_CHUNKS} are sent")
+    return chunks[:OPENAI_MAX_CHUNKS]
+
+openai_histogram = LatencyHistogram()
+openai_stats_lock = threading.Lock()
+openai_stats = {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+def openai_extract_form_data(ocr_text: str, keys=None) -> dict:
     """
     OCRテキストから注文フォーム項目を推定し、JSONを返す例。
     （デモ用のため簡易的なプロンプトのみ）
+    keys: 抽出させる項目 (省略時は FORM_FIELD_KEYS 全て)
+    OCRテキストは preprocess_ocr_text で整形し、長い場合はチャンクごとに問い合わせて結果をマージする。
     """
-    openai.api_key = OPENAI_API_KEY
+    get_catalog()  # 商品名の候補 (スキーマの enum・行判定) をカタログに合わせる
+    remaining = list(keys if keys is not None else FORM_FIELD_KEYS)
+    result = {}
+    for chunk in preprocess_ocr_text(ocr_text):
+        if not remaining:
+            break
+        for k, v in _openai_extract_chunk(chunk, remaining).items():
+            if k not in result and v not in (None, ""):
+                result[k] = v
+        remaining = [k for k in remaining if k not in result]
+    return result
 
-    system_prompt = """あなたは注文用紙のOCR結果から必要な項目を抽出するアシスタントです。
-    入力として渡されるテキスト（OCR結果）を解析し、次のフォーム項目に合致する値を抽出してJSONで返してください。
-    日付項目（application_date, delivery_date, use_date）は必ず YYYY-MM-DD の形式で返してください
-    必ず JSON のみを返し、余計な文章は一切出力しないでください。
-    キー一覧: [
-        "application_date","delivery_date","use_date","discount_option","school_name",
-        "line_account","group_name","school_address","school_tel","teacher_name",
-        "teacher_tel","teacher_email","representative","rep_tel","rep_email",
-        "design_confirm","payment_method","product_name","product_color",
-        "size_ss","size_s","size_m","size_l","size_ll","size_lll",
-        "print_size_front","print_size_front_custom","print_color_front","font_no_front","design_sample_front",
-        "print_size_back","print_size_back_custom","print_color_back","font_no_back","design_sample_back",
-        "print_size_other","print_size_other_custom","print_color_other","font_no_other","design_sample_other"
-    ]
-    （前後のプリント位置やカラー情報など読み取れそうなら適宜含めて構いません）
-    """
+###################################
+# ▼▼ 追加: 抽出結果のスキーマと検証
+###################################
+SIZE_FIELD_KEYS = set(SIZE_FIELDS.values())
+FORM_EXTRACT_FUNCTION_NAME = "submit_order_form"
+
+def build_form_schema(keys) -> dict:
+    """orders の各項目の JSON スキーマ (日付は YYYY-MM-DD、サイズは0以上の整数、選択式は候補のみ)"""
+    properties = {}
+    for k in keys:
+        if k in _DATE_FIELDS:
+            properties[k] = {"type": ["string", "null"], "pattern": r"^\d{4}-\d{2}-\d{2}$", "description": "YYYY-MM-DD"}
+        elif k in SIZE_FIELD_KEYS:
+            properties[k] = {"type": ["integer", "null"], "minimum": 0}
+        elif k in FORM_FIELD_CHOICES:
+            properties[k] = {"type": ["string", "null"], "enum": FORM_FIELD_CHOICES[k] + [None]}
+        else:
+            properties[k] = {"type": ["string", "null"]}
+    return {"type": "object", "properties": properties, "additionalProperties": False}
 
-    user_prompt = f"""
-以下OCRテキストです:
-{ocr_text}
-上記に基づき、フォーム項目に合致する値をJSONのみで返してください。
+def validate_form_data(data, keys):
+    """
+    抽出結果をスキーマに合わせて検証・変換する。
+    戻り値: (有効な項目だけの dict, 問題のあった項目の説明リスト)
     """
+    if not isinstance(data, dict):
+        return {}, ["JSONオブジェクトではありません"]
+    clean, errors = {}, []
+    for k, v in data.items():
+        if k not in keys or v is None or v == "":
+            continue
+        if k in _DATE_FIELDS:
+            m = _DATE_RE.search(_normalize_ocr_line(str(v)))
+            try:
+                clean[k] = datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3))).isoformat()
+            except (AttributeError, ValueError):
+                errors.append(f"{k}: YYYY-MM-DD 形式の日付ではありません ({v!r})")
+        elif k in SIZE_FIELD_KEYS:
+            m = re.fullmatch(r"\s*(\d+)\s*枚?\s*", _normalize_ocr_line(str(v))) if not isinstance(v, bool) else None
+            if m:
+                clean[k] = int(m.group(1))
+            else:
+                errors.append(f"{k}: 0以上の整数ではありません ({v!r})")
+        elif k in FORM_FIELD_CHOICES:
+            normalized = _normalize_ocr_line(str(v))
+            match = next((c for c in FORM_FIELD_CHOICES[k] if _normalize_ocr_line(c) == normalized), None)
+            if match:
+                clean[k] = match
+            else:
+                errors.append(f"{k}: 候補 {FORM_FIELD_CHOICES[k]} のいずれでもありません ({v!r})")
+        else:
+            clean[k] = str(v).strip()
+    return clean, errors
 
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        temperature=0.2,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+def _chat_completion(messages, keys) -> str:
+    """ChatCompletion を1回呼び出し、計測した上で応答のJSON文字列を返す"""
+    openai.api_key = OPENAI_API_KEY
+    kwargs = {}
+    if OPENAI_EXTRACT_MODE == "function":
+        kwargs = {
+            "functions": [{
+                "name": FORM_EXTRACT_FUNCTION_NAME,
+                "description": "注文用紙から読み取った項目を登録する",
+                "parameters": build_form_schema(keys)
+            }],
+            "function_call": {"name": FORM_EXTRACT_FUNCTION_NAME}
+        }
+
+    start = time.perf_counter()
+    try:
+        response = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            temperature=0.2,
+            request_timeout=OPENAI_TIMEOUT_SEC,
+            messages=messages,
+            **kwargs
+        )
+    except Exception:
+        with openai_stats_lock:
+            openai_stats["errors"] += 1
+        raise
+    finally:
+        openai_histogram.observe(time.perf_counter() - start)
+
+    usage = response.get("usage", {})
+    with openai_stats_lock:
+        openai_stats["requests"] += 1
+        openai_stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        openai_stats["completion_tokens"] += usage.get("completion_tokens", 0)
+    logger.info(
+        f"OpenAI extraction for {len(keys)} keys took {(time.perf_counter() - start) * 1000:.0f}ms, "
+        f"prompt_tokens={usage.get('prompt_tokens')}, completion_tokens={usage.get('completion_tokens')}"
     )
-    content = response["choices"][0]["message"]["content"]
+    message = response["choices"][0]["message"]
+    if OPENAI_EXTRACT_MODE == "function":
+        content = (message.get("function_call") or {}).get("arguments") or ""
+    else:
+        content = message.get("content") or ""
     logger.info(f"OpenAI raw content: {content}")
+    return content
 
+def _parse_form_json(content: str):
     # JSONとしてパースを試みる
     try:
-        result = json.loads(content)
-    except json.JSONDecodeError:
-        result = {}
+        return json.loads(content), None
+    except json.JSONDecodeError as e:
+        return {}, f"JSONとして解析できません: {e}"
+
+def _openai_extract_chunk(ocr_text: str, keys) -> dict:
+    system_prompt = (
+        "あなたは注文用紙のOCR結果から必要な項目を抽出するアシスタントです。\n"
+        "入力として渡されるテキスト（OCR結果）を解析し、次のフォーム項目に合致する値を抽出してJSONで返してください。\n"
+        "日付項目（application_date, delivery_date, use_date）は必ず YYYY-MM-DD の形式で返してください。\n"
+        "必ず JSON のみを返し、余計な文章は一切出力しないでください。\n"
+        f"キー一覧: {json.dumps(keys, ensure_ascii=False, separators=(',', ':'))}"
+    )
+    user_prompt = f"以下OCRテキストです:\n{ocr_text}\n上記に基づき、フォーム項目に合致する値をJSONのみで返してください。"
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+    content = _chat_completion(messages, keys)
+    data, parse_error = _parse_form_json(content)
+    result, errors = validate_form_data(data, keys)
+    if parse_error:
+        errors = [parse_error]
+    if not errors or OPENAI_EXTRACT_MODE != "function":
+        return result
+
+    # 1回だけ修正を依頼する (OCRテキストは送り直さず、前回の出力と問題点だけを渡す)
+    logger.info(f"Asking OpenAI to repair extraction: {errors}")
+    repair_messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"次のJSONには問題があります。\n{content}\n問題点:\n" + "\n".join(errors)
+         + "\n問題のある項目を修正するか null にしたJSONのみを返してください。"}
+    ]
+    try:
+        repaired, _ = _parse_form_json(_chat_completion(repair_messages, keys))
+    except Exception as e:
+        logger.error(f"OpenAI repair request failed: {e}")
+        return result
+    repaired_result, repaired_errors = validate_form_data(repaired, keys)
+    if repaired_errors:
+        logger.info(f"Dropping fields still invalid after repair: {repaired_errors}")
+    repaired_result.update(result)
+    return repaired_result
+
+###################################
+# ▼▼ 追加: OCR / OpenAI抽出結果のキャッシュ
+#     同じ写真の再送は画像のハッシュで、同じOCR結果はテキストのハッシュで引き当てる
+###################################
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '512'))
+RESULT_CACHE_BACKEND = os.getenv('RESULT_CACHE_BACKEND', '')     # '' (メモリのみ) / 'disk' / 'postgres'
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'result_cache')
+# 二次キャッシュには注文用紙の氏名・電話番号・住所などが入るので、保存期間を区切って掃除する
+RESULT_CACHE_TTL_SEC = int(os.getenv('RESULT_CACHE_TTL_SEC', str(7 * 24 * 3600)))
+RESULT_CACHE_DISK_MAX_BYTES = int(os.getenv('RESULT_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+
+class DiskCacheTier:
+    """
+    RESULT_CACHE_DIR/<namespace>/<key先頭2文字>/<key>.json に保存する二次キャッシュ。
+    更新から ttl 秒で期限切れ。sweep() で期限切れを消し、合計が max_bytes を超えたら古い順に消す。
+    """
+
+    def __init__(self, base_dir, ttl, max_bytes):
+        self.base_dir = base_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _path(self, namespace, key):
+        return os.path.join(self.base_dir, namespace, key[:2], key + ".json")
+
+    def get(self, namespace, key):
+        try:
+            with open(self._path(namespace, key), encoding="utf-8") as f:
+                if os.fstat(f.fileno()).st_mtime < time.time() - self.ttl:
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, namespace, key, value):
+        path = self._path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def sweep(self):
+        expires_before = time.time() - self.ttl
+        files = []
+        for dirpath, _, filenames in os.walk(self.base_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if mtime >= expires_before and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+class PostgresCacheTier:
+    """result_cache テーブルに保存する二次キャッシュ (全ワーカー・全ホストで共有)。更新から ttl 秒で期限切れ"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._ready = False
+
+    def _ensure_table(self):
+        if self._ready:
+            return
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (namespace, key)
+                )
+                """)
+        self._ready = True
+
+    def get(self, namespace, key):
+        self._ensure_table()
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT value FROM result_cache
+                    WHERE namespace = %s AND key = %s AND created_at >= NOW() - %s * INTERVAL '1 second'
+                    """,
+                    (namespace, key, self.ttl)
+                )
+                row = cur.fetchone()
+        return row[0] if row else None
+
+    def set(self, namespace, key, value):
+        self._ensure_table()
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO result_cache (namespace, key, value) VALUES (%s, %s, %s)
+                    ON CONFLICT (namespace, key) DO UPDATE SET value = EXCLUDED.value, created_at = NOW()
+                    """,
+                    (namespace, key, value)
+                )
+
+    def sweep(self):
+        self._ensure_table()
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM result_cache WHERE created_at < NOW() - %s * INTERVAL '1 second'",
+                    (self.ttl,)
+                )
+                return cur.rowcount
+
+class ResultCache:
+    """
+    プロセス内LRU (max_entries件) + 任意の二次キャッシュ(tier)。
+    値は JSON にシリアライズして保持する。ヒット/ミス数を stats に記録する。
+    """
 
+    def __init__(self, namespace, max_entries, tier=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.tier = tier
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "tier_hits": 0, "misses": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _put_local(self, key, raw):
+        with self._lock:
+            self._data[key] = raw
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            raw = self._data.get(key)
+            if raw is not None:
+                self._data.move_to_end(key)
+                self.stats["hits"] += 1
+                return json.loads(raw)
+        if self.tier is not None:
+            try:
+                raw = self.tier.get(self.namespace, key)
+            except Exception as e:
+                logger.error(f"Result cache ({self.namespace}) read failed: {e}")
+                self._count("errors")
+                raw = None
+            if raw is not None:
+                self._put_local(key, raw)
+                self._count("tier_hits")
+                return json.loads(raw)
+        self._count("misses")
+        return None
+
+    def set(self, key, value):
+        raw = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        self._put_local(key, raw)
+        if self.tier is not None:
+            try:
+                self.tier.set(self.namespace, key, raw)
+            except Exception as e:
+                logger.error(f"Result cache ({self.namespace}) write failed: {e}")
+                self._count("errors")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+            data["entries"] = len(self._data)
+        return data
+
+def _create_cache_tier():
+    if RESULT_CACHE_BACKEND == "disk":
+        return DiskCacheTier(RESULT_CACHE_DIR, RESULT_CACHE_TTL_SEC, RESULT_CACHE_DISK_MAX_BYTES)
+    if RESULT_CACHE_BACKEND == "postgres":
+        return PostgresCacheTier(RESULT_CACHE_TTL_SEC)
+    return None
+
+_cache_tier = _create_cache_tier()
+if _cache_tier is not None:
+    register_sweep_target("result cache entries", _cache_tier.sweep)
+ocr_cache = ResultCache("ocr", RESULT_CACHE_MAX_ENTRIES, _cache_tier)
+extract_cache = ResultCache("extract", RESULT_CACHE_MAX_ENTRIES, _cache_tier)
+
+def cached_google_vision_ocr(image) -> str:
+    """
+    画像 (bytes かファイル) の SHA-256 をキーに google_vision_ocr の結果をキャッシュする。
+    キーは受信したままの画像で取り、正規化 (OCR_NORMALIZE=1) はキャッシュに無い場合だけ行う。
+    Vision に送るために bytes にするのは正規化後の (小さな) 画像だけ。
+    """
+    key = image_sha256(image)
+    ocr_text = ocr_cache.get(key)
+    if ocr_text is None:
+        image_content = normalize_image_for_ocr(image) if OCR_NORMALIZE else read_image_bytes(image)
+        ocr_text = google_vision_ocr(image_content)
+        ocr_cache.set(key, ocr_text)
+    return ocr_text
+
+def cached_openai_extract_form_data(ocr_text: str) -> dict:
+    """OCRテキストの SHA-256 をキーに extract_form_data の結果をキャッシュする (空の結果は保存しない)"""
+    key = hashlib.sha256(ocr_text.encode("utf-8")).hexdigest()
+    result = extract_cache.get(key)
+    if result is None:
+        result = extract_form_data(ocr_text)
+        if result:
+            extract_cache.set(key, result)
     return result
 
+###################################
+# ▼▼ 追加: 注文用紙写真の解析パイプライン
+#     ダウンロード → 品質チェック → OCR → OpenAI抽出 をワーカーで実行し、終わったら push で案内する
+###################################
+PAPER_PIPELINE_WORKERS = int(os.getenv('PAPER_PIPELINE_WORKERS', '4'))
+PAPER_DOWNLOAD_TIMEOUT_SEC = float(os.getenv('PAPER_DOWNLOAD_TIMEOUT_SEC', '30'))
+
+class PaperOrderPipeline:
+    """
+    注文用紙の写真を段階ごとに処理する。
+    各段階の処理時間をヒストグラムに記録し、タイムアウトは各段階の呼び出し側で指定する
+    (download: PAPER_DOWNLOAD_TIMEOUT_SEC, ocr: VISION_TIMEOUT_SEC (VISION_BATCH=1 なら VisionBatcher.result_timeout),
+    extract: OPENAI_TIMEOUT_SEC)。
+    """
+
+    STAGES = ("download", "quality", "ocr", "extract", "total")
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="paper-pipeline")
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "succeeded": 0, "rejected": 0, "failed": 0, "stale": 0}
+
+    def submit(self, user_id, message_id, host):
+        with self._lock:
+            self.stats["submitted"] += 1
+        future = self._executor.submit(self._run, user_id, message_id, host)
+        future.add_done_callback(lambda f: self._on_done(f, user_id, message_id))
+        return future
+
+    @staticmethod
+    def analysing_state(message_id) -> dict:
+        return {"state": "analysing_order_form_photo", "message_id": message_id}
+
+    def _finish(self, user_id, message_id, state) -> bool:
+        """
+        まだこの写真の解析中のときだけ状態を書き換える。
+        解析中に別の操作(簡易見積など)を始めていた場合は、その状態を残して結果を捨てる。
+        """
+        if get_state_store().compare_and_set(user_id, self.analysing_state(message_id), state):
+            return True
+        with self._lock:
+            self.stats["stale"] += 1
+        logger.info(f"Discarding stale paper order result for user_id={user_id}, message_id={message_id}")
+        return False
+
+    def _on_done(self, future, user_id, message_id):
+        """_run の外に漏れた例外を記録し、解析中のまま残らないよう写真待ちに戻す"""
+        if future.exception() is None:
+            return
+        logger.error(f"Paper order pipeline crashed for user_id={user_id}, message_id={message_id}: {future.exception()!r}")
+        try:
+            self._finish(user_id, message_id, {"state": "await_order_form_photo"})
+        except Exception as e:
+            logger.error(f"Failed to reset state for user_id={user_id}: {e}")
+
+    def _timed(self, stage, func, *args):
+        start = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.histograms[stage].observe(time.monotonic() - start)
+
+    def _ask_retake(self, user_id, message_id, outcome, text):
+        """写真待ちに戻して再送してもらう"""
+        with self._lock:
+            self.stats[outcome] += 1
+        if self._finish(user_id, message_id, {"state": "await_order_form_photo"}):
+            push_message_async(user_id, TextSendMessage(text=text))
+
+    def _run(self, user_id, message_id, host):
+        start = time.monotonic()
+        try:
+            # 受信した写真はファイルのまま品質チェック・OCR に渡す (bytes に読み込むのは正規化後の画像だけ)
+            image_file = self._timed("download", download_line_image, message_id, PAPER_DOWNLOAD_TIMEOUT_SEC)
+            with image_file:
+                # 暗い・ぼけた・用紙が切れている写真はここで撮り直しを依頼する (Vision / OpenAI は呼ばない)
+                if OCR_GATE:
+                    self._timed("quality", check_image_quality, image_file)
+
+                # Google Vision API OCR 処理 (同じ写真の再送はキャッシュから返す)
+                ocr_text = self._timed("ocr", cached_google_vision_ocr, image_file)
+            logger.info(f"[DEBUG] OCR result: {ocr_text}")
+
+            # OpenAI API を呼び出して、webフォーム各項目に対応しそうな値を推定
+            form_estimated_data = self._timed("extract", cached_openai_extract_form_data, ocr_text)
+            logger.info(f"[DEBUG] form_estimated_data from OpenAI: {form_estimated_data}")
+        except PoorImageQualityError as e:
+            logger.info(f"Order form photo rejected for user_id={user_id}, message_id={message_id}: {e}")
+            self._ask_retake(user_id, message_id, "rejected", e.retake_message)
+            return
+        except Exception as e:
+            logger.error(f"Paper order pipeline failed for user_id={user_id}, message_id={message_id}: {e}")
+            if isinstance(e, ImageTooLargeError):
+                text = "画像のサイズが大きすぎます。解像度を下げて再度送ってください。"
+            else:
+                text = "注文用紙の読み取りに失敗しました。お手数ですが、もう一度写真を送ってください。"
+            self._ask_retake(user_id, message_id, "failed", text)
+            return
+        finally:
+            self.histograms["total"].observe(time.monotonic() - start)
+
+        # 推定結果をユーザーごとの状態に保持しておき、フォーム表示の際に使う (ステート終了)
+        if not self._finish(user_id, message_id, {"paper_form_data": form_estimated_data}):
+            return
+        with self._lock:
+            self.stats["succeeded"] += 1
+
+        # ユーザーにフォームURLを案内し、修正・送信を促す
+        paper_form_url = f"https://{host}/paper_order_form?user_id={user_id}"
+        push_message_async(
+            user_id,
+            TextSendMessage(
+                text=(
+                    "注文用紙の写真から情報を読み取りました。\n"
+                    "こちらのフォームに自動入力しましたので、内容をご確認・修正の上送信してください。\n"
+                    f"{paper_form_url}"
+                )
+            )
+        )
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+        data["latency"] = {stage: h.snapshot() for stage, h in self.histograms.items()}
+        return data
+
+_paper_pipeline = None
+_paper_pipeline_pid = None
+_paper_pipeline_lock = threading.Lock()
+
+def get_paper_order_pipeline() -> PaperOrderPipeline:
+    """プロセスごと(fork後)にパイプラインのワーカーを生成する"""
+    global _paper_pipeline, _paper_pipeline_pid
+    pid = os.getpid()
+    if _paper_pipeline is None or _paper_pipeline_pid != pid:
+        with _paper_pipeline_lock:
+            if _paper_pipeline is None or _paper_pipeline_pid != pid:
+                _paper_pipeline = PaperOrderPipeline(PAPER_PIPELINE_WORKERS)
+                _paper_pipeline_pid = pid
+    return _paper_pipeline
+
 ###################################
 # ▼▼ 注文用紙フロー用フォーム
 ###################################
@@ -1602,19 +4447,9 @@ PAPER_FORM_HTML = """
 
     <label>商品名:</label>
     <select name="product_name">
-      <option value="ドライTシャツ" {% if data['product_name'] == 'ドライTシャツ' %}selected{% endif %}>ドライTシャツ</option>
-      <option value="ヘビーウェイトTシャツ" {% if data['product_name'] == 'ヘビーウェイトTシャツ' %}selected{% endif %}>ヘビーウェイトTシャツ</option>
-      <option value="ドライポロシャツ" {% if data['product_name'] == 'ドライポロシャツ' %}selected{% endif %}>ドライポロシャツ</option>
-      <option value="ドライメッシュビブス" {% if data['product_name'] == 'ドライメッシュビブス' %}selected{% endif %}>ドライメッシュビブス</option>
-      <option value="ドライベースボールシャツ" {% if data['product_name'] == 'ドライベースボールシャツ' %}selected{% endif %}>ドライベースボールシャツ</option>
-      <option value="ドライロングスリープTシャツ" {% if data['product_name'] == 'ドライロングスリープTシャツ' %}selected{% endif %}>ドライロングスリープTシャツ</option>
-      <option value="ドライハーフパンツ" {% if data['product_name'] == 'ドライハーフパンツ' %}selected{% endif %}>ドライハーフパンツ</option>
-      <option value="ヘビーウェイトロングスリープTシャツ" {% if data['product_name'] == 'ヘビーウェイトロングスリープTシャツ' %}selected{% endif %}>ヘビーウェイトロングスリープTシャツ</option>
-      <option value="クルーネックライトトレーナー" {% if data['product_name'] == 'クルーネックライトトレーナー' %}selected{% endif %}>クルーネックライトトレーナー</option>
-      <option value="フーデッドライトパーカー" {% if data['product_name'] == 'フーデッドライトパーカー' %}selected{% endif %}>フーデッドライトパーカー</option>
-      <option value="スタンダードトレーナー" {% if data['product_name'] == 'スタンダードトレーナー' %}selected{% endif %}>スタンダードトレーナー</option>
-      <option value="スタンダードWフードパーカー" {% if data['product_name'] == 'スタンダードWフードパーカー' %}selected{% endif %}>スタンダードWフードパーカー</option>
-      <option value="ジップアップライトパーカー" {% if data['product_name'] == 'ジップアップライトパーカー' %}selected{% endif %}>ジップアップライトパーカー</option>
+      {% for p in products %}
+      <option value="{{ p }}" {% if data['product_name'] == p %}selected{% endif %}>{{ p }}</option>
+      {% endfor %}
     </select>
 
     <label>商品カラー:</label>
@@ -1743,232 +4578,48 @@ PAPER_FORM_HTML = """
 </html>
 """
 
+PAPER_FORM_PAGE = FormPage(PAPER_FORM_HTML)
+
 @app.route("/paper_order_form", methods=["GET"])
 def paper_order_form():
     user_id = request.args.get("user_id", "")
     guessed_data = {}
-    if user_id in user_states and "paper_form_data" in user_states[user_id]:
-        guessed_data = user_states[user_id]["paper_form_data"]
-    return render_template_string(PAPER_FORM_HTML, user_id=user_id, data=guessed_data)
+    user_state = get_state_store().get(user_id)
+    if user_state is not None and "paper_form_data" in user_state:
+        guessed_data = user_state["paper_form_data"]
+    return PAPER_FORM_PAGE.respond(
+        user_id=user_id,
+        data=guessed_data,
+        products=get_catalog().product_names
+    )
 
 ###################################
 # ▼▼ 紙の注文用フォーム送信
 ###################################
 @app.route("/paper_order_form_submit", methods=["POST"])
 def paper_order_form_submit():
-    form = request.form
-    files = request.files
-    user_id = form.get("user_id", "")
-
-    application_date = none_if_empty_date(form.get("application_date"))
-    delivery_date = none_if_empty_date(form.get("delivery_date"))
-    use_date = none_if_empty_date(form.get("use_date"))
-
-    discount_option = none_if_empty_str(form.get("discount_option"))
-    school_name = none_if_empty_str(form.get("school_name"))
-    line_account = none_if_empty_str(form.get("line_account"))
-    group_name = none_if_empty_str(form.get("group_name"))
-    school_address = none_if_empty_str(form.get("school_address"))
-    school_tel = none_if_empty_str(form.get("school_tel"))
-    teacher_name = none_if_empty_str(form.get("teacher_name"))
-    teacher_tel = none_if_empty_str(form.get("teacher_tel"))
-    teacher_email = none_if_empty_str(form.get("teacher_email"))
-    representative = none_if_empty_str(form.get("representative"))
-    rep_tel = none_if_empty_str(form.get("rep_tel"))
-    rep_email = none_if_empty_str(form.get("rep_email"))
-
-    design_confirm = none_if_empty_str(form.get("design_confirm"))
-    payment_method = none_if_empty_str(form.get("payment_method"))
-    product_name = none_if_empty_str(form.get("product_name"))
-    product_color = none_if_empty_str(form.get("product_color"))
-
-    size_ss = none_if_empty_int(form.get("size_ss"))
-    size_s = none_if_empty_int(form.get("size_s"))
-    size_m = none_if_empty_int(form.get("size_m"))
-    size_l = none_if_empty_int(form.get("size_l"))
-    size_ll = none_if_empty_int(form.get("size_ll"))
-    size_lll = none_if_empty_int(form.get("size_lll"))
-
-    print_size_front = none_if_empty_str(form.get("print_size_front"))
-    print_size_front_custom = none_if_empty_str(form.get("print_size_front_custom"))
-    print_color_front = none_if_empty_str(form.get("print_color_front"))
-    font_no_front = none_if_empty_str(form.get("font_no_front"))
-    design_sample_front = none_if_empty_str(form.get("design_sample_front"))
-
-    print_size_back = none_if_empty_str(form.get("print_size_back"))
-    print_size_back_custom = none_if_empty_str(form.get("print_size_back_custom"))
-    print_color_back = none_if_empty_str(form.get("print_color_back"))
-    font_no_back = none_if_empty_str(form.get("font_no_back"))
-    design_sample_back = none_if_empty_str(form.get("design_sample_back"))
-
-    print_size_other = none_if_empty_str(form.get("print_size_other"))
-    print_size_other_custom = none_if_empty_str(form.get("print_size_other_custom"))
-    print_color_other = none_if_empty_str(form.get("print_color_other"))
-    font_no_other = none_if_empty_str(form.get("font_no_other"))
-    design_sample_other = none_if_empty_str(form.get("design_sample_other"))
-
-    # 位置データ(前/後/その他)
-    pos_data_front = files.get("position_data_front")
-    pos_data_back = files.get("position_data_back")
-    pos_data_other = files.get("position_data_other")
-
-    front_url = upload_file_to_s3(pos_data_front, S3_BUCKET_NAME, prefix="uploads/")
-    back_url = upload_file_to_s3(pos_data_back, S3_BUCKET_NAME, prefix="uploads/")
-    other_url = upload_file_to_s3(pos_data_other, S3_BUCKET_NAME, prefix="uploads/")
-
-    # 追加のデザインイメージ
-    additional_design_position = none_if_empty_str(form.get("additional_design_position"))
-    additional_design_image = files.get("additional_design_image")
-    additional_design_image_url = upload_file_to_s3(additional_design_image, S3_BUCKET_NAME, prefix="uploads/")
-
-    # DBに保存 (orders)
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            sql = """
-            INSERT INTO orders (
-                user_id,
-                application_date,
-                delivery_date,
-                use_date,
-                discount_option,
-                school_name,
-                line_account,
-                group_name,
-                school_address,
-                school_tel,
-                teacher_name,
-                teacher_tel,
-                teacher_email,
-                representative,
-                rep_tel,
-                rep_email,
-                design_confirm,
-                payment_method,
-                product_name,
-                product_color,
-                size_ss,
-                size_s,
-                size_m,
-                size_l,
-                size_ll,
-                size_lll,
-
-                print_size_front,
-                print_size_front_custom,
-                print_color_front,
-                font_no_front,
-                design_sample_front,
-                position_data_front_url,
-
-                print_size_back,
-                print_size_back_custom,
-                print_color_back,
-                font_no_back,
-                design_sample_back,
-                position_data_back_url,
-
-                print_size_other,
-                print_size_other_custom,
-                print_color_other,
-                font_no_other,
-                design_sample_other,
-                position_data_other_url,
-
-                additional_design_position,
-                additional_design_image_url,
-
-                created_at
-            ) VALUES (
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s,
-
-                %s, %s, %s, %s, %s, %s,
+    order, errors = parse_order(request.form)
+    if errors:
+        return _reject_invalid_order(errors)
+    user_id = order["user_id"]
 
-                %s, %s, %s, %s, %s, %s,
+    # 位置データ(前/後/その他)と追加のデザインイメージを並行してアップロード
+    upload_order_files(order, request.files, S3_BUCKET_NAME, prefix="uploads/")
 
-                %s, %s, %s, %s, %s, %s,
-
-                %s,
-                %s,
-
-                NOW()
-            )
-            RETURNING id
-            """
-            params = (
-                user_id,
-                application_date,
-                delivery_date,
-                use_date,
-                discount_option,
-                school_name,
-                line_account,
-                group_name,
-                school_address,
-                school_tel,
-                teacher_name,
-                teacher_tel,
-                teacher_email,
-                representative,
-                rep_tel,
-                rep_email,
-                design_confirm,
-                payment_method,
-                product_name,
-                product_color,
-                size_ss,
-                size_s,
-                size_m,
-                size_l,
-                size_ll,
-                size_lll,
-
-                print_size_front,
-                print_size_front_custom,
-                print_color_front,
-                font_no_front,
-                design_sample_front,
-                front_url,
-
-                print_size_back,
-                print_size_back_custom,
-                print_color_back,
-                font_no_back,
-                design_sample_back,
-                back_url,
-
-                print_size_other,
-                print_size_other_custom,
-                print_color_other,
-                font_no_other,
-                design_sample_other,
-                other_url,
-
-                additional_design_position,
-                additional_design_image_url
-            )
-            cur.execute(sql, params)
-            new_id = cur.fetchone()[0]
-        conn.commit()
-        logger.info(f"Inserted paper_order id={new_id}")
+    # DBに保存 (orders)
+    new_id = insert_order(order)
+    logger.info(f"Inserted paper_order id={new_id}")
 
     # 見積→注文へのコンバージョンを示すため、estimatesテーブル側の order_placed = true に更新
     mark_estimate_as_ordered(user_id)
 
     push_text = (
         "注文用紙(写真)からの注文を受け付けました！\n"
-        f"学校名: {school_name}\n"
-        f"商品名: {product_name}\n"
+        f"学校名: {order['school_name']}\n"
+        f"商品名: {order['product_name']}\n"
         "後ほど担当者からご連絡いたします。"
     )
-    try:
-        line_bot_api.push_message(to=user_id, messages=TextSendMessage(text=push_text))
-    except Exception as e:
-        logger.error(f"Push message failed: {e}")
+    push_message_async(user_id, TextSendMessage(text=push_text))
 
     return "紙の注文フォーム送信完了。LINEに通知を送りました。"
 
@@ -1992,88 +4643,359 @@ def mark_estimate_as_ordered(user_id):
 ###################################
 # ▼▼ 24時間ごとにリマインドを送るデモ
 ###################################
-import datetime
+REMINDER_THRESHOLD_SECONDS = int(os.getenv('REMINDER_THRESHOLD_SECONDS', '30'))  # 作成からこの秒数経過でリマインド
+REMINDER_MAX_COUNT = int(os.getenv('REMINDER_MAX_COUNT', '2'))
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '500'))
+
+def ensure_reminder_index():
+    """
+    リマインド対象の抽出用に、未注文の見積だけを対象とした部分インデックスを作成する。
+    estimates への書き込みを止めないよう CONCURRENTLY で作る (トランザクション外で実行する必要があるため autocommit)。
+    途中で失敗して INVALID のまま残ったインデックスは作り直す。
+    大きな estimates では数分かかるため、リクエスト中ではなく migrate コマンドで実行する。
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT i.indisvalid FROM pg_index i
+              JOIN pg_class c ON c.oid = i.indexrelid
+             WHERE c.relname = 'idx_estimates_reminder'
+            """)
+            row = cur.fetchone()
+            if row is not None and not row[0]:
+                logger.warning("Rebuilding invalid index idx_estimates_reminder")
+                cur.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_estimates_reminder")
+            cur.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_estimates_reminder
+                ON estimates (id, created_at)
+             WHERE order_placed = false
+            """)
+    finally:
+        if not conn.closed:
+            conn.autocommit = False
+        pool.putconn(conn)
+
+def format_elapsed(seconds: int) -> str:
+    """リマインド文面用に経過時間を日本語で表す (例: 86400 -> 1日)"""
+    for unit_sec, label in ((86400, "日"), (3600, "時間"), (60, "分")):
+        if seconds >= unit_sec and seconds % unit_sec == 0:
+            return f"{seconds // unit_sec}{label}"
+    return f"{seconds}秒"
+
+def fetch_reminder_batch(last_id: int):
+    """id > last_id のリマインド対象を REMINDER_BATCH_SIZE 件まで取得する (キーセットページング)"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, user_id, quote_number, total_price, reminder_count
+                  FROM estimates
+                 WHERE order_placed = false
+                   AND reminder_count < %s
+                   AND created_at < NOW() - %s * INTERVAL '1 second'
+                   AND id > %s
+                 ORDER BY id
+                 LIMIT %s
+                """,
+                (REMINDER_MAX_COUNT, REMINDER_THRESHOLD_SECONDS, last_id, REMINDER_BATCH_SIZE)
+            )
+            return cur.fetchall()
+
+def increment_reminder_counts(estimate_ids):
+    """送信できた見積の reminder_count を一括で +1 する"""
+    if not estimate_ids:
+        return
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE estimates SET reminder_count = reminder_count + 1 WHERE id = ANY(%s)",
+                (list(estimate_ids),)
+            )
+
+def send_grouped_messages(payloads: dict, retry_keys: dict = None) -> dict:
+    """
+    payloads: {user_id: [SendMessage, ...]}
+    retry_keys: {user_id: 文字列} 送信内容を一意に表すキー。失敗後に同じ payloads を同じキーで送り直すと、
+                前回届いたチャンクは再送されない (LineOutbox.send の retry_key)
+    同じ内容を受け取るユーザーは multicast (500人/回) でまとめて送り、
+    内容が異なるユーザーは1回の push に最大5通まとめて送る。
+    送信は LineOutbox 経由で並行に行い、全件の結果を待つ。
+    戻り値: {"delivered": 全チャンクが 2xx か、そのチャンクのリトライキーで受理済み (409) だった user_id の set,
+             "failed": set, "calls": API呼び出し回数}
+    """
+    groups = {}
+    for user_id, messages in payloads.items():
+        key = json.dumps([m.as_json_dict() for m in messages], sort_keys=True, ensure_ascii=False)
+        groups.setdefault(key, (messages, []))[1].append(user_id)
+
+    outbox = get_line_outbox()
+    pending = []
+    calls = 0
+    for messages, user_ids in groups.values():
+        for recipients in _chunks(user_ids, LINE_MULTICAST_MAX_RECIPIENTS):
+            retry_key = None
+            if retry_keys is not None:
+                retry_key = hashlib.sha256("\n".join(retry_keys[u] for u in recipients).encode("utf-8")).hexdigest()
+            pending.append((recipients, outbox.send(recipients, messages, retry_key=retry_key)))
+            calls += len(_chunks(messages, LINE_MAX_MESSAGES_PER_REQUEST))
+
+    delivered, failed = set(), set()
+    for recipients, future in pending:
+        try:
+            future.result()
+            delivered.update(recipients)
+        except Exception as e:
+            logger.error(f"LINE send failed for {len(recipients)} recipient(s): {e}")
+            failed.update(recipients)
+    return {"delivered": delivered, "failed": failed, "calls": calls}
 
 @app.route("/send_reminders", methods=["GET"])
 def send_reminders():
     """
-    作成から30秒以上経過した (order_placed=false, reminder_count<2) の見積をリマインドする。
-    Python側の時刻を UTC+9 (JST) として扱い、ログ出力を行う。
+    作成から REMINDER_THRESHOLD_SECONDS 秒以上経過した (order_placed=false, reminder_count<REMINDER_MAX_COUNT) の見積をリマインドする。
+    対象の絞り込みはSQL側で行い、id のキーセットで REMINDER_BATCH_SIZE 件ずつ処理する。
+    ユーザーごとにリマインド文とモード選択をまとめて送り、届いたユーザーの見積だけ reminder_count を増やす。
+    LINE送信中はDB接続を保持しない。
     """
     logger.info("[DEBUG] /send_reminders endpoint called.")
+    elapsed_text = format_elapsed(REMINDER_THRESHOLD_SECONDS)
+    mode_flex = create_mode_selection_flex()
+
+    last_id = 0
+    total_sent = 0
+    total_failed = 0
+    while True:
+        rows = fetch_reminder_batch(last_id)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        logger.info(f"[DEBUG] fetched {len(rows)} rows from estimates for reminder (last_id={last_id}).")
+
+        # ユーザーごとに「リマインド文(見積ごと) + モード選択」をまとめる
+        texts_by_user = {}
+        estimate_ids_by_user = {}
+        retry_keys = {}
+        for (est_id, user_id, quote_number, total_price, reminder_count) in rows:
+            reminder_text = (
+                f"【リマインド】\n"
+                f"簡易見積（見積番号: {quote_number}）\n"
+                f"合計金額: ¥{total_price:,}\n"
+                f"作成から{elapsed_text}以上経過しました。ご注文はお済みでしょうか？"
+            )
+            texts_by_user.setdefault(user_id, []).append(TextSendMessage(text=reminder_text))
+            estimate_ids_by_user.setdefault(user_id, []).append(est_id)
+            # 前回の実行で一部のチャンクだけ届いていても、同じ見積・同じ回数のリマインドなら届いた分は再送されない
+            retry_keys[user_id] = retry_keys.get(user_id, f"reminder:{user_id}") + f":{est_id}-{reminder_count}"
+
+        payloads = {user_id: texts + [mode_flex] for user_id, texts in texts_by_user.items()}
+        result = send_grouped_messages(payloads, retry_keys)
+        logger.info(
+            f"[DEBUG] reminder batch (last_id={last_id}): delivered={len(result['delivered'])} users, "
+            f"failed={len(result['failed'])} users, api_calls={result['calls']}"
+        )
 
-    # UTC+9 のタイムゾーンオブジェクト
-    UTC9 = datetime.timezone(datetime.timedelta(hours=9))
-    # 「今から30秒前」を JST で計算
-    threshold = datetime.datetime.now(UTC9) - datetime.timedelta(seconds=30)
-    logger.info(f"[DEBUG] threshold (30秒前) = {threshold}")
+        # reminder_countを+1 (届いたユーザーの見積のみ、バッチ単位で1回のUPDATE)
+        sent_ids = [est_id for user_id in result["delivered"] for est_id in estimate_ids_by_user[user_id]]
+        increment_reminder_counts(sent_ids)
+        total_sent += len(sent_ids)
+        total_failed += sum(len(estimate_ids_by_user[user_id]) for user_id in result["failed"])
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            # order_placed=false & reminder_count<2 の見積を全件取得
-            sql = """
-            SELECT id, user_id, quote_number, total_price, created_at
-              FROM estimates
-             WHERE order_placed = false
-               AND reminder_count < 2
-            """
-            cur.execute(sql)
-            rows = cur.fetchall()
+        if len(rows) < REMINDER_BATCH_SIZE:
+            break
+
+    logger.info(f"[DEBUG] Sent {total_sent} reminders ({total_failed} failed).")
+    return f"リマインド送信完了 (送信: {total_sent}件, 失敗: {total_failed}件)"
+
+###################################
+# ▼▼ 追加: 製造計画用のサイズ別集計
+#     受付日 x 商品 x カラー x サイズ ごとの枚数を size_breakdown テーブルに持ち、
+#     orders への INSERT と同じトランザクションで加算する。集計APIはこのテーブルだけを読む。
+#     テーブルの作成と初回の集計は集計API (初回の GET か POST) で行う。作成前に保存された注文は加算せず、
+#     初回の集計でまとめて数える (注文の保存処理では DDL や全件集計を行わない)。
+###################################
+SIZE_BREAKDOWN_LOCK_KEY = 0x5153  # 作成・再集計と加算を排他するための advisory lock のキー
+
+SIZE_BREAKDOWN_DDL = """
+CREATE TABLE IF NOT EXISTS size_breakdown (
+    day DATE NOT NULL,
+    product_name TEXT NOT NULL,
+    product_color TEXT NOT NULL,
+    size TEXT NOT NULL,
+    quantity BIGINT NOT NULL,
+    PRIMARY KEY (day, product_name, product_color, size)
+)
+"""
 
-            logger.info(f"[DEBUG] fetched {len(rows)} rows from estimates for reminder check.")
+_size_breakdown_ready = False
 
-            for (est_id, user_id, quote_number, total_price, created_at) in rows:
-                # DBが TIMESTAMP WITHOUT TIME ZONE の場合、tzinfo が None
-                if created_at.tzinfo is None:
-                    created_at = created_at.replace(tzinfo=UTC9)
+def _size_breakdown_exists(cur) -> bool:
+    global _size_breakdown_ready
+    if not _size_breakdown_ready:
+        cur.execute("SELECT to_regclass('size_breakdown')")
+        _size_breakdown_ready = cur.fetchone()[0] is not None
+    return _size_breakdown_ready
 
-                logger.info(
-                    f"[DEBUG] Checking estimate_id={est_id}, created_at={created_at}, quote_number={quote_number}"
-                )
+def ensure_size_breakdown_table():
+    """
+    size_breakdown が無ければ作成し、既存の orders から集計しておく (集計APIから呼ぶ)。
+    作成と初回集計は1トランザクションで、排他ロックの下で行う (複数ワーカーが同時に作成しない)。
+    """
+    if _size_breakdown_ready:
+        return
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SIZE_BREAKDOWN_LOCK_KEY,))
+            if not _size_breakdown_exists(cur):
+                cur.execute(SIZE_BREAKDOWN_DDL)
+                count = _rebuild_size_breakdown(cur)
+                logger.info(f"size_breakdown created: {count} rows")
 
-                # 「created_at < threshold」 → “作成から30秒以上 経過” とみなす
-                if created_at < threshold:
-                    logger.info(
-                        f"[DEBUG] estimate_id={est_id} is older than 30 seconds; sending reminder."
-                    )
-
-                    reminder_text = (
-                        f"【リマインド】\n"
-                        f"簡易見積（見積番号: {quote_number}）\n"
-                        f"合計金額: ¥{total_price:,}\n"
-                        "作成から30秒以上経過しました。ご注文はお済みでしょうか？"
-                    )
-
-                    try:
-                        # リマインド通知
-                        line_bot_api.push_message(
-                            to=user_id,
-                            messages=TextSendMessage(text=reminder_text)
-                        )
-                        # リマインド後、すぐモード選択を案内
-                        line_bot_api.push_message(
-                            to=user_id,
-                            messages=[create_mode_selection_flex()]
-                        )
-
-                        # reminder_countを+1
-                        with conn.cursor() as cur2:
-                            cur2.execute(
-                                "UPDATE estimates SET reminder_count = reminder_count + 1 WHERE id = %s",
-                                (est_id,)
-                            )
-                        conn.commit()
-
-                        logger.info(f"[DEBUG] Sent reminder and updated reminder_count for estimate_id={est_id}")
-                    except Exception as e:
-                        logger.error(f"Push reminder failed for user_id={user_id}, estimate_id={est_id}: {e}")
-                else:
-                    logger.info(
-                        f"[DEBUG] estimate_id={est_id} is NOT older than 30 seconds; skipping."
-                    )
+def add_order_sizes(cur, orders):
+    """
+    保存した注文のサイズ別枚数を size_breakdown に加算する (orders の INSERT と同じカーソル・トランザクションで呼ぶ)。
+    受付日は created_at と同じく NOW() の日付。
+    size_breakdown がまだ無い場合は何もしない (作成時の初回集計に含まれる)。
+    """
+    counts = {}
+    for order in orders:
+        product = order.get("product_name") or ""
+        color = order.get("product_color") or ""
+        for size, column in SIZE_FIELDS.items():
+            quantity = order.get(column)
+            if quantity:
+                key = (product, color, size)
+                counts[key] = counts.get(key, 0) + quantity
+    cur.execute("SELECT pg_advisory_xact_lock_shared(%s)", (SIZE_BREAKDOWN_LOCK_KEY,))
+    if not counts or not _size_breakdown_exists(cur):
+        return
+    execute_values(
+        cur,
+        """
+        INSERT INTO size_breakdown (day, product_name, product_color, size, quantity)
+        VALUES %s
+        ON CONFLICT (day, product_name, product_color, size)
+        DO UPDATE SET quantity = size_breakdown.quantity + EXCLUDED.quantity
+        """,
+        [key + (quantity,) for key, quantity in sorted(counts.items())],
+        template="(CURRENT_DATE, %s, %s, %s, %s)"
+    )
+
+def _rebuild_size_breakdown(cur) -> int:
+    """
+    orders 全体から size_breakdown を作り直す (排他ロックを取ったカーソルで呼ぶ)。
+    サイズ列を縦持ちに展開して GROUP BY する1本の INSERT ... SELECT で、DB側で1回走査するだけで済む。
+    戻り値: 集計後の行数
+    """
+    unpivot = ", ".join(f"('{size}', {column})" for size, column in SIZE_FIELDS.items())
+    cur.execute("DELETE FROM size_breakdown")
+    cur.execute(f"""
+    INSERT INTO size_breakdown (day, product_name, product_color, size, quantity)
+    SELECT o.created_at::date,
+           COALESCE(o.product_name, ''),
+           COALESCE(o.product_color, ''),
+           s.size,
+           SUM(s.quantity)
+      FROM orders o
+     CROSS JOIN LATERAL (VALUES {unpivot}) AS s (size, quantity)
+     WHERE s.quantity > 0
+       AND o.created_at IS NOT NULL
+     GROUP BY 1, 2, 3, 4
+    """)
+    return cur.rowcount
+
+def rebuild_size_breakdown() -> int:
+    """
+    size_breakdown を (無ければ作成して) orders 全体から作り直す。
+    実行中の注文の保存 (add_order_sizes) とは advisory lock で排他する。戻り値: 集計後の行数
+    """
+    global _size_breakdown_ready
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SIZE_BREAKDOWN_LOCK_KEY,))
+            cur.execute(SIZE_BREAKDOWN_DDL)
+            count = _rebuild_size_breakdown(cur)
+    _size_breakdown_ready = True
+    logger.info(f"size_breakdown rebuilt: {count} rows")
+    return count
+
+def fetch_size_breakdown(date_from=None, date_to=None, product_name=None, by_day=False) -> dict:
+    """
+    size_breakdown を 商品 x カラー (by_day なら 受付日 x 商品 x カラー) ごとのサイズ別ピボットにして返す。
+    戻り値: {"sizes": [...], "rows": [{"product_name", "product_color", "SS", ..., "total"}], "totals": {...}}
+    """
+    ensure_size_breakdown_table()
+    conditions, params = [], []
+    if date_from is not None:
+        conditions.append("day >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("day <= %s")
+        params.append(date_to)
+    if product_name:
+        conditions.append("product_name = %s")
+        params.append(product_name)
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    group = "day, product_name, product_color" if by_day else "product_name, product_color"
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT {group}, size, SUM(quantity) FROM size_breakdown{where} GROUP BY {group}, size ORDER BY {group}",
+                params
+            )
+            result = cur.fetchall()
+
+    sizes = list(SIZE_FIELDS)
+    pivot = {}
+    totals = dict.fromkeys(sizes + ["total"], 0)
+    for *keys, size, quantity in result:
+        row = pivot.get(tuple(keys))
+        if row is None:
+            row = pivot[tuple(keys)] = dict(zip(group.split(", "), keys), **dict.fromkeys(sizes + ["total"], 0))
+            if by_day:
+                row["day"] = row["day"].isoformat()
+        row[size] += int(quantity)
+        row["total"] += int(quantity)
+        totals[size] += int(quantity)
+        totals["total"] += int(quantity)
+    return {"sizes": sizes, "rows": list(pivot.values()), "totals": totals}
+
+@app.route("/production/size_breakdown", methods=["GET", "POST"])
+def size_breakdown():
+    """
+    GET: サイズ別集計のピボット (JSON)。クエリ: from / to (YYYY-MM-DD, 受付日), product, by_day=1
+    POST: orders から集計を作り直す。
+    どちらも Authorization: Bearer <EXPORT_API_TOKEN> が必要。
+    """
+    require_export_token()
+    if request.method == "POST":
+        data = {"rows": rebuild_size_breakdown()}
+    else:
+        try:
+            data = fetch_size_breakdown(
+                date_from=_parse_export_date(request.args.get("from")),
+                date_to=_parse_export_date(request.args.get("to")),
+                product_name=request.args.get("product"),
+                by_day=request.args.get("by_day") == "1"
+            )
+        except ValueError:
+            abort(400)
+    return app.response_class(json.dumps(data, ensure_ascii=False), mimetype="application/json")
 
-    return "リマインド送信完了"
 
+###################################
+# ▼▼ 追加: DBマイグレーション
+#     時間のかかる DDL はリクエスト中に実行せず、デプロイ時に
+#     flask --app graffitees_LINE_BOT migrate で実行する。
+###################################
+@app.cli.command("migrate")
+def migrate():
+    """リマインド用インデックスと size_breakdown テーブルを作成する (作成済みなら何もしない)"""
+    ensure_reminder_index()
+    ensure_size_breakdown_table()
+    logger.info("Migrations done")
 
 ###################################
 # Flask起動 (既存)
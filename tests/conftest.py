@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("CHANNEL_SECRET", "test")
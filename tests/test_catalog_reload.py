@@ -0,0 +1,56 @@
+"""
+reload_catalog を、失敗・復旧を切り替えられる偽の読み込み元に対して動かすテスト。
+"""
+import logging
+
+import pytest
+
+import graffitees_LINE_BOT as bot
+
+
+class FlakySource:
+    def __init__(self):
+        self.error = None
+        self.version_ = "v1"
+
+    def version(self):
+        if self.error:
+            raise self.error
+        return self.version_
+
+    def load(self):
+        return bot.Catalog(bot.PRICE_TABLE, version=self.version())
+
+
+@pytest.fixture
+def source(monkeypatch):
+    source = FlakySource()
+    monkeypatch.setattr(bot, "_catalog_source", source)
+    monkeypatch.setattr(bot, "_catalog", source.load())
+    monkeypatch.setattr(bot, "_catalog_failures", 0)
+    return source
+
+
+def catalog_records(caplog, level):
+    return [r for r in caplog.records if r.levelno == level and "Catalog" in r.getMessage()]
+
+
+def test_repeated_failures_are_logged_once_and_recovery_is_logged(source, caplog):
+    caplog.set_level(logging.INFO, logger=bot.logger.name)
+    current = bot._catalog
+
+    source.error = ConnectionError("db down")
+    for _ in range(5):
+        assert bot.reload_catalog() is current  # 失敗中は今のカタログを使い続ける
+    assert len(catalog_records(caplog, logging.ERROR)) == 1
+
+    source.error = None
+    assert bot.reload_catalog() is current  # バージョンは変わっていない
+    recovered = catalog_records(caplog, logging.INFO)
+    assert len(recovered) == 1 and "recovered after 5 failed attempt(s)" in recovered[0].getMessage()
+
+    # 復旧後にもう一度失敗したら、また1回だけ記録する
+    source.error = ConnectionError("db down again")
+    bot.reload_catalog()
+    bot.reload_catalog()
+    assert len(catalog_records(caplog, logging.ERROR)) == 2
@@ -0,0 +1,56 @@
+"""
+注文用紙の写真を、download_line_image が返すファイルオブジェクト (退避済みの SpooledTemporaryFile) のまま
+品質チェック・正規化・OCRキャッシュに渡すテスト。bytes で渡した場合と同じ結果になることを確かめる。
+"""
+import hashlib
+import io
+import tempfile
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import graffitees_LINE_BOT as bot
+
+
+def form_photo() -> bytes:
+    page = Image.new("L", (1200, 1600), 240)
+    draw = ImageDraw.Draw(page)
+    for y in range(100, 1500, 60):
+        draw.rectangle((100, y, 1100, y + 20), fill=20)
+    noise = np.random.default_rng(0).normal(0, 4, (1600, 1200))
+    page = Image.fromarray(np.clip(np.asarray(page) + noise, 0, 255).astype(np.uint8))
+    out = io.BytesIO()
+    page.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+@pytest.fixture
+def photo():
+    content = form_photo()
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024)  # ディスクに退避させる
+    spooled.write(content)
+    spooled.seek(0)
+    with spooled:
+        yield content, spooled
+
+
+def test_file_and_bytes_give_the_same_results(photo):
+    content, image_file = photo
+
+    assert bot.image_sha256(image_file) == hashlib.sha256(content).hexdigest()
+    assert bot.image_size_bytes(image_file) == len(content)
+    assert bot.measure_image_quality(image_file) == bot.measure_image_quality(content)
+    assert bot.normalize_image_for_ocr(image_file) == bot.normalize_image_for_ocr(content)
+
+
+def test_ocr_cache_sends_only_the_normalized_bytes(photo, monkeypatch):
+    content, image_file = photo
+    sent = []
+    monkeypatch.setattr(bot, "OCR_NORMALIZE", True)
+    monkeypatch.setattr(bot, "ocr_cache", bot.ResultCache("ocr-test", 8))
+    monkeypatch.setattr(bot, "google_vision_ocr", lambda image_content: sent.append(image_content) or "text")
+
+    assert bot.cached_google_vision_ocr(image_file) == "text"
+    assert bot.cached_google_vision_ocr(content) == "text"  # 同じ写真なのでキャッシュから返る
+    assert sent == [bot.normalize_image_for_ocr(content)]
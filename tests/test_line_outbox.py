@@ -0,0 +1,105 @@
+"""
+LineOutbox を偽の http_client に対して動かすテスト。
+偽の http_client は受け取ったリクエスト (ヘッダ・宛先) を記録し、応答は各テストで差し替える。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+import graffitees_LINE_BOT as bot
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.json = body or {}
+
+
+class FakeHttpClient:
+    def __init__(self):
+        self.requests = []  # (path, ヘッダ, 宛先)
+        self._lock = threading.Lock()
+        self.respond = lambda path, headers, body: FakeResponse(200)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        body = json.loads(data)
+        path = url[len(bot.line_bot_api.endpoint):]
+        time.sleep(0.001)  # 他のワーカーのリクエストと重なるようにする
+        with self._lock:
+            self.requests.append((path, dict(headers), body["to"]))
+        return self.respond(path, headers, body)
+
+
+@pytest.fixture
+def fake_http(monkeypatch):
+    client = FakeHttpClient()
+    monkeypatch.setattr(bot.line_bot_api, "http_client", client)
+    return client
+
+
+def chunk_key(retry_key, index=0):
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{retry_key}:{index}"))
+
+
+def test_concurrent_pushes_each_carry_their_own_retry_key(fake_http):
+    outbox = bot.LineOutbox(workers=8, queue_size=500, max_retries=0, enqueue_timeout=5)
+    futures = [
+        outbox.send(f"U{i}", bot.TextSendMessage(text=f"msg{i}"), retry_key=f"key{i}")
+        for i in range(200)
+    ]
+    for future in futures:
+        assert future.result(timeout=10) is True
+
+    assert len(fake_http.requests) == 200
+    for path, headers, to in fake_http.requests:
+        assert path == "/v2/bot/message/push"
+        assert headers["X-Line-Retry-Key"] == chunk_key(f"key{to[1:]}")
+    # 共有のクライアントのヘッダには書き込まない (reply や画像取得に紛れ込まない)
+    assert "X-Line-Retry-Key" not in bot.line_bot_api.headers
+
+
+def test_multicast_chunks_use_their_own_keys(fake_http):
+    outbox = bot.LineOutbox(workers=2, queue_size=10, max_retries=0, enqueue_timeout=5)
+    messages = [bot.TextSendMessage(text=str(i)) for i in range(7)]
+
+    assert outbox.send(["U1", "U2"], messages, retry_key="reminder").result(timeout=5) is True
+    assert [(path, headers["X-Line-Retry-Key"], to) for path, headers, to in fake_http.requests] == [
+        ("/v2/bot/message/multicast", chunk_key("reminder", 0), ["U1", "U2"]),
+        ("/v2/bot/message/multicast", chunk_key("reminder", 1), ["U1", "U2"]),
+    ]
+
+
+def test_409_counts_as_sent_only_when_the_key_was_accepted(fake_http):
+    outbox = bot.LineOutbox(workers=1, queue_size=10, max_retries=0, enqueue_timeout=5)
+
+    fake_http.respond = lambda path, headers, body: FakeResponse(409, {"X-Line-Accepted-Request-Id": "req-1"})
+    assert outbox.send("U1", bot.TextSendMessage(text="a"), retry_key="k1").result(timeout=5) is True
+
+    fake_http.respond = lambda path, headers, body: FakeResponse(409, body={"message": "Conflict"})
+    with pytest.raises(bot.LineBotApiError):
+        outbox.send("U1", bot.TextSendMessage(text="a"), retry_key="k2").result(timeout=5)
+    assert outbox.snapshot()["failed"] == 1
+
+
+def test_grouped_messages_count_only_accepted_users_as_delivered(fake_http, monkeypatch):
+    monkeypatch.setattr(bot, "_line_outbox", bot.LineOutbox(workers=2, queue_size=10, max_retries=0, enqueue_timeout=5))
+    monkeypatch.setattr(bot, "_line_outbox_pid", os.getpid())
+
+    def respond(path, headers, body):
+        if body["to"] == "U2":
+            return FakeResponse(409, body={"message": "Conflict"})  # 他のリクエストのキーとの衝突
+        if body["to"] == "U3":
+            return FakeResponse(409, {"X-Line-Accepted-Request-Id": "req-3"})  # 前回の実行で受理済み
+        return FakeResponse(200)
+
+    fake_http.respond = respond
+    payloads = {user_id: [bot.TextSendMessage(text=f"to {user_id}")] for user_id in ("U1", "U2", "U3")}
+    result = bot.send_grouped_messages(payloads, {user_id: f"reminder:{user_id}" for user_id in payloads})
+
+    assert result["delivered"] == {"U1", "U3"}
+    assert result["failed"] == {"U2"}
@@ -0,0 +1,36 @@
+"""
+local_extract_form_data を benchmarks/ocr_samples のOCRテキストに対して動かすテスト。
+ローカルで読めた値は OpenAI で上書きされないため、誤読の疑いがある値は返さないことを確認する。
+"""
+import os
+
+import pytest
+
+import graffitees_LINE_BOT as bot
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "ocr_samples")
+
+
+def read_sample(name):
+    with open(os.path.join(SAMPLES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def test_misread_phone_number_is_left_to_openai():
+    # 「O9O-8765-432l」(0 と 1 が英字に誤読されている) から一部の数字だけを拾わない
+    result = bot.local_extract_form_data(read_sample("04_sparse_handwriting.txt"))
+
+    assert "rep_tel" not in result
+    assert result["school_name"] == "北高 2-4"
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("090-8765-4321", "090-8765-4321"),
+    ("03-1234-5678", "03-1234-5678"),
+    ("0312345678", "0312345678"),
+    ("O9O-8765-432l", None),
+    ("090-8765-4321 内線12", None),
+    ("12345-6789", None),
+])
+def test_phone_numbers_must_be_read_completely(value, expected):
+    assert bot._coerce_local_value("rep_tel", value) == expected
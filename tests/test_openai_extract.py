@@ -0,0 +1,104 @@
+"""
+OPENAI_EXTRACT_MODE=function での _openai_extract_chunk を、ChatCompletion.create のスタブに対して動かすテスト。
+スタブは用意した function_call の引数を順番に返し、受け取ったリクエストを記録する。
+"""
+import json
+
+import pytest
+
+import graffitees_LINE_BOT as bot
+
+KEYS = ["application_date", "discount_option", "payment_method", "size_m", "size_l", "school_name"]
+
+
+class StubChatCompletion:
+    def __init__(self, *arguments):
+        self.arguments = list(arguments)
+        self.requests = []
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return {
+            "choices": [{"message": {
+                "content": None,
+                "function_call": {"name": bot.FORM_EXTRACT_FUNCTION_NAME, "arguments": self.arguments.pop(0)},
+            }}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20},
+        }
+
+
+@pytest.fixture
+def stub_openai(monkeypatch):
+    monkeypatch.setattr(bot, "OPENAI_EXTRACT_MODE", "function")
+
+    def install(*arguments):
+        stub = StubChatCompletion(*arguments)
+        monkeypatch.setattr(bot.openai.ChatCompletion, "create", stub.create)
+        return stub
+
+    return install
+
+
+def test_values_are_coerced_to_the_schema(stub_openai):
+    stub = stub_openai(json.dumps({
+        "application_date": "2024年5月1日",
+        "discount_option": "早割",
+        "payment_method": "後払い（銀行振込）",  # 全角括弧でも候補に一致させる
+        "size_m": "12枚",
+        "size_l": 3,
+        "school_name": " 〇〇高校 ",
+        "unknown_key": "x",
+    }, ensure_ascii=False))
+
+    result = bot._openai_extract_chunk("OCR text", KEYS)
+
+    assert result == {
+        "application_date": "2024-05-01",
+        "discount_option": "早割",
+        "payment_method": "後払い(銀行振込)",
+        "size_m": 12,
+        "size_l": 3,
+        "school_name": "〇〇高校",
+    }
+    assert len(stub.requests) == 1
+    request = stub.requests[0]
+    assert request["function_call"] == {"name": bot.FORM_EXTRACT_FUNCTION_NAME}
+    assert set(request["functions"][0]["parameters"]["properties"]) == set(KEYS)
+
+
+def test_invalid_fields_get_exactly_one_repair_request(stub_openai):
+    stub = stub_openai(
+        json.dumps({"application_date": "来週", "discount_option": "半額", "size_m": "12枚"}, ensure_ascii=False),
+        # 修正後も size_l は不正のまま、size_m は最初の値と食い違う
+        json.dumps({"application_date": "2024-05-01", "discount_option": None, "size_l": "たくさん", "size_m": 99},
+                   ensure_ascii=False),
+    )
+
+    result = bot._openai_extract_chunk("OCR text", KEYS)
+
+    # 最初から有効だった値はそのまま、修正で有効になった値だけが加わり、不正なままの項目は捨てる
+    assert result == {"application_date": "2024-05-01", "size_m": 12}
+    assert len(stub.requests) == 2
+    repair_prompt = stub.requests[1]["messages"][-1]["content"]
+    assert "application_date" in repair_prompt and "discount_option" in repair_prompt
+    assert "OCR text" not in repair_prompt
+
+
+def test_unparseable_arguments_are_repaired(stub_openai):
+    stub = stub_openai('{"size_m": 12', json.dumps({"size_m": 12}))
+
+    assert bot._openai_extract_chunk("OCR text", KEYS) == {"size_m": 12}
+    assert len(stub.requests) == 2
+
+
+def test_failed_repair_keeps_the_valid_fields(stub_openai, monkeypatch):
+    stub = stub_openai(json.dumps({"size_m": 5, "size_l": "?"}))
+
+    def create(**kwargs):
+        if stub.requests:
+            raise bot.openai.error.Timeout("timed out")
+        return stub.create(**kwargs)
+
+    monkeypatch.setattr(bot.openai.ChatCompletion, "create", create)
+
+    assert bot._openai_extract_chunk("OCR text", KEYS) == {"size_m": 5}
@@ -0,0 +1,70 @@
+"""
+stream_orders_csv を偽のDB接続に対して動かすテスト。
+偽のカーソルの copy_expert は COPY の出力を書き込み先に少しずつ書き、途中で読み手を待てるようにしてある。
+"""
+import contextlib
+import threading
+
+import pytest
+
+import graffitees_LINE_BOT as bot
+
+CHUNK = 16
+
+
+class FakeCursor:
+    def __init__(self, writes, gate):
+        self.writes = writes
+        self.gate = gate
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, sql, file, size=8192):
+        file.write(self.writes[0])
+        # 最初のチャンクが読み手に届くまで COPY の残りを書かない
+        assert self.gate.wait(timeout=5)
+        for data in self.writes[1:]:
+            file.write(data)
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+@pytest.fixture
+def fake_copy(monkeypatch):
+    monkeypatch.setattr(bot, "EXPORT_CHUNK_BYTES", CHUNK)
+    monkeypatch.setattr(bot, "build_orders_export_sql", lambda cur, **filters: "COPY ...")
+
+    def install(writes):
+        gate = threading.Event()
+        cursor = FakeCursor(writes, gate)
+        monkeypatch.setattr(bot, "get_db_connection", contextlib.contextmanager(lambda: (yield FakeConnection(cursor))))
+        return gate
+
+    return install
+
+
+def test_chunks_are_yielded_while_copy_is_still_running(fake_copy):
+    gate = fake_copy([b"x" * 40, b"y" * 10])
+    chunks = bot.stream_orders_csv({})
+
+    # COPY は gate を待っているので、ここで読めるのは1回目の書き込みの分だけ
+    assert next(chunks) == b"x" * CHUNK
+    gate.set()
+    assert list(chunks) == [b"x" * CHUNK, b"x" * 8 + b"y" * 8, b"y" * 2]
+
+
+def test_large_writes_are_split_into_fixed_size_chunks(fake_copy):
+    gate = fake_copy([b"z" * (CHUNK * 5 + 3)])
+    gate.set()
+
+    assert [len(c) for c in bot.stream_orders_csv({})] == [CHUNK] * 5 + [3]
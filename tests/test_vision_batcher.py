@@ -0,0 +1,118 @@
+"""
+VisionBatcher を偽の Vision クライアントに対して動かすテスト。
+batch_annotate_images の呼び出し内容 (画像・timeout) を記録し、応答は各テストで差し替える。
+"""
+import os
+
+import pytest
+from google.api_core import exceptions as gexc
+from google.cloud import vision
+
+import graffitees_LINE_BOT as bot
+
+
+def ocr_response(content):
+    return vision.AnnotateImageResponse(full_text_annotation=vision.TextAnnotation(text=content.decode()))
+
+
+class FakeVisionClient:
+    """画像の中身をそのまま OCR 結果として返す。respond を差し替えると応答を変えられる"""
+
+    def __init__(self):
+        self.calls = []  # (画像のリスト, timeout)
+        self.respond = lambda contents: [ocr_response(c) for c in contents]
+
+    def batch_annotate_images(self, requests, timeout=None):
+        contents = [r.image.content for r in requests]
+        self.calls.append((contents, timeout))
+        return vision.BatchAnnotateImagesResponse(responses=self.respond(contents))
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeVisionClient()
+    monkeypatch.setattr(bot, "_vision_client", client)
+    monkeypatch.setattr(bot, "_vision_pid", os.getpid())
+    return client
+
+
+def test_window_collects_images_into_one_request(fake_client):
+    batcher = bot.VisionBatcher(window_sec=0.05, max_images=16, max_bytes=1024, timeout_sec=5)
+    futures = [batcher.submit(f"img{i}".encode()) for i in range(3)]
+
+    assert [f.result(timeout=2) for f in futures] == ["img0", "img1", "img2"]
+    assert fake_client.calls == [([b"img0", b"img1", b"img2"], 5)]
+
+
+def test_max_images_sends_without_waiting_for_window(fake_client):
+    batcher = bot.VisionBatcher(window_sec=60, max_images=2, max_bytes=1024, timeout_sec=5)
+    futures = [batcher.submit(f"img{i}".encode()) for i in range(2)]
+
+    # submit() の中で送信済みなので、ウィンドウ (60秒) を待たずに結果が揃っている
+    assert all(f.done() for f in futures)
+    assert [f.result() for f in futures] == ["img0", "img1"]
+    assert len(fake_client.calls) == 1
+
+
+def test_max_bytes_flushes_pending_batch_first(fake_client):
+    batcher = bot.VisionBatcher(window_sec=60, max_images=2, max_bytes=10, timeout_sec=5)
+    first = batcher.submit(b"a" * 8)
+    second = batcher.submit(b"b" * 8)  # 合計が max_bytes を超えるので first だけ先に送る
+
+    assert first.result(timeout=0) == "a" * 8
+    assert not second.done()
+    batcher._flush()
+    assert second.result(timeout=0) == "b" * 8
+    assert [contents for contents, _ in fake_client.calls] == [[b"a" * 8], [b"b" * 8]]
+
+
+def test_timeout_fails_every_future_in_the_batch(fake_client):
+    def deadline_exceeded(contents):
+        raise gexc.DeadlineExceeded("Deadline Exceeded")
+
+    fake_client.respond = deadline_exceeded
+    batcher = bot.VisionBatcher(window_sec=60, max_images=3, max_bytes=1024, timeout_sec=0.5)
+    futures = [batcher.submit(f"img{i}".encode()) for i in range(3)]
+
+    assert fake_client.calls[0][1] == 0.5
+    for f in futures:
+        with pytest.raises(gexc.DeadlineExceeded):
+            f.result(timeout=0)
+
+
+def test_timeout_does_not_block_the_next_batch(fake_client):
+    def fail_first_call(contents):
+        if len(fake_client.calls) == 1:
+            raise gexc.DeadlineExceeded("Deadline Exceeded")
+        return [ocr_response(c) for c in contents]
+
+    fake_client.respond = fail_first_call
+    batcher = bot.VisionBatcher(window_sec=60, max_images=1, max_bytes=1024, timeout_sec=0.5)
+    failed = batcher.submit(b"img0")
+    ok = batcher.submit(b"img1")
+
+    with pytest.raises(gexc.DeadlineExceeded):
+        failed.result(timeout=0)
+    assert ok.result(timeout=0) == "img1"
+
+
+def test_missing_and_failed_responses_map_to_their_own_images(fake_client):
+    # 2枚目はエラー、3枚目は応答そのものが返ってこない
+    fake_client.respond = lambda contents: [
+        ocr_response(contents[0]),
+        vision.AnnotateImageResponse(error={"message": "Bad image data."}),
+    ]
+    batcher = bot.VisionBatcher(window_sec=60, max_images=3, max_bytes=1024, timeout_sec=5)
+    ok, bad, missing = [batcher.submit(f"img{i}".encode()) for i in range(3)]
+
+    assert ok.result(timeout=0) == "img0"
+    with pytest.raises(Exception, match="Bad image data"):
+        bad.result(timeout=0)
+    with pytest.raises(Exception, match="no response for image"):
+        missing.result(timeout=0)
+
+
+def test_result_timeout_covers_the_window_and_the_request_timeout():
+    batcher = bot.VisionBatcher(window_sec=0.2, max_images=16, max_bytes=1024, timeout_sec=60, margin_sec=5)
+
+    assert batcher.result_timeout == pytest.approx(65.2)